@@ -1,7 +1,11 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+from .accounting import *
 from .action import *
+from .cassette import *
+from .checks_cache import *
 from .dist import *
 from .dpkg import *
+from .durations import *
 from .log import *
 from .mariadb import *
 from .leapp_configs import *
@@ -9,10 +13,13 @@ from .motd import *
 from .packages import *
 from .php import *
 from .plesk import *
+from .query_cache import *
 from .feedback import *
 from .files import *
+from .journal import *
 from .rpm import *
 from .systemd import *
+from .tracing import *
 from .util import *
 from .version import *
 from .writers import *
\ No newline at end of file
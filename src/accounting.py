@@ -0,0 +1,184 @@
+# Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import contextlib
+import json
+import os
+import subprocess
+import threading
+import time
+import typing
+
+from . import cassette, files, log
+
+
+class ProcessUsage():
+    """Resources used by one finished child process, as reported by os.wait4."""
+
+    __slots__ = ("cmd", "stage", "action", "wall_time", "user_time", "system_time", "max_rss_kb",
+                 "read_blocks", "written_blocks", "voluntary_switches", "involuntary_switches")
+
+    def __init__(self, cmd: typing.Union[str, typing.List[str]], stage: typing.Optional[str], action: typing.Optional[str],
+                 wall_time: float, rusage: typing.Any):
+        self.cmd = cmd
+        self.stage = stage
+        self.action = action
+        self.wall_time = wall_time
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        # Linux reports max resident set size in kilobytes
+        self.max_rss_kb = rusage.ru_maxrss
+        self.read_blocks = rusage.ru_inblock
+        self.written_blocks = rusage.ru_oublock
+        # Voluntary switches are waits for I/O or other processes, involuntary ones are preemptions
+        self.voluntary_switches = rusage.ru_nvcsw
+        self.involuntary_switches = rusage.ru_nivcsw
+
+
+class ResourcesUsage():
+    """Usage of resources by child processes aggregated per stage and per action.
+
+    Utilization in the summary is CPU time divided by wall time, so a value close to 1 means
+    the step is CPU-bound, while a low value with many read or written blocks means I/O-bound
+    and a low value without them means the step mostly waits, e.g. for network.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, usage: ProcessUsage) -> None:
+        with self._lock:
+            self.records.append(usage)
+
+    @staticmethod
+    def _aggregate(records: typing.List[ProcessUsage]) -> typing.Dict[str, typing.Any]:
+        wall_time = sum(record.wall_time for record in records)
+        cpu_time = sum(record.user_time + record.system_time for record in records)
+        return {
+            "commands": len(records),
+            "wall_time": round(wall_time, 3),
+            "user_time": round(sum(record.user_time for record in records), 3),
+            "system_time": round(sum(record.system_time for record in records), 3),
+            "cpu_utilization": round(cpu_time / wall_time, 3) if wall_time > 0 else 0,
+            "max_rss_kb": max((record.max_rss_kb for record in records), default=0),
+            "read_blocks": sum(record.read_blocks for record in records),
+            "written_blocks": sum(record.written_blocks for record in records),
+            "voluntary_switches": sum(record.voluntary_switches for record in records),
+            "involuntary_switches": sum(record.involuntary_switches for record in records),
+        }
+
+    def get_summary(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            records = list(self.records)
+
+        by_stage = {}
+        by_action = {}
+        for record in records:
+            if record.stage is not None:
+                by_stage.setdefault(record.stage, []).append(record)
+            if record.action is not None:
+                by_action.setdefault(record.action, []).append(record)
+
+        return {
+            "total": self._aggregate(records),
+            "stages": {stage: self._aggregate(stage_records) for stage, stage_records in by_stage.items()},
+            "actions": {action: self._aggregate(action_records) for action, action_records in by_action.items()},
+        }
+
+    def save(self, path: str) -> None:
+        files.rewrite_json_file(path, self.get_summary())
+
+    def log_summary(self) -> None:
+        if self.records:
+            log.debug("Resources usage of child processes: {summary}".format(summary=json.dumps(self.get_summary())))
+
+
+_context = threading.local()
+
+
+def _get_target() -> typing.Optional[typing.Tuple[ResourcesUsage, typing.Optional[str], typing.Optional[str]]]:
+    return getattr(_context, "target", None)
+
+
+@contextlib.contextmanager
+def accounted_to(usage: ResourcesUsage, stage: typing.Optional[str] = None, action: typing.Optional[str] = None):
+    """Account child processes started by the current thread to the stage and action."""
+    previous = _get_target()
+    _context.target = (usage, stage, action)
+    try:
+        yield
+    finally:
+        _context.target = previous
+
+
+class AccountedPopen(subprocess.Popen):
+    """Popen which reaps the child by os.wait4 to get its resources usage.
+
+    The target is taken on creation, so the process is accounted properly even
+    when it is waited from another thread, like the asyncio runner does.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._accounting_target = _get_target()
+        self._started_at = time.monotonic()
+        self.usage = None
+        super().__init__(*args, **kwargs)
+
+    def _try_wait(self, wait_flags):
+        # The same as Popen._try_wait but with os.wait4 instead of os.waitpid
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # This happens if SIGCLD is set to be ignored, the status is lost
+            return self.pid, 0
+
+        if pid == self.pid:
+            self._account(rusage)
+        return pid, status
+
+    def _account(self, rusage: typing.Any) -> None:
+        target = self._accounting_target
+        usage = ProcessUsage(self.args, target[1] if target else None, target[2] if target else None,
+                             time.monotonic() - self._started_at, rusage)
+        self.usage = usage
+        if target is not None:
+            target[0].add(usage)
+
+
+def run(*popenargs, input: typing.Any = None, timeout: typing.Optional[float] = None, check: bool = False,
+        **kwargs) -> subprocess.CompletedProcess:
+    """The same as subprocess.run, but the resources usage of the process is accounted.
+    When a cassette is active, the process is recorded or replayed."""
+    active_cassette = cassette.get_active_cassette()
+    if active_cassette is not None and active_cassette.replaying:
+        return active_cassette.replay_run(popenargs[0] if popenargs else kwargs["args"], input, check, kwargs)
+
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+
+    started_at = time.monotonic()
+    with AccountedPopen(*popenargs, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+        except BaseException:
+            process.kill()
+            raise
+        returncode = process.poll()
+
+    if active_cassette is not None:
+        active_cassette.record(process.args, input, stdout, stderr, returncode, time.monotonic() - started_at)
+
+    if check and returncode:
+        raise subprocess.CalledProcessError(returncode, process.args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(process.args, returncode, stdout, stderr)
+
+
+def check_output(*popenargs, **kwargs) -> typing.Any:
+    return run(*popenargs, stdout=subprocess.PIPE, check=True, **kwargs).stdout
+
+
+def call(*popenargs, **kwargs) -> int:
+    return run(*popenargs, **kwargs).returncode
@@ -1,14 +1,17 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
-import os
-import json
 import math
+import queue
 import time
 import typing
 import shutil
+import signal
+import subprocess
+import threading
 
+from concurrent import futures
 from enum import Enum
 
-from . import files, log, plesk, writers
+from . import accounting, checks_cache, durations, journal, log, packages, plesk, query_cache, tracing, util, writers
 
 
 class Action():
@@ -38,6 +41,16 @@ class Action():
 
 
 class ActiveAction(Action):
+    # Dependencies are taken into account only when a flow runs actions in parallel.
+    # Actions that are not marked as concurrent are executed as a barrier: they wait
+    # for all previous actions of the stage and all next actions wait for them.
+    concurrent: bool = False
+    # Names of actions from the same stage that should be finished before this one is started
+    depends_on: typing.List[str] = []
+    # Things the action touches, like "yum", "/etc/my.cnf" or "mariadb.service".
+    # Actions which share a resource are never executed at the same time.
+    resources: typing.List[str] = []
+
     def invoke_prepare(self):
         self._prepare_action()
 
@@ -54,6 +67,14 @@ class ActiveAction(Action):
         # All actions are required by default - just to simplefy things
         return True
 
+    def is_still_applied(self) -> bool:
+        return self._is_still_applied()
+
+    def _is_still_applied(self) -> bool:
+        # Used on resume of an interrupted flow. By default we trust the persisted state,
+        # actions could override it with a cheap check the changes were not reverted
+        return True
+
     def _prepare_action(self):
         raise NotImplementedError("Not implemented prapare action is called")
 
@@ -82,17 +103,149 @@ class ActionsFlow():
         pass
 
 
+class StageScheduler():
+    """Runs actions of one stage on a bounded pool of workers.
+
+    The order of actions in the stage is kept for everything that is not
+    explicitly marked as concurrent, so the scheduler is safe to use with
+    actions that know nothing about parallel execution.
+    """
+
+    def __init__(self, actions: typing.List[ActiveAction], max_workers: int):
+        self.actions = actions
+        self.max_workers = max_workers
+        self.dependencies = self._build_dependencies(actions)
+
+    @staticmethod
+    def _build_dependencies(actions: typing.List[ActiveAction]) -> typing.Dict[int, typing.Set[int]]:
+        positions = {action.name: index for index, action in enumerate(actions)}
+        dependencies = {}
+        last_barrier = None
+
+        for index, action in enumerate(actions):
+            if not action.concurrent:
+                dependencies[index] = set(range(index))
+                last_barrier = index
+                continue
+
+            required = set() if last_barrier is None else {last_barrier}
+            for name in action.depends_on:
+                # Actions from other stages are finished already because of stage boundaries
+                if name not in positions:
+                    continue
+                if positions[name] >= index:
+                    raise ValueError("Action {name!s} depends on the action {dependency!s} which goes after it in the stage".format(
+                                     name=action.name, dependency=name))
+                required.add(positions[name])
+
+            first_candidate = 0 if last_barrier is None else last_barrier + 1
+            for previous in range(first_candidate, index):
+                if set(actions[previous].resources) & set(action.resources):
+                    required.add(previous)
+
+            dependencies[index] = required
+
+        return dependencies
+
+    def run(self, worker: typing.Callable[[ActiveAction], None]) -> typing.Optional[typing.Tuple[ActiveAction, Exception]]:
+        """Call worker for every action. Stops to start new actions on the first failure,
+        waits for already started ones and returns the failed action with the exception."""
+        pending = dict(self.dependencies)
+        done = set()
+        running = {}
+        failure = None
+
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if failure is None:
+                    ready = [index for index, required in pending.items() if required <= done]
+                    for index in ready[:self.max_workers - len(running)]:
+                        del pending[index]
+                        running[executor.submit(worker, self.actions[index])] = index
+
+                if not running:
+                    break
+
+                finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    index = running.pop(future)
+                    if future.exception() is not None:
+                        if failure is None:
+                            failure = (self.actions[index], future.exception())
+                    else:
+                        done.add(index)
+
+        return failure
+
+
+class PlannedAction():
+    def __init__(self, action: ActiveAction, required: bool, estimate: int):
+        self.action = action
+        self.required = required
+        self.estimate = estimate
+
+
+class ExecutionPlan():
+    """Frozen decision which actions of a flow are going to be executed and how long it takes."""
+
+    def __init__(self):
+        self.stages = {}
+        self._by_action = {}
+
+    def add(self, stage_id: str, planned: PlannedAction) -> None:
+        self.stages.setdefault(stage_id, []).append(planned)
+        self._by_action[planned.action] = planned
+
+    def is_required(self, action: ActiveAction) -> typing.Optional[bool]:
+        planned = self._by_action.get(action)
+        return planned.required if planned is not None else None
+
+    def get_total_time(self) -> int:
+        return sum(planned.estimate for planned in self._by_action.values())
+
+    def describe(self) -> typing.List[str]:
+        lines = []
+        for stage_id, planned_actions in self.stages.items():
+            lines.append("Stage {stage}:".format(stage=stage_id))
+            for planned in planned_actions:
+                mark = "[run ]" if planned.required else "[skip]"
+                lines.append("\t{mark} {name} ({estimate} sec)".format(mark=mark, name=planned.action.name, estimate=planned.estimate))
+        lines.append("Estimated time: {total} sec".format(total=self.get_total_time()))
+        return lines
+
+
 class ActiveFlow(ActionsFlow):
 
     PATH_TO_ACTIONS_DATA = plesk.CONVERTER_TEMP_DIRECTORY + "/distupgrade_actions.json"
+    # Name of the phase in actions durations history
+    ACTIONS_PHASE = "prepare"
 
-    def __init__(self, stages: typing.Dict[str, typing.List[ActiveAction]]):
+    def __init__(self, stages: typing.Dict[str, typing.List[ActiveAction]], max_workers: int = 1,
+                 actions_durations: durations.ActionsDurations = None, packages_transactions: bool = False):
         super().__init__(stages)
         self._finished = False
         self.current_stage = "initiliazing"
         self.current_action = "initiliazing"
         self.total_time = 0
         self.error = None
+        # Last lines of output of the failed command, if the flow is failed because of one
+        self.error_output = []
+        # Actions are executed one by one unless more workers are allowed
+        self.max_workers = max_workers
+        self._state_lock = threading.Lock()
+        # Packages operations deferred by actions are performed by one transaction at the end of every stage
+        self.packages_transactions = packages_transactions
+        # Measured durations of previous runs are used for estimations when passed
+        self.actions_durations = actions_durations
+        # Persisted states of actions. Loaded by the particular flow on enter
+        self.actions_states = journal.ActionsStateStore(self.PATH_TO_ACTIONS_DATA)
+        # Requirement of actions is evaluated once when the plan is made
+        self.plan = None
+        # Observers like progressbar could wait for changes of stage, action or flow status
+        self._state_changed = threading.Condition()
+        self._state_version = 0
+        # Child processes started by actions are accounted per stage and per action
+        self.resources_usage = accounting.ResourcesUsage()
 
     def validate_actions(self):
         # Note. This one is for development porpuses only
@@ -101,41 +254,127 @@ class ActiveFlow(ActionsFlow):
                 if not isinstance(action, ActiveAction):
                     raise TypeError("Non an ActiveAction passed into action flow. Name of the action is {name!s}".format(name=action.name))
 
-    def pass_actions(self) -> bool:
+    def make_plan(self, max_workers: int = 1) -> ExecutionPlan:
+        """Evaluate requirement of every action once and freeze it for estimation and execution.
+        Note the decision is not changed even if an earlier action affects it."""
+        flow = self._get_flow()
+        actions = [action for stage_actions in flow.values() for action in stage_actions]
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            requirements = dict(zip(actions, executor.map(self._is_action_required, actions)))
+
+        self.plan = ExecutionPlan()
+        for stage_id, stage_actions in flow.items():
+            for action in stage_actions:
+                self.plan.add(stage_id, PlannedAction(action, requirements[action], 0))
+
+        for planned_actions in self.plan.stages.values():
+            for planned in planned_actions:
+                if planned.required:
+                    planned.estimate = self._get_action_estimate(planned.action)
+
+        self.total_time = 0
+        return self.plan
+
+    def pass_actions(self, dry_run: bool = False) -> bool:
+        if dry_run:
+            plan = self.plan if self.plan is not None else self.make_plan()
+            for line in plan.describe():
+                log.info(line)
+            return True
+
+        try:
+            return self._pass_stages()
+        finally:
+            self._notify_state_changed()
+            if self.actions_durations is not None:
+                self.actions_durations.save()
+            self.resources_usage.log_summary()
+
+    def _pass_stages(self) -> bool:
         stages = self._get_flow()
         self._finished = False
 
         for stage_id, actions in stages.items():
-            self._pre_stage(stage_id, actions)
-            for action in actions:
-                try:
-                    if not self._is_action_required(action):
-                        log.info("Skipped: {description!s}".format(description=action))
-                        self._save_action_state(action.name, ActionState.skiped)
-                        continue
-
-                    self._invoke_action(action)
+            with tracing.span("stage {stage}".format(stage=stage_id), "stage"):
+                self._pre_stage(stage_id, actions)
 
-                    self._save_action_state(action.name, ActionState.success)
-                    log.info("Success: {description!s}".format(description=action))
-                except Exception as ex:
+                if self.packages_transactions:
+                    packages.begin_transaction()
+                try:
+                    failure = self._pass_stage_actions(actions)
+                    if self.packages_transactions:
+                        # Operations of successfully finished actions are performed even if the stage is failed
+                        transaction_failure = self._commit_packages_transaction(actions)
+                        if failure is None:
+                            failure = transaction_failure
+                finally:
+                    if self.packages_transactions:
+                        # Nothing should be deferred into the transaction of the stage interrupted by an exception
+                        packages.abort_transaction()
+
+                if failure is not None:
+                    action, ex = failure
                     self._save_action_state(action.name, ActionState.failed)
                     self.error = Exception("Failed: {description!s}. The reason: {error}".format(description=action, error=ex))
+                    if isinstance(ex, (subprocess.CalledProcessError, subprocess.TimeoutExpired)) and ex.output:
+                        self.error_output = ex.output.splitlines()
                     log.err("Failed: {description!s}. The reason: {error}".format(description=action, error=ex))
                     return False
 
-            self._post_stage(stage_id, actions)
+                self._post_stage(stage_id, actions)
 
         self._finished = True
         return True
 
+    def _pass_stage_actions(self, actions: typing.List[ActiveAction]) -> typing.Optional[typing.Tuple[ActiveAction, Exception]]:
+        if self.max_workers > 1:
+            return StageScheduler(actions, self.max_workers).run(self._pass_action)
+
+        for action in actions:
+            try:
+                self._pass_action(action)
+            except Exception as ex:
+                return action, ex
+
+        return None
+
+    def _commit_packages_transaction(self, actions: typing.List[ActiveAction]) -> typing.Optional[typing.Tuple[ActiveAction, Exception]]:
+        try:
+            packages.commit_transaction()
+        except packages.PackagesTransactionError as ex:
+            failed = [action for action in actions if action.name in ex.requesters]
+            for action in failed:
+                self._save_action_state(action.name, ActionState.failed)
+            return (failed[0] if failed else actions[-1]), ex
+
+        return None
+
+    def _pass_action(self, action: ActiveAction) -> None:
+        if not self._get_action_requirement(action):
+            log.info("Skipped: {description!s}".format(description=action))
+            with self._state_lock:
+                self._save_action_state(action.name, ActionState.skiped)
+            return
+
+        start_time = time.monotonic()
+        with tracing.span(action.name, "action", flow=self.__class__.__name__), packages.transaction_requester(action.name), \
+                accounting.accounted_to(self.resources_usage, self.current_stage, action.name):
+            self._invoke_action(action)
+        if self.actions_durations is not None:
+            self.actions_durations.record(self.ACTIONS_PHASE, action.name, time.monotonic() - start_time)
+
+        with self._state_lock:
+            self._save_action_state(action.name, ActionState.success)
+        log.info("Success: {description!s}".format(description=action))
+
     def _get_flow(self) -> typing.Dict[str, typing.List[ActiveAction]]:
         return {}
 
     def _pre_stage(self, stage_id: str, actions: typing.List[ActiveAction]):
         log.info("Start stage {stage}.".format(stage=stage_id))
         self.current_stage = stage_id
-        pass
+        query_cache.clear_stage_queries()
+        self._notify_state_changed()
 
     def _post_stage(self, stage_id: str, actions: typing.List[ActiveAction]):
         pass
@@ -143,19 +382,32 @@ class ActiveFlow(ActionsFlow):
     def _is_action_required(self, action: ActiveAction) -> bool:
         return action.is_required()
 
+    def _get_action_requirement(self, action: ActiveAction) -> bool:
+        if self.plan is not None:
+            required = self.plan.is_required(action)
+            if required is not None:
+                return required
+        return self._is_action_required(action)
+
     def _invoke_action(self, action: ActiveAction) -> None:
         log.info("Do: {description!s}".format(description=action))
         self.current_action = action.name
+        self._notify_state_changed()
 
     def _save_action_state(self, name: str, state: ActionState) -> None:
         pass
 
-    def _load_actions_state(self):
-        if os.path.exists(self.PATH_TO_ACTIONS_DATA):
-            with open(self.PATH_TO_ACTIONS_DATA, "r") as actions_data_file:
-                return json.load(actions_data_file)
+    def _notify_state_changed(self) -> None:
+        with self._state_changed:
+            self._state_version += 1
+            self._state_changed.notify_all()
 
-        return {"actions": []}
+    def wait_state_change(self, seen_version: int, timeout: float) -> int:
+        """Wait until the flow state differs from the seen version or timeout is expired.
+        Returns the actual version of the flow state."""
+        with self._state_changed:
+            self._state_changed.wait_for(lambda: self._state_version != seen_version, timeout)
+            return self._state_version
 
     def is_finished(self) -> bool:
         return self._finished or self.error is not None
@@ -166,19 +418,41 @@ class ActiveFlow(ActionsFlow):
     def get_error(self) -> Exception:
         return self.error
 
+    def get_error_output(self) -> typing.List[str]:
+        return self.error_output
+
     def get_current_stage(self) -> str:
         return self.current_stage
 
     def get_current_action(self) -> str:
         return self.current_action
 
+    def get_resources_usage(self) -> typing.Dict[str, typing.Any]:
+        return self.resources_usage.get_summary()
+
+    def get_running_commands(self) -> typing.List[util.CommandHeartbeat]:
+        # Heartbeats of commands started by util.logged_check_call, so a stuck command
+        # could be distinguished from a slow one by the time since its last output
+        return util.get_running_commands()
+
     def _get_action_estimate(self, action: ActiveAction) -> int:
-        return action.estimate_prepare_time()
+        return self._get_learned_estimate(action, action.estimate_prepare_time)
+
+    def _get_learned_estimate(self, action: ActiveAction, static_estimate: typing.Callable[[], int]) -> int:
+        if self.actions_durations is not None:
+            learned = self.actions_durations.estimate(self.ACTIONS_PHASE, action.name)
+            if learned is not None:
+                return learned
+        return static_estimate()
 
     def get_total_time(self) -> int:
         if self.total_time != 0:
             return self.total_time
 
+        if self.plan is not None:
+            self.total_time = self.plan.get_total_time()
+            return self.total_time
+
         for _, actions in self.stages.items():
             for action in actions:
                 self.total_time += self._get_action_estimate(action)
@@ -188,24 +462,57 @@ class ActiveFlow(ActionsFlow):
 
 class PrepareActionsFlow(ActiveFlow):
 
-    def __init__(self, stages: typing.Dict[str, typing.List[ActiveAction]]):
-        super().__init__(stages)
-        self.actions_data = {}
+    def __init__(self, stages: typing.Dict[str, typing.List[ActiveAction]], max_workers: int = 1,
+                 actions_durations: durations.ActionsDurations = None, packages_transactions: bool = False,
+                 resume: bool = False):
+        super().__init__(stages, max_workers, actions_durations, packages_transactions)
+        self.resume = resume
+        self.resumed_actions = []
 
     def __enter__(self):
-        self.actions_data = self._load_actions_state()
+        self.actions_states.load().open()
+        if self.resume:
+            self.resumed_actions = self._find_resumed_actions()
+            log.info("Resume: {count} actions are done already and will be skipped: {names}".format(
+                     count=len(self.resumed_actions), names=", ".join(self.get_resumed_actions())))
         return self
 
     def __exit__(self, *kwargs):
-        files.rewrite_json_file(self.PATH_TO_ACTIONS_DATA, self.actions_data)
+        self.actions_states.close()
 
-    def _save_action_state(self, name: str, state: ActionState) -> None:
-        for action in self.actions_data["actions"]:
-            if action["name"] == name:
-                action["state"] = state
-                return
+    def _find_resumed_actions(self) -> typing.List[ActiveAction]:
+        # Only the beginning of the flow, up to the first incomplete action, is skipped.
+        # Everything after the action could depend on it, so it will be executed again.
+        resumed = []
+        for _, actions in self._get_flow().items():
+            for action in actions:
+                if self.actions_states.get_state(action.name) != ActionState.success:
+                    return resumed
 
-        self.actions_data["actions"].append({"name": name, "state": state})
+                try:
+                    if not action.is_still_applied():
+                        log.info("Resume: {description!s} was done, but the changes are not applied anymore".format(description=action))
+                        return resumed
+                except Exception as ex:
+                    log.warn("Resume: unable to check if {description!s} is still applied: {error}".format(description=action, error=ex))
+                    return resumed
+
+                resumed.append(action)
+
+        return resumed
+
+    def get_resumed_actions(self) -> typing.List[str]:
+        return [action.name for action in self.resumed_actions]
+
+    def _pass_action(self, action: ActiveAction) -> None:
+        if action in self.resumed_actions:
+            log.info("Already done: {description!s}".format(description=action))
+            return
+
+        super()._pass_action(action)
+
+    def _save_action_state(self, name: str, state: ActionState) -> None:
+        self.actions_states.set_state(name, state)
 
     def _get_flow(self) -> typing.Dict[str, typing.List[ActiveAction]]:
         return self.stages
@@ -215,18 +522,19 @@ class PrepareActionsFlow(ActiveFlow):
         action.invoke_prepare()
 
     def _get_action_estimate(self, action: ActiveAction) -> int:
-        return action.estimate_prepare_time()
+        if action in self.resumed_actions:
+            return 0
+        return self._get_learned_estimate(action, action.estimate_prepare_time)
 
 
 class ReverseActionFlow(ActiveFlow):
 
     def __enter__(self):
-        self.actions_data = self._load_actions_state()
+        self.actions_states.load()
         return self
 
     def __exit__(self, *kwargs):
-        if os.path.exists(self.PATH_TO_ACTIONS_DATA):
-            os.remove(self.PATH_TO_ACTIONS_DATA)
+        self.actions_states.remove()
 
     def _get_flow(self) -> typing.Dict[str, typing.List[ActiveAction]]:
         return dict(reversed(list(self.stages.items())))
@@ -234,47 +542,75 @@ class ReverseActionFlow(ActiveFlow):
     def _is_action_required(self, action: ActiveAction) -> bool:
         # I believe the finish stage could have an action that was not performed on conversion stage
         # So we ignore the case when there is no actions is persistance store
-        for stored_action in self.actions_data["actions"]:
-            if stored_action["name"] == action.name:
-                if stored_action["state"] == ActionState.failed or stored_action["state"] == ActionState.skiped:
-                    return False
-                elif stored_action["state"] == ActionState.success:
-                    return True
+        stored_state = self.actions_states.get_state(action.name)
+        if stored_state == ActionState.failed or stored_state == ActionState.skiped:
+            return False
+        elif stored_state == ActionState.success:
+            return True
 
         return action.is_required()
 
 
 class FinishActionsFlow(ReverseActionFlow):
+    ACTIONS_PHASE = "post"
+
     def _invoke_action(self, action: ActiveAction) -> None:
         super()._invoke_action(action)
         action.invoke_post()
 
     def _get_action_estimate(self, action: ActiveAction) -> int:
-        if not self._is_action_required(action):
+        if not self._get_action_requirement(action):
             return 0
-        return action.estimate_post_time()
+        return self._get_learned_estimate(action, action.estimate_post_time)
 
 
 class RevertActionsFlow(ReverseActionFlow):
+    ACTIONS_PHASE = "revert"
+
     def _invoke_action(self, action: ActiveAction) -> None:
         super()._invoke_action(action)
         action.invoke_revert()
 
     def _get_action_estimate(self, action: ActiveAction) -> int:
-        if not self._is_action_required(action):
+        if not self._get_action_requirement(action):
             return 0
-        return action.estimate_revert_time()
+        return self._get_learned_estimate(action, action.estimate_revert_time)
 
 
 class CheckAction(Action):
+    # Cached results of the check are not used when the version is changed,
+    # so increase it when the check logic is changed
+    cache_version: str = "1"
+
     def do_check(self) -> bool:
         return self._do_check()
 
     def _do_check(self) -> bool:
         raise NotImplementedError("Not implemented check call")
 
+    def get_inputs(self) -> typing.Optional[checks_cache.CheckInputs]:
+        return self._get_inputs()
+
+    def _get_inputs(self) -> typing.Optional[checks_cache.CheckInputs]:
+        # Result of the check is not cached unless it declares what it depends on
+        return None
+
 
 class CheckFlow(ActionsFlow):
+    # Checks running longer than this are reported as slow ones
+    SLOW_CHECK_THRESHOLD = 5
+
+    def __init__(self, stages: typing.List[CheckAction], max_workers: int = 1, check_timeout: float = None,
+                 results_cache: checks_cache.ChecksCache = None):
+        super().__init__(stages)
+        # Results of checks with declared inputs are taken from the cache until the inputs are changed
+        self.results_cache = results_cache
+        # Checks are executed concurrently when more than one worker is allowed or timeout is set.
+        # Timeout is counted from the start of the particular check
+        self.max_workers = max_workers
+        self.check_timeout = check_timeout
+        self.checks_timings = []
+        self.timed_out_checks = set()
 
     def validate_actions(self):
         # Note. This one is for development porpuses only
@@ -283,18 +619,118 @@ class CheckFlow(ActionsFlow):
                 raise TypeError("Non an CheckAction passed into check flow. Name of the action is {name!s}".format(check.name))
 
     def make_checks(self) -> typing.List[str]:
-        failed_checks_msgs = []
         log.debug("Start checks")
-        for check in self.stages:
-            log.debug("Make check {name}".format(name=check.name))
-            if not check.do_check():
+        self.checks_timings = [(check.name, 0.0) for check in self.stages]
+        self.timed_out_checks = set()
+        if self.max_workers > 1 or self.check_timeout is not None:
+            results = self._make_checks_concurrently()
+        else:
+            results = [self._make_check(index, check) for index, check in enumerate(self.stages)]
+
+        failed_checks_msgs = []
+        for index, (check, result) in enumerate(zip(self.stages, results)):
+            if index in self.timed_out_checks:
+                failed_checks_msgs.append(f"Required pre-conversion condition {check.name!s} was not checked in {self.check_timeout} seconds:\n\t{check.description!s}\n")
+            elif not result:
                 failed_checks_msgs.append(f"Required pre-conversion condition {check.name!s} not met:\n\t{check.description!s}\n")
 
+        self._report_slow_checks()
+        if self.results_cache is not None:
+            self.results_cache.save()
         return failed_checks_msgs
 
+    def _make_check(self, index: int, check: CheckAction) -> bool:
+        start_time = time.monotonic()
+        try:
+            return self._run_check(check)
+        finally:
+            self.checks_timings[index] = (check.name, time.monotonic() - start_time)
+
+    def _run_check(self, check: CheckAction) -> bool:
+        log.debug("Make check {name}".format(name=check.name))
+        inputs = check.get_inputs() if self.results_cache is not None else None
+        if inputs is None:
+            return check.do_check()
+
+        cache_key = "{classname}:{name}:{version}".format(classname=check.__class__.__name__, name=check.name,
+                                                          version=check.cache_version)
+        fingerprint = inputs.fingerprint()
+        result = self.results_cache.get(cache_key, fingerprint)
+        if result is not None:
+            log.debug("Result of check {name} is taken from the cache".format(name=check.name))
+            return result
+
+        result = check.do_check()
+        self.results_cache.store(cache_key, fingerprint, result)
+        return result
+
+    def _run_check_in_thread(self, index: int, check: CheckAction, finished: queue.Queue) -> None:
+        # The thread of a timed out check is left running, so it touches no state of the flow.
+        # Duration is passed with the result and saved by the coordinator.
+        start_time = time.monotonic()
+        try:
+            result = self._run_check(check)
+        except Exception as ex:
+            finished.put((index, None, ex, time.monotonic() - start_time))
+            return
+        finished.put((index, result, None, time.monotonic() - start_time))
+
+    def _make_checks_concurrently(self) -> typing.List[typing.Optional[bool]]:
+        # We use own daemon threads instead of an executor, because there is no way to stop
+        # a timed out check. So we just forget about it and give the slot to the next check.
+        results = [None] * len(self.stages)
+        waiting = list(enumerate(self.stages))
+        waiting.reverse()
+        running = {}
+        finished = queue.Queue()
+
+        while waiting or running:
+            while waiting and len(running) < self.max_workers:
+                index, check = waiting.pop()
+                running[index] = time.monotonic()
+                threading.Thread(target=self._run_check_in_thread, args=(index, check, finished), daemon=True).start()
+
+            timeout = None
+            if self.check_timeout is not None:
+                timeout = max(min(running.values()) + self.check_timeout - time.monotonic(), 0)
+
+            try:
+                index, result, error, duration = finished.get(timeout=timeout)
+            except queue.Empty:
+                now = time.monotonic()
+                for index, start_time in list(running.items()):
+                    if now - start_time >= self.check_timeout:
+                        log.warn("Check {name} is timed out".format(name=self.stages[index].name))
+                        self.checks_timings[index] = (self.stages[index].name, now - start_time)
+                        self.timed_out_checks.add(index)
+                        del running[index]
+                continue
+
+            if index not in running:
+                # Result of a check that was reported as timed out already
+                continue
+
+            del running[index]
+            self.checks_timings[index] = (self.stages[index].name, duration)
+            if error is not None:
+                raise error
+            results[index] = result
+
+        return results
+
+    def _report_slow_checks(self) -> None:
+        slow_checks = sorted((timing for timing in self.checks_timings if timing[1] >= self.SLOW_CHECK_THRESHOLD),
+                             key=lambda timing: timing[1], reverse=True)
+        for name, seconds in slow_checks:
+            log.warn("Slow pre-conversion check {name} took {seconds:.1f} seconds".format(name=name, seconds=seconds))
+
+    def get_checks_timings(self) -> typing.List[typing.Tuple[str, float]]:
+        return self.checks_timings
+
 
 class FlowProgressbar():
-    def __init__(self, flow: ActionsFlow, writers: typing.List[writers.Writer] = None, exceed_msg: str = None):
+    def __init__(self, flow: ActionsFlow, writers: typing.List[writers.Writer] = None, exceed_msg: str = None,
+                 event_driven: bool = False):
         self.flow = flow
         self.total_time = flow.get_total_time()
         self.exceed_msg = exceed_msg
@@ -303,6 +739,60 @@ class FlowProgressbar():
             writers = [writers.StdoutWriter]
         self.writers = writers
 
+        # In event driven mode the progressbar is redrawn only when the flow notifies about changes
+        # or shown time is changed. Flows which do not notify about changes are polled.
+        # Terminal size is cached and refreshed on SIGWINCH. Signal handlers could be set from
+        # the main thread only, so the handler is installed on creation and display() could be
+        # called from a helper thread. Call close() from the main thread to restore the previous handler.
+        self.event_driven = event_driven and hasattr(flow, "wait_state_change")
+        self._terminal_size = None
+        self._sigwinch_handler_installed = False
+        self._previous_sigwinch_handler = None
+        if self.event_driven:
+            self._install_sigwinch_handler()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *kwargs):
+        self.close()
+
+    def close(self) -> None:
+        if self._sigwinch_handler_installed and threading.current_thread() is threading.main_thread():
+            self._restore_sigwinch_handler()
+
+    def _install_sigwinch_handler(self) -> bool:
+        # Otherwise terminal size is asked on every redraw
+        if self._sigwinch_handler_installed or threading.current_thread() is not threading.main_thread():
+            return False
+
+        self._terminal_size = None
+        self._previous_sigwinch_handler = signal.signal(signal.SIGWINCH, self._on_terminal_resize)
+        self._sigwinch_handler_installed = True
+        return True
+
+    def _restore_sigwinch_handler(self) -> None:
+        # None means the previous handler was not installed from python
+        previous = self._previous_sigwinch_handler
+        signal.signal(signal.SIGWINCH, previous if previous is not None else signal.SIG_DFL)
+        self._sigwinch_handler_installed = False
+        self._previous_sigwinch_handler = None
+        self._terminal_size = None
+
+    def _on_terminal_resize(self, signum, frame) -> None:
+        self._terminal_size = None
+        if callable(self._previous_sigwinch_handler):
+            self._previous_sigwinch_handler(signum, frame)
+
+    def _get_terminal_size(self) -> int:
+        if self._terminal_size is not None:
+            return self._terminal_size
+
+        terminal_size, _ = shutil.get_terminal_size()
+        if self._sigwinch_handler_installed:
+            self._terminal_size = terminal_size
+        return terminal_size
+
     def _seconds_to_minutes(self, seconds: str) -> str:
         minutes = int(seconds / 60)
         seconds = int(seconds % 60)
@@ -317,39 +807,80 @@ class FlowProgressbar():
         for writer in self.writers:
             writer.write(msg)
 
+    def _render(self, passed_time: float, terminal_size: int) -> str:
+        percent = int((passed_time) / self.total_time * 100)
+
+        description = self.get_action_description()
+
+        progress = "=" * int(percent / 2) + ">" + " " * (50 - int(percent / 2))
+        progress = "[" + progress[:25] + description + progress[25:] + "]"
+
+        output = ""
+        if terminal_size > 118:
+            output = progress + " " + self._seconds_to_minutes(passed_time) + " / " + self._seconds_to_minutes(self.total_time)
+        elif terminal_size > 65 and terminal_size < 118:
+            output = description + " " + self._seconds_to_minutes(passed_time) + " / " + self._seconds_to_minutes(self.total_time)
+        else:
+            output = self._seconds_to_minutes(passed_time) + " / " + self._seconds_to_minutes(self.total_time)
+
+        clean = " " * (terminal_size - len(output))
+
+        if percent < 80:
+            color = "\033[92m"  # green
+        else:
+            color = "\033[93m"  # yellow
+        drop_color = "\033[0m"
+
+        return f"\r{color}{output}{clean}{drop_color}"
+
     def display(self) -> None:
+        if self.event_driven:
+            # The handler is installed here if it was closed already, so it is restored here as well
+            handler_installed = self._install_sigwinch_handler()
+            try:
+                passed_time = self._display_on_events()
+            finally:
+                if handler_installed:
+                    self._restore_sigwinch_handler()
+        else:
+            passed_time = self._display_by_polling()
+
+        if passed_time > self.total_time:
+            self.write("\r\033[91m[" + "X" * 25 + self.get_action_description() + "X" * 25 + "] exceed\033[0m")
+            self.write(self.exceed_msg)
+            if isinstance(self.flow, ActiveFlow):
+                for heartbeat in self.flow.get_running_commands():
+                    self.write("Command '{cmd}' is running for {running}, last output was {silence} ago\n".format(
+                        cmd=heartbeat.cmd, running=self._seconds_to_minutes(heartbeat.get_running_time()),
+                        silence=self._seconds_to_minutes(heartbeat.get_silence_time())))
+
+    def _display_by_polling(self) -> float:
         start_time = time.time()
         passed_time = 0
 
         while passed_time < self.total_time and not self.flow.is_finished():
-            percent = int((passed_time) / self.total_time * 100)
+            terminal_size, _ = shutil.get_terminal_size()
+            self.write(self._render(passed_time, terminal_size))
+            time.sleep(1)
+            passed_time = time.time() - start_time
 
-            description = self.get_action_description()
+        return passed_time
 
-            progress = "=" * int(percent / 2) + ">" + " " * (50 - int(percent / 2))
-            progress = "[" + progress[:25] + description + progress[25:] + "]"
+    def _display_on_events(self) -> float:
+        start_time = time.time()
+        passed_time = 0
+        seen_version = None
+        shown = None
 
-            terminal_size, _ = shutil.get_terminal_size()
-            output = ""
-            if terminal_size > 118:
-                output = progress + " " + self._seconds_to_minutes(passed_time) + " / " + self._seconds_to_minutes(self.total_time)
-            elif terminal_size > 65 and terminal_size < 118:
-                output = description + " " + self._seconds_to_minutes(passed_time) + " / " + self._seconds_to_minutes(self.total_time)
-            else:
-                output = self._seconds_to_minutes(passed_time) + " / " + self._seconds_to_minutes(self.total_time)
-
-            clean = " " * (terminal_size - len(output))
-
-            if percent < 80:
-                color = "\033[92m"  # green
-            else:
-                color = "\033[93m"  # yellow
-            drop_color = "\033[0m"
-
-            self.write(f"\r{color}{output}{clean}{drop_color}")
-            time.sleep(1)
+        while passed_time < self.total_time and not self.flow.is_finished():
+            output = self._render(passed_time, self._get_terminal_size())
+            if output != shown:
+                self.write(output)
+                shown = output
+
+            # Shown time is changed only once a second, so there is no reason to wake up earlier
+            # if nothing happened in the flow
+            seen_version = self.flow.wait_state_change(seen_version, 1 - passed_time % 1)
             passed_time = time.time() - start_time
 
-        if passed_time > self.total_time:
-            self.write("\r\033[91m[" + "X" * 25 + self.get_action_description() + "X" * 25 + "] exceed\033[0m")
-            self.write(self.exceed_msg)
+        return passed_time
@@ -0,0 +1,186 @@
+# Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import asyncio
+import collections
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+import typing
+
+from . import log
+
+
+class CassetteError(Exception):
+    def __init__(self, cmd: typing.Union[str, typing.List[str]], reason: str):
+        self.cmd = cmd
+        self.reason = reason
+        super().__init__(f"Unable to replay command '{cmd}': {reason}")
+
+
+def _to_text(value: typing.Union[str, bytes, None]) -> typing.Optional[str]:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="surrogateescape")
+    return value
+
+
+def _from_text(value: typing.Optional[str], as_text: bool) -> typing.Union[str, bytes, None]:
+    if value is None or as_text:
+        return value
+    return value.encode("utf-8", errors="surrogateescape")
+
+
+class Cassette():
+    """Recorded interactions with child processes.
+
+    Every interaction keeps the command, its stdin, output and exit code and how long it took.
+    Commands streamed by util.logged_check_call keep output lines with their time offsets instead
+    of the whole output. On replay interactions of the same command and stdin are returned
+    in the recorded order, so concurrently running actions do not confuse each other.
+    Recorded time is multiplied by time_scale, so 0 replays without any waiting.
+    """
+
+    def __init__(self, path: str, replaying: bool = False, time_scale: float = 1.0):
+        self.path = path
+        self.replaying = replaying
+        self.time_scale = time_scale
+        self.interactions = []
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> "Cassette":
+        with open(self.path, "r") as cassette_file:
+            self.interactions = json.load(cassette_file)["interactions"]
+
+        self._queues = {}
+        for interaction in self.interactions:
+            key = self._get_key(interaction["cmd"], interaction["input"])
+            self._queues.setdefault(key, collections.deque()).append(interaction)
+        return self
+
+    def save(self) -> None:
+        log.debug("Going to write {count} recorded commands into cassette '{path}'".format(count=len(self.interactions), path=self.path))
+        with open(self.path + ".next", "w") as dst:
+            json.dump({"interactions": self.interactions}, dst, indent=1)
+        os.replace(self.path + ".next", self.path)
+
+    @staticmethod
+    def _get_key(cmd: typing.Union[str, typing.List[str]], input: typing.Optional[str]) -> str:
+        return json.dumps([cmd, input])
+
+    def record(self, cmd: typing.Union[str, typing.List[str]], input: typing.Union[str, bytes, None],
+               stdout: typing.Union[str, bytes, None], stderr: typing.Union[str, bytes, None], returncode: int,
+               duration: float, lines: typing.List[typing.Tuple[float, str]] = None) -> None:
+        interaction = {
+            "cmd": cmd,
+            "input": _to_text(input),
+            "stdout": _to_text(stdout),
+            "stderr": _to_text(stderr),
+            "lines": lines,
+            "returncode": returncode,
+            "duration": round(duration, 6),
+        }
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def take(self, cmd: typing.Union[str, typing.List[str]], input: typing.Union[str, bytes, None] = None) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            queue = self._queues.get(self._get_key(cmd, _to_text(input)))
+            if not queue:
+                raise CassetteError(cmd, "there is no recorded interaction left")
+            return queue.popleft()
+
+    def replay_run(self, cmd: typing.Union[str, typing.List[str]], input: typing.Union[str, bytes, None], check: bool,
+                   kwargs: typing.Dict[str, typing.Any]) -> subprocess.CompletedProcess:
+        interaction = self.take(cmd, input)
+        time.sleep(interaction["duration"] * self.time_scale)
+
+        as_text = any(kwargs.get(key) for key in ("universal_newlines", "text", "encoding", "errors"))
+        stdout = _from_text(interaction["stdout"], as_text)
+        stderr = _from_text(interaction["stderr"], as_text)
+        if check and interaction["returncode"]:
+            raise subprocess.CalledProcessError(interaction["returncode"], cmd, output=stdout, stderr=stderr)
+        return subprocess.CompletedProcess(cmd, interaction["returncode"], stdout, stderr)
+
+    def replay_process(self, cmd: typing.Union[str, typing.List[str]]) -> "ReplayedProcess":
+        return ReplayedProcess(cmd, self.take(cmd), self.time_scale)
+
+
+class ReplayedReader():
+    """Stand-in of asyncio.StreamReader which returns recorded lines at their time."""
+
+    def __init__(self, process: "ReplayedProcess", lines: typing.List[typing.Tuple[float, str]]):
+        self.process = process
+        self.lines = collections.deque(lines)
+
+    async def readline(self) -> bytes:
+        if not self.lines:
+            return b""
+
+        offset, line = self.lines[0]
+        delay = offset * self.process.time_scale - (time.monotonic() - self.process.started_at)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.lines.popleft()
+        return line.encode("utf-8", errors="surrogateescape") + b"\n"
+
+
+class ReplayedProcess():
+    """Stand-in of a streamed child process, finishes after the recorded (scaled) duration."""
+
+    def __init__(self, cmd: typing.Union[str, typing.List[str]], interaction: typing.Dict[str, typing.Any], time_scale: float):
+        self.args = cmd
+        self.pid = 0
+        self.usage = None
+        self.returncode = None
+        self.time_scale = time_scale
+        self.started_at = time.monotonic()
+        self.stdout = ReplayedReader(self, interaction["lines"] or [])
+        self._interaction = interaction
+        self._stopped = threading.Event()
+        self._stop_returncode = None
+
+    def wait(self) -> int:
+        remaining = self._interaction["duration"] * self.time_scale - (time.monotonic() - self.started_at)
+        if remaining > 0 and self._stopped.wait(remaining):
+            self.returncode = self._stop_returncode
+        else:
+            self.returncode = self._interaction["returncode"]
+        return self.returncode
+
+    def send_signal(self, sig: int) -> None:
+        self._stop_returncode = -sig
+        self._stopped.set()
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+
+_active_cassette = None
+
+
+def get_active_cassette() -> typing.Optional[Cassette]:
+    return _active_cassette
+
+
+def start_recording(path: str) -> None:
+    """Record every command started through util.logged_check_call and accounting helpers."""
+    global _active_cassette
+    _active_cassette = Cassette(path)
+
+
+def start_replaying(path: str, time_scale: float = 1.0) -> None:
+    """Replace commands with interactions recorded in the cassette. Nothing is executed on the system."""
+    global _active_cassette
+    _active_cassette = Cassette(path, replaying=True, time_scale=time_scale).load()
+
+
+def stop_cassette() -> None:
+    global _active_cassette
+    if _active_cassette is not None and not _active_cassette.replaying:
+        _active_cassette.save()
+    _active_cassette = None
@@ -0,0 +1,90 @@
+# Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import hashlib
+import json
+import os
+import threading
+import typing
+
+from . import files, log, packages, systemd
+
+
+class CheckInputs():
+    """Parts of the system a check result depends on."""
+
+    def __init__(self, files: typing.List[str] = None, packages: typing.List[str] = None,
+                 services: typing.List[str] = None, values: typing.Dict[str, str] = None):
+        self.files = files if files is not None else []
+        self.packages = packages if packages is not None else []
+        self.services = services if services is not None else []
+        # Anything else that is cheap to get, e.g. a configuration value
+        self.values = values if values is not None else {}
+
+    def fingerprint(self) -> str:
+        state = {
+            "files": [self._file_state(path) for path in self.files],
+            "packages": [packages.is_package_installed(pkg) for pkg in self.packages],
+            "services": [(systemd.is_service_exists(service), systemd.is_service_active(service)) for service in self.services],
+            "values": self.values,
+        }
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _file_state(path: str) -> typing.Optional[typing.List[int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+
+class ChecksCache():
+    """Persistent results of checks keyed by the fingerprint of the check inputs.
+
+    Results stored by another version of the utility are dropped on load,
+    because implementation of the checks could be changed since then.
+    """
+
+    def __init__(self, path: str, version: str = None):
+        self.path = path
+        self.version = version
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> "ChecksCache":
+        self.results = {}
+        if not os.path.exists(self.path):
+            return self
+
+        try:
+            with open(self.path, "r") as cache_file:
+                cache_data = json.load(cache_file)
+        except ValueError as ex:
+            log.warn("Unable to load checks cache from {path}: {error}".format(path=self.path, error=ex))
+            return self
+
+        if not isinstance(cache_data, dict) or "results" not in cache_data or cache_data.get("version") != self.version:
+            log.debug("Checks cache {path} is stored by another version of the utility, drop it".format(path=self.path))
+            return self
+
+        self.results = cache_data["results"]
+        return self
+
+    def save(self) -> None:
+        with self._lock:
+            files.rewrite_json_file(self.path, {"version": self.version, "results": self.results})
+
+    def get(self, name: str, fingerprint: str) -> typing.Optional[bool]:
+        cached = self.results.get(name)
+        if cached is None or cached["fingerprint"] != fingerprint:
+            return None
+        return cached["result"]
+
+    def store(self, name: str, fingerprint: str, result: bool) -> None:
+        with self._lock:
+            self.results[name] = {"fingerprint": fingerprint, "result": result}
+
+    def clear(self) -> None:
+        with self._lock:
+            self.results = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,19 +1,157 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
 import os
 import subprocess
+import threading
 import typing
 
-from . import files, util
+from . import accounting, files, query_cache, util
 
 APT_CHOOSE_OLD_FILES_OPTIONS = ['-o', 'Dpkg::Options::=--force-confdef',
                                 '-o', 'Dpkg::Options::=--force-confold']
 
 
+DPKG_STATUS_FILE_PATH = "/var/lib/dpkg/status"
+# Values of the last word of the Status field which mean package files are not on the disk
+DPKG_NOT_INSTALLED_STATES = ("not-installed", "config-files")
+
+
+class DpkgPackage():
+    """Package record of dpkg status file."""
+
+    __slots__ = ("name", "status", "version", "arch")
+
+    def __init__(self, name: str, status: str, version: typing.Optional[str], arch: typing.Optional[str]):
+        self.name = name
+        self.status = status
+        self.version = version
+        self.arch = arch
+
+    @property
+    def state(self) -> str:
+        # Status field is "want flag state", e.g. "install ok installed"
+        return self.status.split()[-1] if self.status else "not-installed"
+
+    def is_installed(self) -> bool:
+        return self.state not in DPKG_NOT_INSTALLED_STATES
+
+    def __repr__(self) -> str:
+        return f"{self.name}:{self.arch} {self.version} ({self.status})"
+
+
+class DpkgStatusIndex():
+    """Packages from dpkg status file indexed by name.
+
+    The file is read line by line and only fields we need are kept, so even
+    a huge status file does not take much memory. Packages in "config-files"
+    state (removed, but not purged) are not considered as installed.
+    """
+
+    def __init__(self, packages: typing.Iterable[DpkgPackage]):
+        self.by_name = {}
+        for package in packages:
+            self.by_name.setdefault(package.name, []).append(package)
+
+    @staticmethod
+    def parse(lines: typing.Iterable[str]) -> typing.Iterator[DpkgPackage]:
+        fields = {}
+        for line in lines:
+            if not line.strip():
+                if "Package" in fields:
+                    yield DpkgPackage(fields["Package"], fields.get("Status", ""), fields.get("Version"), fields.get("Architecture"))
+                fields = {}
+                continue
+
+            # Continuation lines of multiline fields like Description or Conffiles start with a space
+            if line[0] in " \t":
+                continue
+
+            field, _, value = line.partition(":")
+            if field in ("Package", "Status", "Version", "Architecture"):
+                fields[field] = value.strip()
+
+        if "Package" in fields:
+            yield DpkgPackage(fields["Package"], fields.get("Status", ""), fields.get("Version"), fields.get("Architecture"))
+
+    @classmethod
+    def load(cls, path: str = DPKG_STATUS_FILE_PATH) -> "DpkgStatusIndex":
+        with open(path, "r", encoding="utf-8", errors="replace") as status_file:
+            return cls(cls.parse(status_file))
+
+    def find(self, pkg: str) -> typing.List[DpkgPackage]:
+        # Just like dpkg, "name:arch" is accepted to look for the particular architecture
+        name, _, arch = pkg.partition(":")
+        packages = self.by_name.get(name, [])
+        return [package for package in packages if package.is_installed() and (not arch or package.arch in (arch, "all"))]
+
+    def is_installed(self, pkg: str) -> bool:
+        return len(self.find(pkg)) > 0
+
+    def get_versions(self, name: str) -> typing.List[str]:
+        return [package.version for package in self.find(name)]
+
+    def get_arches(self, name: str) -> typing.List[str]:
+        return [package.arch for package in self.find(name)]
+
+    def __iter__(self) -> typing.Iterator[DpkgPackage]:
+        # Only installed packages, records of removed ones are skipped
+        for packages in self.by_name.values():
+            yield from (package for package in packages if package.is_installed())
+
+    def __len__(self) -> int:
+        return sum(len(packages) for packages in self.by_name.values())
+
+
+class _StatusIndexCache():
+    # dpkg rewrites the status file on every change, so its stat is enough to notice changes
+    def __init__(self, path: str):
+        self.path = path
+        self._index = None
+        self._file_state = None
+        self._lock = threading.Lock()
+
+    def get(self) -> DpkgStatusIndex:
+        with self._lock:
+            stat = os.stat(self.path)
+            file_state = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if self._index is None or file_state != self._file_state:
+                self._index = DpkgStatusIndex.load(self.path)
+                self._file_state = file_state
+            return self._index
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._index = None
+
+
+_status_index = _StatusIndexCache(DPKG_STATUS_FILE_PATH)
+
+
+def get_installed_packages_index() -> DpkgStatusIndex:
+    return _status_index.get()
+
+
+def invalidate_installed_packages_index() -> None:
+    _status_index.invalidate()
+
+
+def filter_installed_packages(lookup_pkgs: typing.List[str]) -> typing.List[str]:
+    index = get_installed_packages_index()
+    return [pkg for pkg in lookup_pkgs if index.is_installed(pkg)]
+
+
 def is_package_installed(pkg: str) -> bool:
-    res = subprocess.run(["/usr/bin/dpkg", "-s", pkg], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return res.returncode == 0
+    return get_installed_packages_index().is_installed(pkg)
+
+
+def get_installed_package_versions(name: str) -> typing.List[str]:
+    return get_installed_packages_index().get_versions(name)
+
 
+def get_installed_package_arches(name: str) -> typing.List[str]:
+    return get_installed_packages_index().get_arches(name)
 
+
+@query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)
 def install_packages(pkgs: typing.List[str], repository: str = None, force_package_config: bool = False) -> None:
     if len(pkgs) == 0:
         return
@@ -27,6 +165,7 @@ def install_packages(pkgs: typing.List[str], repository: str = None, force_packa
     util.logged_check_call(cmd, env={"PATH": os.environ["PATH"], "DEBIAN_FRONTEND": "noninteractive"})
 
 
+@query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)
 def remove_packages(pkgs: typing.List[str]) -> None:
     if len(pkgs) == 0:
         return
@@ -35,6 +174,22 @@ def remove_packages(pkgs: typing.List[str]) -> None:
     util.logged_check_call(cmd)
 
 
+@query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)
+def apply_packages_transaction(install: typing.List[str], remove: typing.List[str],
+                               upgrade: typing.Optional[typing.List[str]] = None, force_package_config: bool = False) -> None:
+    if install or remove:
+        # apt-get removes packages marked with "-" suffix in the same run
+        cmd = ['/usr/bin/apt-get', 'install', '-y']
+        if force_package_config is True:
+            cmd += APT_CHOOSE_OLD_FILES_OPTIONS
+        cmd += install + [pkg + "-" for pkg in remove]
+
+        util.logged_check_call(cmd, env={"PATH": os.environ["PATH"], "DEBIAN_FRONTEND": "noninteractive"})
+
+    if upgrade is not None:
+        upgrade_packages(upgrade)
+
+
 def find_related_repofiles(repository_file: str) -> typing.List[str]:
     return files.find_files_case_insensitive("/etc/apt/sources.list.d", repository_file)
 
@@ -43,6 +198,7 @@ def update_package_list() -> None:
     util.logged_check_call(["/usr/bin/apt-get", "update", "-y"])
 
 
+@query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)
 def upgrade_packages(pkgs: typing.List[str] = None) -> None:
     if pkgs is None:
         pkgs = []
@@ -51,26 +207,29 @@ def upgrade_packages(pkgs: typing.List[str] = None) -> None:
     util.logged_check_call(cmd, env={"PATH": os.environ["PATH"], "DEBIAN_FRONTEND": "noninteractive"})
 
 
+@query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)
 def autoremove_outdated_packages() -> None:
     util.logged_check_call(["/usr/bin/apt-get", "autoremove", "-y"],
                            env={"PATH": os.environ["PATH"], "DEBIAN_FRONTEND": "noninteractive"})
 
 
 def depconfig_parameter_set(parameter: str, value: str) -> None:
-    subprocess.run(["/usr/bin/debconf-communicate"], input=f"SET {parameter} {value}\n",
+    accounting.run(["/usr/bin/debconf-communicate"], input=f"SET {parameter} {value}\n",
                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, universal_newlines=True)
 
 
 def depconfig_parameter_get(parameter: str) -> None:
-    process = subprocess.run(["/usr/bin/debconf-communicate"], input=f"GET {parameter}\n",
+    process = accounting.run(["/usr/bin/debconf-communicate"], input=f"GET {parameter}\n",
                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True, universal_newlines=True)
     return process.stdout.split(" ")[1].strip()
 
 
+@query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)
 def restore_installation() -> None:
     util.logged_check_call(["/usr/bin/apt-get", "-f", "install", "-y"])
 
 
+@query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)
 def do_distupgrade() -> None:
     util.logged_check_call(["apt-get", "dist-upgrade", "-y"] + APT_CHOOSE_OLD_FILES_OPTIONS,
                            env={"PATH": os.environ["PATH"], "DEBIAN_FRONTEND": "noninteractive"})
\ No newline at end of file
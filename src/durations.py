@@ -0,0 +1,60 @@
+# Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import json
+import math
+import os
+import threading
+import typing
+
+from . import files, log
+
+
+class ActionsDurations():
+    """Measured wall time of actions, stored by phase (prepare/post/revert) and action name.
+
+    Only the last MAX_SAMPLES measurements of every action are kept, so the estimate
+    follows changes of the action itself. Estimation uses a percentile of the samples
+    instead of average to ignore single extremely long or short runs.
+    The history is loaded on creation, so saving never drops samples of previous runs.
+    """
+
+    MAX_SAMPLES = 20
+
+    def __init__(self, path: str, percentile: int = 50):
+        self.path = path
+        self.percentile = percentile
+        self.samples = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self) -> "ActionsDurations":
+        self.samples = {}
+        if not os.path.exists(self.path):
+            return self
+
+        try:
+            with open(self.path, "r") as durations_file:
+                self.samples = json.load(durations_file)
+        except ValueError as ex:
+            log.warn("Unable to load actions durations from {path}: {error}".format(path=self.path, error=ex))
+
+        return self
+
+    def save(self) -> None:
+        with self._lock:
+            files.rewrite_json_file(self.path, self.samples)
+
+    def record(self, phase: str, name: str, seconds: float) -> None:
+        with self._lock:
+            action_samples = self.samples.setdefault(phase, {}).setdefault(name, [])
+            action_samples.append(round(seconds, 3))
+            del action_samples[:-self.MAX_SAMPLES]
+
+    def estimate(self, phase: str, name: str) -> typing.Optional[int]:
+        action_samples = self.samples.get(phase, {}).get(name)
+        if not action_samples:
+            return None
+
+        ordered = sorted(action_samples)
+        # Nearest-rank percentile
+        rank = max(math.ceil(self.percentile / 100 * len(ordered)), 1)
+        return max(math.ceil(ordered[rank - 1]), 1)
@@ -5,7 +5,7 @@ import subprocess
 import typing
 import zipfile
 
-from . import dist
+from . import dist, util
 
 
 class Feedback():
@@ -58,3 +58,16 @@ class Feedback():
         for file in self.created_files:
             if os.path.exists(file):
                 os.unlink(file)
+
+
+FAILED_COMMAND_OUTPUT_FILE_PATH = "failed_command_output.txt"
+
+
+def collect_failed_command_output() -> str:
+    # Could be used as one of collect_actions of Feedback. Takes the output from memory,
+    # so there is no need to look through the whole log file
+    output = util.get_last_failed_command_output()
+    if output:
+        with open(FAILED_COMMAND_OUTPUT_FILE_PATH, "w") as output_file:
+            output_file.write("\n".join(output) + "\n")
+    return FAILED_COMMAND_OUTPUT_FILE_PATH
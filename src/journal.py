@@ -0,0 +1,178 @@
+# Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import json
+import os
+import typing
+
+from . import log
+
+
+class ActionsJournal():
+    """Append-only storage of actions states.
+
+    Every state change is appended to the file as a separate json line and synced
+    to the disk right away, so the progress survives even a killed process.
+    On close the journal is compacted to one record per action.
+    The legacy format, single json document with "actions" list, is supported on load.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.states = {}
+        self._journal = None
+        # Set when the file has legacy document or broken records, so records could not be just appended
+        self._needs_compaction = False
+
+    def load(self) -> "ActionsJournal":
+        self.states = {}
+        self._needs_compaction = False
+        if not os.path.exists(self.path):
+            return self
+
+        with open(self.path, "r") as journal:
+            for line_number, raw_line in enumerate(journal):
+                if not raw_line.endswith("\n"):
+                    # The last record is not finished, the next one should not be glued to it
+                    self._needs_compaction = True
+
+                line = raw_line.strip()
+                if not line:
+                    continue
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self._needs_compaction = True
+                    if line_number == 0 and self._load_legacy_document(journal):
+                        return self
+                    # Most likely the process was killed in the middle of a write
+                    log.warn("Skip broken record in actions journal {path}: {line}".format(path=self.path, line=line))
+                    continue
+
+                if "actions" in record:
+                    self._needs_compaction = True
+                    self._load_legacy_records(record)
+                else:
+                    self.states[record["name"]] = record["state"]
+
+        return self
+
+    def _load_legacy_document(self, journal: typing.TextIO) -> bool:
+        # Looks like multiline legacy json document, but only a complete one is accepted.
+        # Otherwise reading goes on from the second line.
+        journal.seek(0)
+        try:
+            self._load_legacy_records(json.load(journal))
+            return True
+        except ValueError:
+            journal.seek(0)
+            journal.readline()
+            return False
+
+    def _load_legacy_records(self, actions_data: typing.Dict[str, typing.Any]) -> None:
+        for action in actions_data["actions"]:
+            self.states[action["name"]] = action["state"]
+
+    def open(self) -> None:
+        if self._journal is not None:
+            return
+
+        if self._needs_compaction:
+            # Rewrite the file in the journal format, so appended records are not mixed with legacy or broken ones
+            self.compact()
+            self._needs_compaction = False
+
+        self._journal = open(self.path, "a")
+
+    def record(self, name: str, state: str) -> None:
+        self.states[name] = state
+        if self._journal is None:
+            return
+
+        self._journal.write(self._format_record(name, state))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def get_state(self, name: str) -> typing.Optional[str]:
+        return self.states.get(name)
+
+    def compact(self) -> None:
+        log.debug("Going to compact actions journal '{path}'".format(path=self.path))
+
+        with open(self.path + ".next", "w") as dst:
+            for name, state in self.states.items():
+                dst.write(self._format_record(name, state))
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        reopen = self._journal is not None
+        if reopen:
+            self._journal.close()
+            self._journal = None
+
+        os.replace(self.path + ".next", self.path)
+
+        if reopen:
+            self.open()
+
+    def close(self) -> None:
+        self.compact()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def remove(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def _format_record(name: str, state: str) -> str:
+        return json.dumps({"name": name, "state": state}, separators=(",", ":")) + "\n"
+
+
+class ActionsStateStore():
+    """Index of persisted actions states shared by prepare, finish and revert flows.
+
+    States are loaded into a name to state dict once, so every lookup is O(1).
+    Changes are written through the journal right away.
+    """
+
+    def __init__(self, path: str):
+        self.journal = ActionsJournal(path)
+
+    def load(self) -> "ActionsStateStore":
+        self.journal.load()
+        return self
+
+    def open(self) -> None:
+        self.journal.open()
+
+    def close(self) -> None:
+        self.journal.close()
+
+    def remove(self) -> None:
+        self.journal.remove()
+
+    def get_state(self, name: str) -> typing.Optional[str]:
+        return self.journal.get_state(name)
+
+    def set_state(self, name: str, state: str) -> None:
+        self.journal.record(name, state)
+
+    def get_states(self, names: typing.Iterable[str]) -> typing.Dict[str, typing.Optional[str]]:
+        return {name: self.journal.states.get(name) for name in names}
+
+    def get_names_with_state(self, *states: str) -> typing.List[str]:
+        return [name for name, state in self.journal.states.items() if state in states]
+
+    def items(self) -> typing.Iterable[typing.Tuple[str, str]]:
+        return self.journal.states.items()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.journal.states
+
+    def __len__(self) -> int:
+        return len(self.journal.states)
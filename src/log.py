@@ -37,6 +37,12 @@ class logger():
         for handler in stream_handlers:
             logger.streams_logger.addHandler(handler)
 
+    @staticmethod
+    def is_debug_enabled() -> bool:
+        if logger.files_logger.isEnabledFor(logging.DEBUG):
+            return True
+        return logger.is_streams_enabled and logger.streams_logger.isEnabledFor(logging.DEBUG)
+
     @staticmethod
     def debug(msg: str, to_file: bool = True, to_stream: bool = True) -> None:
         if to_file:
@@ -75,6 +81,11 @@ def init_logger(logfiles: typing.List[str], streams: typing.List[typing.Any],
     logger.init_logger(logfiles, streams, console, loglevel)
 
 
+def is_debug_enabled() -> bool:
+    # Allows to skip formatting of debug messages in hot loops
+    return logger.is_debug_enabled()
+
+
 def debug(msg: str, to_file: bool = True, to_stream: bool = True) -> None:
     logger.debug(msg, to_file, to_stream)
 
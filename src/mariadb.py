@@ -1,21 +1,23 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
 import subprocess
 
-from . import dist, log
+from . import accounting, dist, log, query_cache
 
 
 def is_version_larger(left: str, right: str) -> bool:
     return MariaDBVersion(left) > MariaDBVersion(right)
 
 
+@query_cache.cached_query(query_cache.PACKAGES_QUERIES)
 def _get_mariadb_utilname() -> str:
     for utility in ("mariadb", "mysql"):
-        if subprocess.run(["which", utility], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+        if accounting.run(["which", utility], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
             return utility
 
     return None
 
 
+@query_cache.cached_query(query_cache.PACKAGES_QUERIES)
 def is_mariadb_installed() -> bool:
     utility = _get_mariadb_utilname()
     if utility is None:
@@ -23,15 +25,16 @@ def is_mariadb_installed() -> bool:
     elif utility == "mariadb":
         return True
 
-    return "MariaDB" in subprocess.check_output([utility, "--version"], universal_newlines=True)
+    return "MariaDB" in accounting.check_output([utility, "--version"], universal_newlines=True)
 
 
+@query_cache.cached_query(query_cache.PACKAGES_QUERIES)
 def is_mysql_installed() -> bool:
     utility = _get_mariadb_utilname()
     if utility is None or utility == "mariadb":
         return False
 
-    return "MariaDB" not in subprocess.check_output([utility, "--version"], universal_newlines=True)
+    return "MariaDB" not in accounting.check_output([utility, "--version"], universal_newlines=True)
 
 
 class MariaDBVersion():
@@ -84,7 +87,7 @@ class MariaDBVersion():
 
 def get_installed_mariadb_version() -> MariaDBVersion:
     utility = _get_mariadb_utilname()
-    out = subprocess.check_output([utility, "--version"], universal_newlines=True)
+    out = accounting.check_output([utility, "--version"], universal_newlines=True)
     log.debug("Detected mariadb version is: {version}".format(version=out.split("Distrib ")[1].split(",")[0].split("-")[0]))
     return MariaDBVersion(out)
 
@@ -1,11 +1,22 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import contextlib
+import functools
+import json
+import os
+import threading
 import typing
 
-from . import dist, dpkg, rpm
+from . import dist, dpkg, log, rpm, version
 
 
 def filter_installed_packages(lookup_pkgs: typing.List[str]) -> typing.List[str]:
-    return [pkg for pkg in lookup_pkgs if is_package_installed(pkg)]
+    started_on = dist.get_distro()
+    if dist._is_deb_based(started_on):
+        return dpkg.filter_installed_packages(lookup_pkgs)
+    elif dist._is_rhel_based(started_on):
+        return rpm.filter_installed_packages(lookup_pkgs)
+    else:
+        raise NotImplementedError(f"Unsupported distro {started_on}")
 
 
 def is_package_installed(pkg: str) -> bool:
@@ -76,3 +87,306 @@ def autoremove_outdated_packages() -> None:
         return rpm.autoremove_outdated_packages()
     else:
         raise NotImplementedError(f"Unsupported distro {started_on}")
+
+
+def apply_packages_transaction(install: typing.List[str], remove: typing.List[str],
+                               upgrade: typing.Optional[typing.List[str]] = None,
+                               repository: str = None, force_package_config: bool = False) -> None:
+    started_on = dist.get_distro()
+    if dist._is_deb_based(started_on):
+        return dpkg.apply_packages_transaction(install, remove, upgrade, force_package_config)
+    elif dist._is_rhel_based(started_on):
+        return rpm.apply_packages_transaction(install, remove, upgrade, repository)
+    else:
+        raise NotImplementedError(f"Unsupported distro {started_on}")
+
+
+class PackagesTransactionError(Exception):
+    def __init__(self, requesters: typing.List[str], reason: Exception):
+        super().__init__("Packages transaction requested by {requesters} failed: {reason}".format(
+                         requesters=", ".join(requesters), reason=reason))
+        self.requesters = requesters
+        self.reason = reason
+
+
+class PackagesTransaction():
+    """Collects install, remove and upgrade operations to perform them by one package manager run.
+
+    Operations with different repository or configuration options can't share a run, so they are
+    grouped by the options. When a run fails, the operations are repeated requester by requester
+    to find out which ones are broken.
+    """
+
+    def __init__(self):
+        self.operations = []
+        self._lock = threading.Lock()
+
+    def _add(self, kind: str, pkgs: typing.Optional[typing.List[str]], requester: str,
+             repository: str = None, force_package_config: bool = False) -> None:
+        with self._lock:
+            self.operations.append((kind, list(pkgs) if pkgs is not None else [], requester, (repository, force_package_config)))
+
+    def install(self, pkgs: typing.List[str], requester: str = None, repository: str = None, force_package_config: bool = False) -> None:
+        if len(pkgs) != 0:
+            self._add("install", pkgs, requester, repository, force_package_config)
+
+    def remove(self, pkgs: typing.List[str], requester: str = None) -> None:
+        if len(pkgs) != 0:
+            self._add("remove", pkgs, requester)
+
+    def upgrade(self, pkgs: typing.List[str] = None, requester: str = None) -> None:
+        self._add("upgrade", pkgs, requester)
+
+    def discard(self, requester: str) -> None:
+        with self._lock:
+            self.operations = [operation for operation in self.operations if operation[2] != requester]
+
+    def is_empty(self) -> bool:
+        return len(self.operations) == 0
+
+    def commit(self) -> None:
+        with self._lock:
+            operations, self.operations = self.operations, []
+
+        groups = {}
+        for operation in operations:
+            groups.setdefault(operation[3], []).append(operation)
+
+        for (repository, force_package_config), group in groups.items():
+            self._apply_group(group, repository, force_package_config)
+
+    @staticmethod
+    def _apply_operations(operations: typing.List[typing.Tuple], repository: str, force_package_config: bool) -> None:
+        def collect(kind: str) -> typing.List[str]:
+            # Keep the order of packages, but mention every one only once
+            return list(dict.fromkeys(pkg for operation in operations if operation[0] == kind for pkg in operation[1]))
+
+        upgrade = None
+        upgrades = [operation for operation in operations if operation[0] == "upgrade"]
+        if upgrades:
+            # Upgrade without packages specified means upgrade of everything
+            upgrade = [] if any(len(operation[1]) == 0 for operation in upgrades) else collect("upgrade")
+
+        apply_packages_transaction(collect("install"), collect("remove"), upgrade, repository, force_package_config)
+
+    @staticmethod
+    def _skip_applied_removals(operations: typing.List[typing.Tuple]) -> typing.List[typing.Tuple]:
+        # A failed run could be applied partially, e.g. on rpm based systems packages are removed
+        # before the yum run. Removing them again would fail, so only installed ones are kept.
+        removals = [pkg for operation in operations if operation[0] == "remove" for pkg in operation[1]]
+        if not removals:
+            return operations
+
+        installed = set(filter_installed_packages(removals))
+        result = []
+        for kind, pkgs, requester, options in operations:
+            if kind == "remove":
+                pkgs = [pkg for pkg in pkgs if pkg in installed]
+                if not pkgs:
+                    continue
+            result.append((kind, pkgs, requester, options))
+        return result
+
+    def _apply_group(self, operations: typing.List[typing.Tuple], repository: str, force_package_config: bool) -> None:
+        requesters = []
+        for _, _, requester, _ in operations:
+            if requester not in requesters:
+                requesters.append(requester)
+
+        try:
+            self._apply_operations(operations, repository, force_package_config)
+            return
+        except Exception as ex:
+            if len(requesters) == 1:
+                raise PackagesTransactionError([str(requesters[0])], ex)
+            log.warn("Packages transaction failed: {error}. Going to repeat it for every requester separately".format(error=ex))
+            error = ex
+
+        failed = []
+        for requester in requesters:
+            requester_operations = self._skip_applied_removals([operation for operation in operations if operation[2] == requester])
+            if not requester_operations:
+                continue
+
+            try:
+                self._apply_operations(requester_operations, repository, force_package_config)
+            except Exception as ex:
+                failed.append(str(requester))
+                error = ex
+
+        if failed:
+            raise PackagesTransactionError(failed, error)
+
+
+_active_transaction = None
+_transaction_context = threading.local()
+
+
+def begin_transaction() -> PackagesTransaction:
+    global _active_transaction
+    _active_transaction = PackagesTransaction()
+    return _active_transaction
+
+
+def commit_transaction() -> None:
+    global _active_transaction
+    transaction, _active_transaction = _active_transaction, None
+    if transaction is not None:
+        transaction.commit()
+
+
+def abort_transaction() -> None:
+    global _active_transaction
+    transaction, _active_transaction = _active_transaction, None
+    if transaction is not None and not transaction.is_empty():
+        log.warn("Packages transaction is aborted, {count} operations are not performed".format(count=len(transaction.operations)))
+
+
+@contextlib.contextmanager
+def transaction_requester(name: str) -> typing.Iterator[None]:
+    # Operations deferred by the current thread are attributed to the requester.
+    # If the requester fails, its operations are dropped from the active transaction.
+    previous = getattr(_transaction_context, "requester", None)
+    _transaction_context.requester = name
+    try:
+        yield
+    except Exception:
+        transaction = _active_transaction
+        if transaction is not None:
+            transaction.discard(name)
+        raise
+    finally:
+        _transaction_context.requester = previous
+
+
+def _get_requester(requester: typing.Optional[str]) -> typing.Optional[str]:
+    return requester if requester is not None else getattr(_transaction_context, "requester", None)
+
+
+# Deferred variants are performed in scope of the active transaction if there is one,
+# and right away otherwise. So an action should not expect the change is done when the call returns.
+def defer_install_packages(pkgs: typing.List[str], repository: str = None, force_package_config: bool = False,
+                           requester: str = None) -> None:
+    transaction = _active_transaction
+    if transaction is None:
+        return install_packages(pkgs, repository, force_package_config)
+    transaction.install(pkgs, _get_requester(requester), repository, force_package_config)
+
+
+def defer_remove_packages(pkgs: typing.List[str], requester: str = None) -> None:
+    transaction = _active_transaction
+    if transaction is None:
+        return remove_packages(pkgs)
+    transaction.remove(pkgs, _get_requester(requester))
+
+
+def defer_upgrade_packages(pkgs: typing.List[str] = None, requester: str = None) -> None:
+    transaction = _active_transaction
+    if transaction is None:
+        return upgrade_packages(pkgs)
+    transaction.upgrade(pkgs, _get_requester(requester))
+
+
+class PackagesDiff():
+    """Difference between two snapshots of installed packages.
+
+    Added and removed map a package key to its versions, upgraded and downgraded
+    map a package key to the pair of old and new latest versions.
+    """
+
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+        self.upgraded = {}
+        self.downgraded = {}
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.upgraded or self.downgraded)
+
+    def to_dict(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        return {"added": self.added, "removed": self.removed, "upgraded": self.upgraded, "downgraded": self.downgraded}
+
+
+class InstalledPackages():
+    """Snapshot of installed packages taken from the rpm or dpkg index.
+
+    Packages are keyed by name and architecture ("name.arch" for rpm, "name:arch" for dpkg),
+    so multilib packages are tracked separately. Install-only packages like kernel could have
+    several versions under the same key, the latest one is used to detect upgrades.
+    """
+
+    RPM = "rpm"
+    DEB = "deb"
+
+    def __init__(self, kind: str, versions: typing.Dict[str, typing.List[str]]):
+        self.kind = kind
+        self.versions = versions
+
+    @classmethod
+    def take(cls) -> "InstalledPackages":
+        started_on = dist.get_distro()
+        versions = {}
+        if dist._is_deb_based(started_on):
+            for package in dpkg.get_installed_packages_index():
+                versions.setdefault(f"{package.name}:{package.arch}", []).append(package.version)
+            return cls(cls.DEB, versions)
+        elif dist._is_rhel_based(started_on):
+            for package in rpm.get_installed_packages_index():
+                key = f"{package.name}.{package.arch}" if package.arch is not None else package.name
+                versions.setdefault(key, []).append(package.evr)
+            return cls(cls.RPM, versions)
+        else:
+            raise NotImplementedError(f"Unsupported distro {started_on}")
+
+    def save(self, path: str) -> None:
+        # Single version is stored as a string instead of a list to keep the file small
+        packages = {key: versions[0] if len(versions) == 1 else versions for key, versions in self.versions.items()}
+        with open(path + ".next", "w") as dst:
+            json.dump({"kind": self.kind, "packages": packages}, dst, separators=(",", ":"), sort_keys=True)
+        os.replace(path + ".next", path)
+
+    @classmethod
+    def load(cls, path: str) -> "InstalledPackages":
+        with open(path, "r") as src:
+            data = json.load(src)
+        versions = {key: [value] if isinstance(value, str) else value for key, value in data["packages"].items()}
+        return cls(data["kind"], versions)
+
+    def _compare(self, left: str, right: str) -> int:
+        if self.kind == self.DEB:
+            return version.compare_deb_versions(left, right)
+        return version.compare_rpm_versions(left, right)
+
+    def _get_latest(self, versions: typing.List[str]) -> str:
+        return functools.reduce(lambda latest, current: current if self._compare(current, latest) > 0 else latest, versions)
+
+    def diff(self, newer: "InstalledPackages") -> PackagesDiff:
+        """Changes from this snapshot to the newer one. Every key is visited once."""
+        if self.kind != newer.kind:
+            raise ValueError(f"Unable to compare snapshots of {self.kind} and {newer.kind} packages")
+
+        result = PackagesDiff()
+        for key, old_versions in self.versions.items():
+            new_versions = newer.versions.get(key)
+            if new_versions is None:
+                result.removed[key] = old_versions
+                continue
+
+            if old_versions == new_versions:
+                continue
+
+            old_latest, new_latest = self._get_latest(old_versions), self._get_latest(new_versions)
+            comparison = self._compare(new_latest, old_latest)
+            if comparison > 0:
+                result.upgraded[key] = (old_latest, new_latest)
+            elif comparison < 0:
+                result.downgraded[key] = (old_latest, new_latest)
+
+        for key, new_versions in newer.versions.items():
+            if key not in self.versions:
+                result.added[key] = new_versions
+
+        return result
+
+    def __len__(self) -> int:
+        return len(self.versions)
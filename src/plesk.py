@@ -4,7 +4,7 @@ import os
 import subprocess
 import typing
 
-from . import log, mariadb, systemd
+from . import accounting, log, mariadb, query_cache, systemd
 
 CONVERTER_TEMP_DIRECTORY = "/usr/local/psa/var/centos2alma"
 
@@ -16,15 +16,16 @@ def send_error_report(error_message: str) -> None:
     send_error_path = "/usr/local/psa/admin/bin/send-error-report"
     try:
         if os.path.exists(send_error_path):
-            subprocess.run([send_error_path, "backend"], input=error_message.encode(),
+            accounting.run([send_error_path, "backend"], input=error_message.encode(),
                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except Exception:
         # We don't care about errors to avoid mislead of the user
         pass
 
 
+@query_cache.cached_query(query_cache.PLESK_VERSION_QUERIES, query_cache.RUN_SCOPE)
 def get_plesk_version() -> typing.List[str]:
-    version_info = subprocess.check_output(["/usr/sbin/plesk", "version"], universal_newlines=True).splitlines()
+    version_info = accounting.check_output(["/usr/sbin/plesk", "version"], universal_newlines=True).splitlines()
     for line in version_info:
         if line.startswith("Product version"):
             version = line.split()[-1]
@@ -33,8 +34,9 @@ def get_plesk_version() -> typing.List[str]:
     raise Exception("Unable to parce plesk version output.")
 
 
+@query_cache.cached_query(query_cache.PLESK_VERSION_QUERIES, query_cache.RUN_SCOPE)
 def get_plesk_full_version() -> typing.List[str]:
-    return subprocess.check_output(["/usr/sbin/plesk", "version"], universal_newlines=True).splitlines()
+    return accounting.check_output(["/usr/sbin/plesk", "version"], universal_newlines=True).splitlines()
 
 
 _STATUS_FLAG_FILE_PATH = CONVERTER_TEMP_DIRECTORY + "/distupgrade-conversion.flag"
@@ -66,7 +68,7 @@ def send_conversion_status(succeed: bool) -> str:
 
     try:
         log.debug("Trying to send status of conversion by report-update utility")
-        subprocess.run(["/usr/bin/python3", results_sander_path, "--op", "dist-upgrade", "--rc", "0" if succeed else "1",
+        accounting.run(["/usr/bin/python3", results_sander_path, "--op", "dist-upgrade", "--rc", "0" if succeed else "1",
                         "--start-flag", _STATUS_FLAG_FILE_PATH, "--from", plesk_version, "--to", plesk_version],
                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except Exception as ex:
@@ -97,7 +99,7 @@ def get_from_plesk_database(query: str) -> typing.List[str]:
 
     cmd = ["/usr/sbin/plesk", "db", "-B", "-N", "-e", query]
     log.debug(f"Executing query {cmd}")
-    proc = subprocess.run(
+    proc = accounting.run(
         cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
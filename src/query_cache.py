@@ -0,0 +1,115 @@
+# Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import copy
+import functools
+import threading
+import typing
+
+# Values of run scope are kept until they are invalidated explicitly,
+# values of stage scope are dropped on every start of a flow stage as well
+RUN_SCOPE = "run"
+STAGE_SCOPE = "stage"
+
+PACKAGES_QUERIES = "packages"
+SERVICES_EXISTS_QUERIES = "services.exists"
+SERVICES_ACTIVE_QUERIES = "services.active"
+SERVICES_ENABLED_QUERIES = "services.enabled"
+PLESK_VERSION_QUERIES = "plesk.version"
+
+SERVICES_QUERIES = [SERVICES_EXISTS_QUERIES, SERVICES_ACTIVE_QUERIES, SERVICES_ENABLED_QUERIES]
+# Installation of packages could bring new services and even a new version of Plesk
+PACKAGES_MUTATION_QUERIES = [PACKAGES_QUERIES, PLESK_VERSION_QUERIES] + SERVICES_QUERIES
+
+
+class QueryCache():
+    """Memoized results of read-only system queries like "is the package installed".
+
+    Values are stored by namespace, query name and query arguments, so a mutating call
+    could drop exactly the affected entries. The cache is disabled by default, because changes made
+    not by the library functions (e.g. by a raw util.logged_check_call) are not tracked.
+    Every caller gets its own copy of the value, so changes of a returned list do not affect the cache.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_or_query(self, namespace: str, name: str, arguments: typing.Tuple, scope: str,
+                     query: typing.Callable[[], typing.Any]) -> typing.Any:
+        if not self.enabled:
+            return query()
+
+        key = (namespace, name, arguments)
+        with self._lock:
+            if key in self._values:
+                return copy.deepcopy(self._values[key][1])
+
+        value = query()
+        with self._lock:
+            self._values[key] = (scope, copy.deepcopy(value))
+        return value
+
+    def invalidate(self, namespace: str, arguments: typing.Tuple = None) -> None:
+        with self._lock:
+            for key in [key for key in self._values
+                        if key[0] == namespace and (arguments is None or key[2] == arguments)]:
+                del self._values[key]
+
+    def clear_scope(self, scope: str) -> None:
+        with self._lock:
+            for key in [key for key, (value_scope, _) in self._values.items() if value_scope == scope]:
+                del self._values[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values = {}
+
+
+query_cache = QueryCache()
+
+
+def enable_query_cache() -> None:
+    query_cache.enabled = True
+
+
+def disable_query_cache() -> None:
+    query_cache.enabled = False
+    query_cache.clear()
+
+
+def cached_query(namespace: str, scope: str = STAGE_SCOPE) -> typing.Callable:
+    def decorator(func: typing.Callable) -> typing.Callable:
+        name = func.__module__ + "." + func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return query_cache.get_or_query(namespace, name, args, scope, lambda: func(*args))
+        return wrapper
+    return decorator
+
+
+def invalidate_query(namespace: str, arguments: typing.Tuple = None) -> None:
+    query_cache.invalidate(namespace, arguments)
+
+
+def invalidates_queries(*namespaces: str) -> typing.Callable:
+    """Drop all cached values of the namespaces after the call, even a failed one."""
+    def decorator(func: typing.Callable) -> typing.Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                for namespace in namespaces:
+                    query_cache.invalidate(namespace)
+        return wrapper
+    return decorator
+
+
+def invalidate_services_queries(namespace: str, services: typing.Iterable[str]) -> None:
+    for service in services:
+        query_cache.invalidate(namespace, (service,))
+
+
+def clear_stage_queries() -> None:
+    query_cache.clear_scope(STAGE_SCOPE)
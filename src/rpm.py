@@ -1,11 +1,14 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
-import itertools
+import fnmatch
+import functools
 import os
+import re
 import shutil
-import subprocess
+import tempfile
+import threading
 import typing
 
-from . import files, util, log
+from . import accounting, files, log, query_cache, util, version
 
 REPO_HEAD_WITH_URL = """[{id}]
 name={name}
@@ -23,6 +26,159 @@ mirrorlist={url}
 """
 
 
+YUM_REPOS_DIRECTORY = "/etc/yum.repos.d"
+
+
+class RepoSection():
+    """Section of a yum repository file.
+
+    All lines of the section, including the header, comments and empty lines, are kept as is,
+    so the file could be written back without any changes. Lines before the first header
+    are stored as a section without id.
+    """
+
+    __slots__ = ("id", "lines", "fields")
+
+    def __init__(self, id: typing.Optional[str], lines: typing.List[str] = None):
+        self.id = id
+        self.lines = lines if lines is not None else []
+        self.fields = {}
+
+    def add_line(self, line: str) -> None:
+        self.lines.append(line)
+        if "=" not in line or line.startswith(("#", ";")):
+            return
+
+        field, value = line.split("=", 1)
+        self.fields[field.strip()] = value.strip()
+
+    def get(self, field: str, default: typing.Optional[str] = None) -> typing.Optional[str]:
+        return self.fields.get(field, default)
+
+    @property
+    def name(self) -> typing.Optional[str]:
+        return self.fields.get("name")
+
+    @property
+    def baseurl(self) -> typing.Optional[str]:
+        return self.fields.get("baseurl")
+
+    @property
+    def metalink(self) -> typing.Optional[str]:
+        return self.fields.get("metalink")
+
+    @property
+    def mirrorlist(self) -> typing.Optional[str]:
+        return self.fields.get("mirrorlist")
+
+    def to_repodata(self) -> typing.Tuple[typing.Optional[str], typing.Optional[str], typing.Optional[str],
+                                          typing.Optional[str], typing.Optional[str], typing.List[str]]:
+        # Representation used by extract_repodata: known fields and the rest of lines as they are
+        additional = []
+        body = self.lines[1:] if self.id is not None else self.lines
+        for line in body:
+            if "=" not in line or line.split("=", 1)[0].strip() not in ("name", "baseurl", "metalink", "mirrorlist"):
+                additional.append(line)
+        return (self.id, self.name, self.baseurl, self.metalink, self.mirrorlist, additional)
+
+    def __repr__(self) -> str:
+        return f"RepoSection({self.id!r})"
+
+
+class RepoFile():
+    """Yum repository file parsed in one pass with exact lines kept for round trip."""
+
+    __slots__ = ("path", "sections")
+
+    def __init__(self, path: typing.Optional[str], sections: typing.List[RepoSection]):
+        self.path = path
+        self.sections = sections
+
+    @classmethod
+    def parse(cls, lines: typing.Iterable[str], path: typing.Optional[str] = None) -> "RepoFile":
+        # Formatting of a message for every line is expensive, so do it only when it is going to be shown
+        debug = log.is_debug_enabled()
+        sections = []
+        current = None
+        for line in lines:
+            if debug:
+                log.debug("Repository file line: {line}".format(line=line.rstrip()))
+
+            if line.startswith("["):
+                current = RepoSection(line.strip()[1:-1].strip(), [line])
+                sections.append(current)
+                continue
+
+            if current is None:
+                current = RepoSection(None)
+                sections.append(current)
+            current.add_line(line)
+
+        return cls(path, sections)
+
+    @classmethod
+    def load(cls, path: str) -> "RepoFile":
+        with open(path, "r") as repofile:
+            return cls.parse(repofile, path)
+
+    @property
+    def repositories(self) -> typing.List[RepoSection]:
+        return [section for section in self.sections if section.id is not None]
+
+    def get_repository(self, id: str) -> typing.Optional[RepoSection]:
+        for section in self.sections:
+            if section.id == id:
+                return section
+        return None
+
+    def to_text(self) -> str:
+        return "".join(line for section in self.sections for line in section.lines)
+
+    def __iter__(self) -> typing.Iterator[RepoSection]:
+        return iter(self.repositories)
+
+
+class RepoFilesLoader():
+    """Parsed repository files of a directory. A file is parsed again only when it is changed.
+
+    Returned objects are shared between callers, so they should not be modified.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def load(self, directory: str = YUM_REPOS_DIRECTORY) -> typing.List[RepoFile]:
+        repofiles = []
+        with self._lock:
+            seen = set()
+            for path in sorted(files.find_files_case_insensitive(directory, ["*.repo"])):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                seen.add(path)
+                state = (stat.st_mtime_ns, stat.st_size)
+                cached = self._files.get(path)
+                if cached is None or cached[0] != state:
+                    cached = (state, RepoFile.load(path))
+                    self._files[path] = cached
+                repofiles.append(cached[1])
+
+            for path in [path for path in self._files if path.startswith(directory.rstrip("/") + "/") and path not in seen]:
+                del self._files[path]
+
+        return repofiles
+
+
+_repofiles_loader = RepoFilesLoader()
+
+
+def load_repofiles(directory: str = YUM_REPOS_DIRECTORY) -> typing.List[RepoFile]:
+    return _repofiles_loader.load(directory)
+
+
 def extract_repodata(
     repofile: str
 ) -> typing.Iterable[
@@ -35,50 +191,17 @@ def extract_repodata(
         typing.List[str]
     ]
 ]:
-    id = None
-    name = None
-    url = None
-    metalink = None
-    mirrorlist = None
-    additional = []
-
-    with open(repofile, "r") as repo:
-        for line in repo.readlines():
-            if line.startswith("["):
-                if id is not None:
-                    yield (id, name, url, metalink, mirrorlist, additional)
-
-                id = None
-                name = None
-                url = None
-                metalink = None
-                mirrorlist = None
-                additional = []
-
-            log.debug("Repository file line: {line}".format(line=line.rstrip()))
-            if line.startswith("["):
-                id = line[1:-2]
-                continue
+    repositories = RepoFile.load(repofile).sections
+    if any(section.id is not None for section in repositories):
+        # Lines before the first repository are not a part of any repository
+        repositories = [section for section in repositories if section.id is not None]
 
-            if "=" not in line:
-                additional.append(line)
-                continue
-
-            field, val = line.split("=", 1)
-            field = field.strip().rstrip()
-            val = val.strip().rstrip()
-            if field == "name":
-                name = val
-            elif field == "baseurl":
-                url = val
-            elif field == "metalink":
-                metalink = val
-            elif field == "mirrorlist":
-                mirrorlist = val
-            else:
-                additional.append(line)
+    if not repositories:
+        yield (None, None, None, None, None, [])
+        return
 
-    yield (id, name, url, metalink, mirrorlist, additional)
+    for section in repositories:
+        yield section.to_repodata()
 
 
 def write_repodata(
@@ -104,6 +227,139 @@ def write_repodata(
             dst.write(line)
 
 
+class RepoFileEditor():
+    """Transactional editor of a yum repository file.
+
+    Removals, modifications and additions are collected in memory and written on exit
+    by one write into a unique temporary file, which is synced and renamed over the original
+    one. If the block raises, nothing is written. The file is removed when no repositories
+    are left in it, and it is not touched at all when nothing was changed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.repofile = None
+        self._changed = False
+
+    def __enter__(self) -> "RepoFileEditor":
+        if os.path.exists(self.path):
+            self.repofile = RepoFile.load(self.path)
+        else:
+            self.repofile = RepoFile(self.path, [])
+        self._changed = False
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            log.warn("Changes of repository file '{path}' are discarded because of an error: {error}".format(path=self.path, error=exc_value))
+            return
+
+        if self._changed:
+            self.commit()
+
+    @property
+    def repositories(self) -> typing.List[RepoSection]:
+        return self.repofile.repositories
+
+    def get_repository(self, id: str) -> typing.Optional[RepoSection]:
+        return self.repofile.get_repository(id)
+
+    def remove_repository(self, id: str) -> bool:
+        return self.remove_repositories(lambda section: section.id == id) > 0
+
+    def remove_repositories(self, predicate: typing.Callable[[RepoSection], bool]) -> int:
+        kept = [section for section in self.repofile.sections if section.id is None or not predicate(section)]
+        removed = len(self.repofile.sections) - len(kept)
+        if removed:
+            self.repofile.sections = kept
+            self._changed = True
+        return removed
+
+    def set_field(self, id: str, field: str, value: str) -> None:
+        section = self.get_repository(id)
+        if section is None:
+            raise KeyError(f"There is no repository '{id}' in {self.path}")
+
+        new_line = f"{field}={value}\n"
+        for index, line in enumerate(section.lines[1:], start=1):
+            if "=" in line and not line.startswith(("#", ";")) and line.split("=", 1)[0].strip() == field:
+                section.lines[index] = new_line
+                break
+        else:
+            # Put the new field right after the last one to keep empty lines between sections
+            position = len(section.lines)
+            while position > 1 and not section.lines[position - 1].strip():
+                position -= 1
+            section.lines.insert(position, new_line)
+
+        section.fields[field] = value
+        self._changed = True
+
+    def add_repository(self, id: str, name: str, url: typing.Optional[str] = None, metalink: typing.Optional[str] = None,
+                       mirrorlist: typing.Optional[str] = None, additional: typing.List[str] = None) -> RepoSection:
+        if self.get_repository(id) is not None:
+            raise KeyError(f"Repository '{id}' already exists in {self.path}")
+
+        repo_format = REPO_HEAD_WITH_URL
+        if url is None and metalink is not None:
+            url, repo_format = metalink, REPO_HEAD_WITH_METALINK
+        if url is None and mirrorlist is not None:
+            url, repo_format = mirrorlist, REPO_HEAD_WITH_MIRRORLIST
+
+        lines = repo_format.format(id=id, name=name, url=url).splitlines(keepends=True)
+        section = RepoSection(id, lines[:1])
+        for line in lines[1:] + (additional if additional is not None else []):
+            section.add_line(line)
+
+        if self.repofile.sections and self.repofile.sections[-1].lines:
+            # Keep an empty line between repositories
+            last_lines = self.repofile.sections[-1].lines
+            if not last_lines[-1].endswith("\n"):
+                last_lines[-1] += "\n"
+            if last_lines[-1].strip():
+                last_lines.append("\n")
+        self.repofile.sections.append(section)
+        self._changed = True
+        return section
+
+    def commit(self) -> None:
+        if not self.repofile.repositories:
+            log.debug("No repositories left in '{path}', removing the file".format(path=self.path))
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._changed = False
+            return
+
+        log.debug("Going to write changes of repository file '{path}'".format(path=self.path))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # Unique name, so a leftover of a crashed run could not be mixed into the result
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as dst:
+                dst.write(self.repofile.to_text())
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, temp_path)
+            else:
+                # mkstemp creates the file readable by the owner only, but repository files should be
+                # readable by everyone. The umask is not read, because it could be done only by changing it.
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        self._changed = False
+
+
 def remove_repositories(
     repofile: str,
     conditions: typing.Iterable[
@@ -119,31 +375,292 @@ def remove_repositories(
         ]
     ]
 ) -> None:
-    for id, name, url, metalink, mirrorlist, additional_lines in extract_repodata(repofile):
-        remove = False
-        for condition in conditions:
-            if condition(id, name, url, metalink, mirrorlist):
-                remove = True
-                break
+    conditions = list(conditions)
+    with RepoFileEditor(repofile) as editor:
+        editor.remove_repositories(
+            lambda repo: any(condition(repo.id, repo.name, repo.baseurl, repo.metalink, repo.mirrorlist) for condition in conditions)
+        )
+
+
+class RepositoryMatcher():
+    """Declarative rules to find repositories, compiled once to be checked fast.
+
+    Exact ids and URL hosts are looked up in sets, id globs and URL prefixes are joined
+    into one regular expression each. A host rule matches subdomains too when it starts
+    with a dot, e.g. ".example.com". URL prefixes are compared with URLs without a scheme,
+    like "mirror.example.com/centos/7". baseurl, metalink and mirrorlist are checked.
+    The matcher could also be used as a condition of remove_repositories.
+    """
+
+    def __init__(self, ids: typing.Iterable[str] = None, id_globs: typing.Iterable[str] = None,
+                 url_hosts: typing.Iterable[str] = None, url_prefixes: typing.Iterable[str] = None):
+        self.ids = frozenset(ids if ids is not None else [])
+        self.url_hosts = frozenset(host.lower() for host in (url_hosts if url_hosts is not None else []))
+
+        id_globs = list(id_globs if id_globs is not None else [])
+        self._id_regex = re.compile("|".join(fnmatch.translate(glob) for glob in id_globs)) if id_globs else None
+
+        # Longer prefixes first, so the regex engine does not backtrack on common beginnings
+        url_prefixes = sorted(url_prefixes if url_prefixes is not None else [], key=len, reverse=True)
+        self._url_prefix_regex = re.compile("|".join(re.escape(prefix) for prefix in url_prefixes)) if url_prefixes else None
+
+    def _match_host(self, host: str) -> bool:
+        if host in self.url_hosts:
+            return True
+
+        # Walk through parent domains: a.b.example.com -> .b.example.com -> .example.com -> .com
+        position = host.find(".")
+        while position != -1:
+            if host[position:] in self.url_hosts:
+                return True
+            position = host.find(".", position + 1)
+        return False
 
-        if not remove:
-            write_repodata(repofile + ".next", id, name, url, metalink, mirrorlist, additional_lines)
+    def _match_url(self, url: str) -> bool:
+        _, _, without_scheme = url.partition("://")
+        if not without_scheme:
+            without_scheme = url
 
-    if os.path.exists(repofile + ".next"):
-        shutil.move(repofile + ".next", repofile)
-    else:
-        os.remove(repofile)
+        if self.url_hosts:
+            host = without_scheme.split("/", 1)[0].rsplit("@", 1)[-1].split(":", 1)[0].lower()
+            if self._match_host(host):
+                return True
+
+        return self._url_prefix_regex is not None and self._url_prefix_regex.match(without_scheme) is not None
+
+    def match(self, id: typing.Optional[str], urls: typing.Iterable[typing.Optional[str]]) -> bool:
+        if id is not None:
+            if id in self.ids:
+                return True
+            if self._id_regex is not None and self._id_regex.match(id):
+                return True
+
+        if not self.url_hosts and self._url_prefix_regex is None:
+            return False
+
+        for field in urls:
+            # baseurl could contain several urls separated by spaces or commas
+            if field and any(self._match_url(url) for url in field.replace(",", " ").split()):
+                return True
+        return False
+
+    def matches(self, section: RepoSection) -> bool:
+        return self.match(section.id, (section.baseurl, section.metalink, section.mirrorlist))
+
+    def __call__(self, id: typing.Optional[str], name: typing.Optional[str], url: typing.Optional[str],
+                 metalink: typing.Optional[str], mirrorlist: typing.Optional[str]) -> bool:
+        return self.match(id, (url, metalink, mirrorlist))
+
+
+def find_repositories(matcher: RepositoryMatcher, directory: str = YUM_REPOS_DIRECTORY) -> typing.List[typing.Tuple[str, RepoSection]]:
+    """Matching repositories of all repository files in the directory as (file path, section) pairs."""
+    return [(repofile.path, section) for repofile in load_repofiles(directory) for section in repofile if matcher.matches(section)]
+
+
+def remove_matching_repositories(matcher: RepositoryMatcher, directory: str = YUM_REPOS_DIRECTORY) -> typing.Dict[str, typing.List[str]]:
+    """Remove matching repositories from all repository files in the directory.
+    Only files with matching repositories are rewritten. Returns removed ids by file path."""
+    removed = {}
+    for path, section in find_repositories(matcher, directory):
+        removed.setdefault(path, []).append(section.id)
+
+    for path, ids in removed.items():
+        log.debug("Going to remove repositories {ids} from '{path}'".format(ids=ids, path=path))
+        with RepoFileEditor(path) as editor:
+            editor.remove_repositories(matcher.matches)
+
+    return removed
+
+
+class RpmPackage():
+    """Installed package as reported by rpm database."""
+
+    __slots__ = ("name", "epoch", "version", "release", "arch")
+
+    def __init__(self, name: str, epoch: typing.Optional[str], version: str, release: str, arch: typing.Optional[str]):
+        self.name = name
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+        self.arch = arch
+
+    @property
+    def evr(self) -> str:
+        evr = f"{self.version}-{self.release}"
+        return f"{self.epoch}:{evr}" if self.epoch is not None else evr
+
+    @property
+    def nevra(self) -> str:
+        nevra = f"{self.name}-{self.evr}"
+        return f"{nevra}.{self.arch}" if self.arch is not None else nevra
+
+    @property
+    def nvra(self) -> str:
+        # Name without epoch accepted by "rpm -e", packages like gpg-pubkey have no arch
+        nvr = f"{self.name}-{self.version}-{self.release}"
+        return f"{nvr}.{self.arch}" if self.arch is not None else nvr
+
+    @property
+    def evr_key(self) -> typing.Tuple[typing.Any, ...]:
+        # Sort key ordering packages just like rpm does
+        return version.rpm_evr_key(self.evr)
+
+    def get_query_names(self) -> typing.List[str]:
+        # Forms of the package name accepted by "rpm --query"
+        vr = f"{self.version}-{self.release}"
+        names = [f"{self.name}-{self.version}", f"{self.name}-{vr}"]
+        if self.epoch is not None:
+            names.append(f"{self.name}-{self.epoch}:{vr}")
+        if self.arch is not None:
+            names += [f"{self.name}.{self.arch}", f"{self.name}-{vr}.{self.arch}"]
+            if self.epoch is not None:
+                names.append(f"{self.name}-{self.epoch}:{vr}.{self.arch}")
+        return names
+
+    def __repr__(self) -> str:
+        return self.nevra
+
+
+# Tab separated fields, rpm shows "(none)" for missing epoch and for arch of gpg-pubkey
+RPM_QUERY_FORMAT = "%{NAME}\t%{EPOCH}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\n"
+# Database files of rpm < 4.16 and of rpm >= 4.16
+RPM_DATABASE_FILES = ["/var/lib/rpm/Packages", "/var/lib/rpm/rpmdb.sqlite", "/var/lib/rpm/rpmdb.sqlite-wal"]
+
+
+class RpmPackagesIndex():
+    """Installed packages taken from rpm database by the single "rpm -qa" call.
+
+    Packages are indexed by name, so a lookup does not start a process. Other forms
+    of the package name accepted by "rpm --query" (name-version, name.arch, full NEVRA)
+    are resolved by a secondary index.
+    """
+
+    def __init__(self, packages: typing.Iterable[RpmPackage]):
+        self.by_name = {}
+        self._by_query_name = {}
+        for package in packages:
+            self.by_name.setdefault(package.name, []).append(package)
+            for query_name in package.get_query_names():
+                self._by_query_name.setdefault(query_name, []).append(package)
+
+    @classmethod
+    def parse(cls, query_output: str) -> "RpmPackagesIndex":
+        packages = []
+        for line in query_output.splitlines():
+            fields = line.split("\t")
+            if len(fields) != 5:
+                continue
+
+            name, epoch, version, release, arch = (None if field == "(none)" else field for field in fields)
+            packages.append(RpmPackage(name, epoch, version, release, arch))
+        return cls(packages)
+
+    @classmethod
+    def load(cls) -> "RpmPackagesIndex":
+        return cls.parse(accounting.check_output(["/usr/bin/rpm", "-qa", "--queryformat", RPM_QUERY_FORMAT], universal_newlines=True))
+
+    def find(self, pkg: str) -> typing.List[RpmPackage]:
+        found = self.by_name.get(pkg)
+        if found is None:
+            found = self._by_query_name.get(pkg, [])
+        return found
+
+    def is_installed(self, pkg: str) -> bool:
+        return len(self.find(pkg)) > 0
+
+    def get_versions(self, name: str) -> typing.List[str]:
+        return [package.evr for package in self.by_name.get(name, [])]
+
+    def get_arches(self, name: str) -> typing.List[str]:
+        return [package.arch for package in self.by_name.get(name, []) if package.arch is not None]
+
+    def get_latest(self, name: str) -> typing.Optional[RpmPackage]:
+        return max(self.by_name.get(name, []), key=lambda package: package.evr_key, default=None)
+
+    def __iter__(self) -> typing.Iterator[RpmPackage]:
+        for packages in self.by_name.values():
+            yield from packages
+
+    def __len__(self) -> int:
+        return sum(len(packages) for packages in self.by_name.values())
+
+
+class _InstalledPackagesCache():
+    # The index is dropped after every change done by the module functions, and it is
+    # also checked against rpm database files to notice changes done by something else
+    def __init__(self):
+        self._index = None
+        self._database_state = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_database_state() -> typing.List[typing.Tuple[str, int, int]]:
+        state = []
+        for path in RPM_DATABASE_FILES:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state.append((path, stat.st_mtime_ns, stat.st_size))
+        return state
+
+    def get(self) -> RpmPackagesIndex:
+        with self._lock:
+            database_state = self._get_database_state()
+            if self._index is None or database_state != self._database_state:
+                self._index = RpmPackagesIndex.load()
+                self._database_state = database_state
+            return self._index
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._index = None
+
+
+_installed_packages = _InstalledPackagesCache()
+
+
+def get_installed_packages_index() -> RpmPackagesIndex:
+    return _installed_packages.get()
+
+
+def invalidate_installed_packages_index() -> None:
+    _installed_packages.invalidate()
+
+
+def _changes_installed_packages(func: typing.Callable) -> typing.Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate_installed_packages_index()
+    return query_cache.invalidates_queries(*query_cache.PACKAGES_MUTATION_QUERIES)(wrapper)
 
 
 def filter_installed_packages(lookup_pkgs: typing.List[str]) -> typing.List[str]:
-    return [pkg for pkg in lookup_pkgs if is_package_installed(pkg)]
+    index = get_installed_packages_index()
+    return [pkg for pkg in lookup_pkgs if index.is_installed(pkg)]
 
 
 def is_package_installed(pkg: str) -> bool:
-    res = subprocess.run(["/usr/bin/rpm", "--quiet", "--query", pkg])
-    return res.returncode == 0
+    return get_installed_packages_index().is_installed(pkg)
+
+
+def get_installed_package_versions(name: str) -> typing.List[str]:
+    return get_installed_packages_index().get_versions(name)
+
+
+def get_installed_package_arches(name: str) -> typing.List[str]:
+    return get_installed_packages_index().get_arches(name)
+
+
+def get_latest_installed_package(name: str) -> typing.Optional[RpmPackage]:
+    """The newest installed package with the name, e.g. the latest "kernel". rpm is not called for comparison."""
+    return get_installed_packages_index().get_latest(name)
 
 
+@_changes_installed_packages
 def install_packages(pkgs: str, repository: str = None, force_package_config: bool = False) -> None:
     # force_package_config is not supported yet
     if len(pkgs) == 0:
@@ -157,20 +674,96 @@ def install_packages(pkgs: str, repository: str = None, force_package_config: bo
     util.logged_check_call(command)
 
 
-def remove_packages(pkgs: str) -> None:
+# Epoch is printed before the name by yum tools and after the name by rpm
+def parse_nevra(nevra: str) -> typing.Optional[RpmPackage]:
+    """Parse "[E:]N-[E:]V-R[.A]" string, None is returned for anything else."""
+    parts = version.split_rpm_nevra(nevra)
+    return RpmPackage(*parts) if parts is not None else None
+
+
+class PackagesRemovalReport():
+    """Result of remove_packages: duplicates found for requested packages and arguments of the rpm call."""
+
+    def __init__(self, requested: typing.List[str]):
+        self.requested = requested
+        # Requested package to its installed duplicates
+        self.duplicates = {}
+        self.removed = []
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "requested": self.requested,
+            "duplicates": {pkg: [duplicate.nevra for duplicate in duplicates] for pkg, duplicates in self.duplicates.items()},
+            "removed": self.removed,
+        }
+
+
+def _find_duplicates(pkgs: typing.List[str]) -> typing.Dict[str, typing.List[RpmPackage]]:
+    requested = set(pkgs)
+    duplicates = {}
+    output = accounting.check_output(["/usr/bin/package-cleanup", "--dupes"], universal_newlines=True)
+    for line in output.splitlines():
+        package = parse_nevra(line)
+        if package is None:
+            # Messages of yum plugins and so on
+            continue
+
+        for query_name in [package.name] + package.get_query_names():
+            if query_name in requested:
+                duplicates.setdefault(query_name, []).append(package)
+                break
+
+    return duplicates
+
+
+@_changes_installed_packages
+def remove_packages(pkgs: typing.List[str]) -> PackagesRemovalReport:
+    report = PackagesRemovalReport(list(pkgs))
     if len(pkgs) == 0:
-        return
+        return report
 
     if os.path.exists("/usr/bin/package-cleanup"):
-        duplicates = subprocess.check_output(["/usr/bin/package-cleanup", "--dupes"], universal_newlines=True).splitlines()
-        for duplicate, pkg in itertools.product(duplicates, pkgs):
-            if pkg in duplicate:
-                util.logged_check_call(["/usr/bin/rpm", "-e", "--nodeps", duplicate])
-                # Since we removed each duplicate, we don't need to remove the package in the end.
-                if pkg in pkgs:
-                    pkgs.remove(pkg)
+        report.duplicates = _find_duplicates(pkgs)
+
+    # rpm refuses to remove a package by the name when several versions are installed,
+    # so every duplicate is specified by the full NEVRA instead
+    for pkg in pkgs:
+        duplicates = report.duplicates.get(pkg)
+        if duplicates is None:
+            report.removed.append(pkg)
+        else:
+            report.removed += [duplicate.nvra for duplicate in duplicates]
+    report.removed = list(dict.fromkeys(report.removed))
+
+    util.logged_check_call(["/usr/bin/rpm", "-e", "--nodeps"] + report.removed)
+    return report
+
+
+@_changes_installed_packages
+def apply_packages_transaction(install: typing.List[str], remove: typing.List[str],
+                               upgrade: typing.Optional[typing.List[str]] = None, repository: str = None) -> None:
+    # Removal is done by rpm without dependencies check like in remove_packages, so it can't
+    # be a part of the yum transaction. Do it first to clean up conflicting packages.
+    if remove:
+        remove_packages(remove)
+
+    commands = []
+    if install:
+        commands.append("install " + " ".join(install))
+    if upgrade is not None:
+        # Empty list means upgrade of everything, just like for upgrade_packages
+        commands.append("update " + " ".join(upgrade))
+    if not commands:
+        return
+
+    with tempfile.NamedTemporaryFile("w", prefix="distupgrade-", suffix=".yumshell") as script:
+        script.write("\n".join(commands + ["run"]) + "\n")
+        script.flush()
 
-    util.logged_check_call(["/usr/bin/rpm", "-e", "--nodeps"] + pkgs)
+        command = ["/usr/bin/yum", "shell", "-y"]
+        if repository is not None:
+            command += ["--repo", repository]
+        util.logged_check_call(command + [script.name])
 
 
 def handle_rpmnew(original_path: str) -> bool:
@@ -203,10 +796,12 @@ def find_related_repofiles(repository_file: str) -> typing.List[str]:
     return files.find_files_case_insensitive("/etc/yum.repos.d", repository_file)
 
 
+@_changes_installed_packages
 def update_package_list() -> None:
     util.logged_check_call(["/usr/bin/yum", "update", "-y"])
 
 
+@_changes_installed_packages
 def upgrade_packages(pkgs: typing.List[str] = None) -> None:
     if pkgs is None:
         pkgs = []
@@ -214,5 +809,6 @@ def upgrade_packages(pkgs: typing.List[str] = None) -> None:
     util.logged_check_call(["/usr/bin/yum", "upgrade", "-y"] + pkgs)
 
 
+@_changes_installed_packages
 def autoremove_outdated_packages() -> None:
     util.logged_check_call(["/usr/bin/yum", "autoremove", "-y"])
@@ -3,7 +3,7 @@ import os
 import typing
 import subprocess
 
-from . import dist, log, util
+from . import accounting, dist, log, query_cache, util
 
 SYSTEMCTL_BIN_PATH = "/usr/bin/systemctl"
 if dist._is_deb_based(dist.get_distro()):
@@ -14,18 +14,21 @@ if dist._is_deb_based(dist.get_distro()):
     SYSTEMCTL_SERVICES_PATH = "/lib/systemd/system"
 
 
+@query_cache.cached_query(query_cache.SERVICES_EXISTS_QUERIES)
 def is_service_exists(service: str):
-    res = subprocess.run([SYSTEMCTL_BIN_PATH, 'cat', service], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    res = accounting.run([SYSTEMCTL_BIN_PATH, 'cat', service], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return res.returncode == 0
 
 
+@query_cache.cached_query(query_cache.SERVICES_ACTIVE_QUERIES)
 def is_service_active(service: str):
-    res = subprocess.run([SYSTEMCTL_BIN_PATH, 'is-active', service], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    res = accounting.run([SYSTEMCTL_BIN_PATH, 'is-active', service], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return res.returncode == 0
 
 
+@query_cache.cached_query(query_cache.SERVICES_EXISTS_QUERIES)
 def get_required_services(service: str) -> typing.List[str]:
-    res = subprocess.run(
+    res = accounting.run(
         [SYSTEMCTL_BIN_PATH, 'show', '--property', 'Requires', service],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -37,10 +40,11 @@ def get_required_services(service: str) -> typing.List[str]:
     return required_services
 
 
+@query_cache.cached_query(query_cache.SERVICES_ENABLED_QUERIES)
 def is_service_masked(service: str) -> bool:
     # is-enabled for masked service will return return code 1
     # so don't check operation result by the standard subprocess.run() way
-    res = subprocess.run(
+    res = accounting.run(
         [SYSTEMCTL_BIN_PATH, 'is-enabled', service],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -79,10 +83,13 @@ def is_service_startable(
     return True
 
 
+@query_cache.invalidates_queries(*query_cache.SERVICES_QUERIES)
 def reload_systemd_daemon():
     util.logged_check_call([SYSTEMCTL_BIN_PATH, "daemon-reload"])
 
 
+# systemd also starts required units and stops dependent ones, so states of all services could be changed
+@query_cache.invalidates_queries(query_cache.SERVICES_ACTIVE_QUERIES)
 def start_services(services: typing.List[str]):
     existed_services = [service for service in services if is_service_exists(service)]
     if not existed_services:
@@ -91,6 +98,7 @@ def start_services(services: typing.List[str]):
     util.logged_check_call([SYSTEMCTL_BIN_PATH, "start"] + existed_services)
 
 
+@query_cache.invalidates_queries(query_cache.SERVICES_ACTIVE_QUERIES)
 def stop_services(services: typing.List[str]):
     existed_services = [service for service in services if is_service_exists(service)]
     if not existed_services:
@@ -104,7 +112,10 @@ def enable_services(services: typing.List[str]):
     if not existed_services:
         return
 
-    util.logged_check_call([SYSTEMCTL_BIN_PATH, "enable"] + existed_services)
+    try:
+        util.logged_check_call([SYSTEMCTL_BIN_PATH, "enable"] + existed_services)
+    finally:
+        query_cache.invalidate_services_queries(query_cache.SERVICES_ENABLED_QUERIES, existed_services)
 
 
 def disable_services(services: typing.List[str]):
@@ -112,9 +123,13 @@ def disable_services(services: typing.List[str]):
     if not existed_services:
         return
 
-    util.logged_check_call([SYSTEMCTL_BIN_PATH, "disable"] + existed_services)
+    try:
+        util.logged_check_call([SYSTEMCTL_BIN_PATH, "disable"] + existed_services)
+    finally:
+        query_cache.invalidate_services_queries(query_cache.SERVICES_ENABLED_QUERIES, existed_services)
 
 
+@query_cache.invalidates_queries(query_cache.SERVICES_ACTIVE_QUERIES)
 def restart_services(services: typing.List[str]):
     existed_services = [service for service in services if is_service_exists(service)]
     if not existed_services:
@@ -124,9 +139,10 @@ def restart_services(services: typing.List[str]):
 
 
 def do_reboot():
-    subprocess.call([SYSTEMCTL_BIN_PATH, "reboot"])
+    accounting.call([SYSTEMCTL_BIN_PATH, "reboot"])
 
 
+@query_cache.invalidates_queries(*query_cache.SERVICES_QUERIES)
 def add_systemd_service(service: str, content: str):
     with open(f"{SYSTEMCTL_SERVICES_PATH}/{service}", "w") as dst:
         dst.write(content)
@@ -134,6 +150,7 @@ def add_systemd_service(service: str, content: str):
     enable_services([service])
 
 
+@query_cache.invalidates_queries(*query_cache.SERVICES_QUERIES)
 def remove_systemd_service(service: str):
     service_config = f"{SYSTEMCTL_SERVICES_PATH}/{service}"
 
@@ -0,0 +1,125 @@
+# Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import json
+import os
+import threading
+import time
+import typing
+
+from . import log
+
+
+class Span():
+    """Timeline interval, stored as a complete event of Chrome trace-event format."""
+
+    __slots__ = ("tracer", "name", "category", "args", "start")
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: typing.Dict[str, typing.Any]):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self.args["error"] = str(exc_value)
+        self.tracer._add_event(self.name, self.category, self.start, time.perf_counter() - self.start, self.args)
+
+
+class NullSpan():
+    """Span of disabled tracer. Does nothing, so instrumentation is free when tracing is off."""
+
+    __slots__ = ("args",)
+
+    def __init__(self):
+        self.args = {}
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.args.clear()
+
+
+class Tracer():
+    """Collects spans in memory and saves them as trace-event json.
+
+    The file could be opened in Perfetto UI or chrome://tracing. Spans from the same
+    thread are nested on the timeline by their time, so stages, actions and
+    subprocesses are shown as a tree.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.threads = {}
+        self._null_span = NullSpan()
+        self._origin = time.perf_counter()
+
+    def enable(self) -> None:
+        self.events = []
+        self.threads = {}
+        self._origin = time.perf_counter()
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def span(self, name: str, category: str, **args) -> typing.Union[Span, NullSpan]:
+        if not self.enabled:
+            return self._null_span
+        return Span(self, name, category, args)
+
+    def _add_event(self, name: str, category: str, start: float, duration: float, args: typing.Dict[str, typing.Any]) -> None:
+        thread = threading.current_thread()
+        # list.append and dict item assignment are atomic, so no lock is required here
+        self.threads[thread.ident] = thread.name
+        self.events.append((name, category, start, duration, thread.ident, args))
+
+    def to_trace_events(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        pid = os.getpid()
+        trace_events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}}
+                        for tid, thread_name in self.threads.items()]
+
+        for name, category, start, duration, tid, args in self.events:
+            trace_events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((start - self._origin) * 1000000),
+                "dur": round(duration * 1000000),
+                "pid": pid,
+                "tid": tid,
+                "args": {key: str(value) for key, value in args.items()},
+            })
+
+        return trace_events
+
+    def save(self, path: str) -> None:
+        log.debug("Going to write execution trace into '{path}'".format(path=path))
+        with open(path + ".next", "w") as dst:
+            json.dump({"traceEvents": self.to_trace_events(), "displayTimeUnit": "ms"}, dst)
+        os.replace(path + ".next", path)
+
+
+tracer = Tracer()
+
+
+def enable_tracing() -> None:
+    tracer.enable()
+
+
+def disable_tracing() -> None:
+    tracer.disable()
+
+
+def span(name: str, category: str, **args) -> typing.Union[Span, NullSpan]:
+    return tracer.span(name, category, **args)
+
+
+def save_trace(path: str) -> None:
+    tracer.save(path)
@@ -1,32 +1,274 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import asyncio
+import collections
 import subprocess
+import threading
+import time
 import typing
 
-from . import log
+from . import accounting, cassette, log, tracing
 
 
-def logged_check_call(cmd: str, **kwargs) -> None:
-    log.info("Running: {cmd!s}. Output:".format(cmd=cmd))
+# Lines longer than the limit are skipped, we don't expect anything like this from package managers
+COMMAND_OUTPUT_LINE_LIMIT = 1024 * 1024
+# Number of last output lines kept in memory to describe a failure of a command
+COMMAND_OUTPUT_TAIL_SIZE = 100
+
+# Time given to a timed out command to stop after SIGTERM, before it is killed by SIGKILL
+COMMAND_TERMINATION_GRACE_PERIOD = 30
+
+_last_failed_command_lock = threading.Lock()
+_last_failed_command_output = []
+
+# Default limits of logged_check_call commands in seconds, None means no limit
+_command_timeout = None
+_command_inactivity_timeout = None
+
+_running_commands_lock = threading.Lock()
+_running_commands = []
+
+
+def set_command_timeouts(timeout: typing.Optional[float] = None, inactivity_timeout: typing.Optional[float] = None) -> None:
+    """Set default limits for commands started by logged_check_call. The timeout limits the whole
+    command run, the inactivity timeout limits time since the last output line of the command."""
+    global _command_timeout, _command_inactivity_timeout
+    _command_timeout = timeout
+    _command_inactivity_timeout = inactivity_timeout
+
+
+class CommandHeartbeat():
+    """Liveness information of a running command, updated on every output line."""
+
+    def __init__(self, cmd: typing.Union[str, typing.List[str]], pid: int):
+        self.cmd = cmd
+        self.pid = pid
+        self.started_at = time.monotonic()
+        self.last_output_at = self.started_at
+        self.last_line = None
+
+    def beat(self, line: str) -> None:
+        self.last_output_at = time.monotonic()
+        self.last_line = line
+
+    def get_running_time(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def get_silence_time(self) -> float:
+        return time.monotonic() - self.last_output_at
+
+    def get_wait_time(self, timeout: typing.Optional[float], inactivity_timeout: typing.Optional[float]) -> typing.Optional[float]:
+        limits = []
+        if timeout is not None:
+            limits.append(timeout - self.get_running_time())
+        if inactivity_timeout is not None:
+            limits.append(inactivity_timeout - self.get_silence_time())
+
+        if not limits:
+            return None
+        return max(0, min(limits))
+
+    def get_expiration(self, timeout: typing.Optional[float],
+                       inactivity_timeout: typing.Optional[float]) -> typing.Optional[typing.Tuple[str, float]]:
+        if timeout is not None and self.get_running_time() >= timeout:
+            return f"is running for more than {timeout} seconds", timeout
+        if inactivity_timeout is not None and self.get_silence_time() >= inactivity_timeout:
+            return f"produced no output for {inactivity_timeout} seconds", inactivity_timeout
+        return None
+
+
+def get_running_commands() -> typing.List[CommandHeartbeat]:
+    with _running_commands_lock:
+        return list(_running_commands)
+
+
+def get_last_failed_command_output() -> typing.List[str]:
+    """Last output lines of the most recent failed command, without reading of the log file."""
+    with _last_failed_command_lock:
+        return list(_last_failed_command_output)
+
+
+def _remember_failed_command(cmd: typing.Union[str, typing.List[str]], returncode: int,
+                             output_tail: typing.List[str]) -> subprocess.CalledProcessError:
+    global _last_failed_command_output
+    with _last_failed_command_lock:
+        _last_failed_command_output = output_tail
+
+    log.err(f"Command '{cmd}' failed with return code {returncode}")
+    return subprocess.CalledProcessError(returncode, cmd, output="\n".join(output_tail))
+
+
+def _remember_timed_out_command(cmd: typing.Union[str, typing.List[str]], expiration: typing.Tuple[str, float],
+                                output_tail: typing.List[str]) -> subprocess.TimeoutExpired:
+    global _last_failed_command_output
+    with _last_failed_command_lock:
+        _last_failed_command_output = output_tail
+
+    reason, limit = expiration
+    log.err(f"Command '{cmd}' was stopped because it {reason}")
+    return subprocess.TimeoutExpired(cmd, limit, output="\n".join(output_tail))
+
 
+async def _terminate_process(process: subprocess.Popen, wait_future: asyncio.Future) -> int:
+    process.terminate()
+    try:
+        return await asyncio.wait_for(asyncio.shield(wait_future), COMMAND_TERMINATION_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        log.warn(f"Process {process.pid} is still running {COMMAND_TERMINATION_GRACE_PERIOD} seconds after SIGTERM, sending SIGKILL")
+        process.kill()
+        return await wait_future
+
+
+async def _stream_command(cmd: typing.Union[str, typing.List[str]], kwargs: typing.Dict[str, typing.Any], prefix: str = "",
+                          timeout: typing.Optional[float] = None, inactivity_timeout: typing.Optional[float] = None
+                          ) -> typing.Tuple[int, typing.List[str], typing.Optional[typing.Tuple[str, float]]]:
+    output_tail = collections.deque(maxlen=COMMAND_OUTPUT_TAIL_SIZE)
+    active_cassette = cassette.get_active_cassette()
+    replaying = active_cassette is not None and active_cassette.replaying
+    recording = active_cassette is not None and not replaying
+    if replaying:
+        process = active_cassette.replay_process(cmd)
+    else:
+        # The process is reaped by os.wait4, so resources it used are accounted to the current action
+        process = accounting.AccountedPopen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    recorded_lines = []
+    heartbeat = CommandHeartbeat(cmd, process.pid)
+    expiration = None
+
+    with _running_commands_lock:
+        _running_commands.append(heartbeat)
+
+    try:
+        with tracing.span(" ".join(cmd) if isinstance(cmd, list) else str(cmd), "subprocess", pid=process.pid) as span:
+            loop = asyncio.get_event_loop()
+            if replaying:
+                reader, transport = process.stdout, None
+            else:
+                reader = asyncio.StreamReader(limit=COMMAND_OUTPUT_LINE_LIMIT)
+                transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), process.stdout)
+            try:
+                while True:
+                    try:
+                        line = await asyncio.wait_for(reader.readline(), heartbeat.get_wait_time(timeout, inactivity_timeout))
+                    except asyncio.TimeoutError:
+                        expiration = heartbeat.get_expiration(timeout, inactivity_timeout)
+                        break
+                    except ValueError:
+                        log.warn(f"Too long line in output of '{cmd}' is skipped")
+                        continue
+
+                    if not line:
+                        break
+
+                    line = line.decode("utf-8", errors="replace").strip()
+                    if line:
+                        log.info(prefix + line, to_stream=False)
+                        output_tail.append(line)
+                        heartbeat.beat(line)
+                        if recording:
+                            recorded_lines.append((round(heartbeat.get_running_time(), 6), line))
+            finally:
+                if transport is not None:
+                    transport.close()
+
+            # We wait for the process in a thread instead of asyncio subprocess support, because
+            # before python 3.8 asyncio child watcher works only with an event loop from the main thread
+            wait_future = loop.run_in_executor(None, process.wait)
+            if expiration is None:
+                try:
+                    returncode = await asyncio.wait_for(asyncio.shield(wait_future), heartbeat.get_wait_time(timeout, inactivity_timeout))
+                except asyncio.TimeoutError:
+                    expiration = heartbeat.get_expiration(timeout, inactivity_timeout)
+
+            if expiration is not None:
+                log.warn(f"Command '{cmd}' {expiration[0]}, sending SIGTERM to process {process.pid}")
+                returncode = await _terminate_process(process, wait_future)
+                span.args["expired"] = expiration[0]
+
+            span.args["returncode"] = returncode
+            if process.usage is not None:
+                span.args["user_time"] = process.usage.user_time
+                span.args["system_time"] = process.usage.system_time
+
+        if recording:
+            active_cassette.record(cmd, None, None, None, returncode, heartbeat.get_running_time(), recorded_lines)
+    finally:
+        with _running_commands_lock:
+            _running_commands.remove(heartbeat)
+
+    return returncode, list(output_tail), expiration
+
+
+def _run_coroutine(coroutine: typing.Awaitable) -> typing.Any:
+    # asyncio.run is not available in python 3.6, so we manage the loop by ourselves
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _prepare_command_kwargs(kwargs: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
     # I beleive we should be able pass argument to the subprocess function
-    # from the caller. So we have to inject stdout/stderr/universal_newlines
-    kwargs["stdout"] = subprocess.PIPE
-    kwargs["stderr"] = subprocess.STDOUT
-    kwargs["universal_newlines"] = True
+    # from the caller. But output is always captured by us and decoded line by line
+    for key in ("stdout", "stderr", "universal_newlines", "text"):
+        kwargs.pop(key, None)
+    return kwargs
 
-    process = subprocess.Popen(cmd, **kwargs)
-    while None is process.poll():
-        line = process.stdout.readline()
-        if line and line.strip():
-            log.info(line.strip(), to_stream=False)
 
-    if process.returncode != 0:
-        log.err(f"Command '{cmd}' failed with return code {process.returncode}")
-        raise subprocess.CalledProcessError(process.returncode, cmd)
+def _get_command_limits(timeout: typing.Optional[float],
+                        inactivity_timeout: typing.Optional[float]) -> typing.Tuple[typing.Optional[float], typing.Optional[float]]:
+    return (timeout if timeout is not None else _command_timeout,
+            inactivity_timeout if inactivity_timeout is not None else _command_inactivity_timeout)
+
+
+def logged_check_call(cmd: typing.Union[str, typing.List[str]], timeout: typing.Optional[float] = None,
+                      inactivity_timeout: typing.Optional[float] = None, **kwargs) -> None:
+    """Run the command and stream its output into the log. When the command exceeds the timeout
+    or the inactivity timeout (defaults are set by set_command_timeouts), it is terminated
+    and subprocess.TimeoutExpired is raised."""
+    log.info("Running: {cmd!s}. Output:".format(cmd=cmd))
+
+    timeout, inactivity_timeout = _get_command_limits(timeout, inactivity_timeout)
+    returncode, output_tail, expiration = _run_coroutine(_stream_command(cmd, _prepare_command_kwargs(kwargs), "",
+                                                                         timeout, inactivity_timeout))
+    if expiration is not None:
+        raise _remember_timed_out_command(cmd, expiration, output_tail)
+    if returncode != 0:
+        raise _remember_failed_command(cmd, returncode, output_tail)
 
     log.info("Command '{cmd}' finished successfully".format(cmd=cmd))
 
 
+def logged_check_call_concurrently(cmds: typing.List[typing.Union[str, typing.List[str]]], timeout: typing.Optional[float] = None,
+                                   inactivity_timeout: typing.Optional[float] = None, **kwargs) -> None:
+    """Run several commands at the same time and stream their output into the log.
+    Every output line is prefixed with the index of the command. When some commands fail,
+    CalledProcessError is raised for the first one of them after all commands are finished.
+    Limits are applied to every command separately, like in logged_check_call."""
+    kwargs = _prepare_command_kwargs(kwargs)
+    timeout, inactivity_timeout = _get_command_limits(timeout, inactivity_timeout)
+    for cmd in cmds:
+        log.info("Running: {cmd!s}. Output:".format(cmd=cmd))
+
+    async def run_all() -> typing.List[typing.Tuple[int, typing.List[str], typing.Optional[typing.Tuple[str, float]]]]:
+        return await asyncio.gather(*[_stream_command(cmd, dict(kwargs), "[{}] ".format(index), timeout, inactivity_timeout)
+                                      for index, cmd in enumerate(cmds)])
+
+    results = _run_coroutine(run_all())
+
+    errors = []
+    for cmd, (returncode, output_tail, expiration) in zip(cmds, results):
+        if expiration is not None:
+            errors.append(_remember_timed_out_command(cmd, expiration, output_tail))
+        elif returncode != 0:
+            errors.append(_remember_failed_command(cmd, returncode, output_tail))
+        else:
+            log.info("Command '{cmd}' finished successfully".format(cmd=cmd))
+
+    if errors:
+        raise errors[0]
+
+
 def merge_dicts_of_lists(dict1: typing.Dict[typing.Any, typing.Any],
                          dict2: typing.Dict[typing.Any, typing.Any]) -> typing.Dict[typing.Any, typing.Any]:
     for key, value in dict2.items():
@@ -1,4 +1,9 @@
 # Copyright 1999 - 2024. WebPros International GmbH. All rights reserved.
+import functools
+import re
+import string
+import typing
+
 
 class KernelVersion():
     """Linux kernel version representation class."""
@@ -78,16 +83,13 @@ class KernelVersion():
         return result
 
     def __lt__(self, other):
-        if self.major < other.major or self.minor < other.minor or self.patch < other.patch:
-            return True
-
-        for build_part_left, build_part_right in zip(self.build.split("."), other.build.split(".")):
-            if int(build_part_left) < int(build_part_right):
-                return True
-            elif int(build_part_left) > int(build_part_right):
-                return False
+        # Parts are compared one by one, a later part matters only if all previous ones are equal
+        main_part = (int(self.major), int(self.minor), int(self.patch))
+        other_main_part = (int(other.major), int(other.minor), int(other.patch))
+        if main_part != other_main_part:
+            return main_part < other_main_part
 
-        return len(self.build) < len(other.build)
+        return rpmvercmp(str(self.build), str(other.build)) < 0
 
     def __eq__(self, other):
         return self.major == other.major and self.minor == other.minor and self.patch == other.patch and self.build == other.build
@@ -146,3 +148,165 @@ class PHPVersion():
 
     def __ge__(self, other):
         return not self.__lt__(other)
+
+
+# Kinds of version segments in the order used by rpmvercmp: tilde sorts before anything,
+# even before the end of the string, and caret sorts after the end, but before anything else
+_RPM_TILDE, _RPM_END, _RPM_CARET, _RPM_ALPHA, _RPM_NUMERIC = range(5)
+# Everything except ASCII letters, digits, tilde and caret is a separator
+_RPM_SEGMENT_REGEX = re.compile(r"~|\^|[0-9]+|[a-zA-Z]+")
+_RPM_NEVRA_REGEX = re.compile(r"^(?:(?P<epoch>\d+):)?(?P<name>\S+)-(?:(?P<name_epoch>\d+):)?(?P<version>[^-:\s]+)-(?P<release>[^-:\s]+)\.(?P<arch>[^.\s-]+)$")
+# Packages without arch, like gpg-pubkey, are shown by rpm as N-V-R
+_RPM_NEVR_REGEX = re.compile(r"^(?:(?P<epoch>\d+):)?(?P<name>\S+)-(?:(?P<name_epoch>\d+):)?(?P<version>[^-:\s]+)-(?P<release>[^-:\s]+)$")
+RPM_KEYS_CACHE_SIZE = 16384
+
+
+@functools.lru_cache(maxsize=RPM_KEYS_CACHE_SIZE)
+def rpm_version_key(version: str) -> typing.Tuple[typing.Tuple[typing.Any, ...], ...]:
+    """Sort key of version or release string. Keys are ordered just like rpmvercmp orders the strings."""
+    key = []
+    for segment in _RPM_SEGMENT_REGEX.findall(version):
+        if segment == "~":
+            key.append((_RPM_TILDE,))
+        elif segment == "^":
+            key.append((_RPM_CARET,))
+        elif segment.isdigit():
+            # Leading zeros are not significant
+            key.append((_RPM_NUMERIC, int(segment)))
+        else:
+            key.append((_RPM_ALPHA, segment))
+    key.append((_RPM_END,))
+    return tuple(key)
+
+
+def rpmvercmp(left: str, right: str) -> int:
+    """Comparison of version or release strings by the rpmvercmp algorithm. Returns -1, 0 or 1."""
+    left_key, right_key = rpm_version_key(left), rpm_version_key(right)
+    return (left_key > right_key) - (left_key < right_key)
+
+
+@functools.lru_cache(maxsize=RPM_KEYS_CACHE_SIZE)
+def split_rpm_evr(evr: str) -> typing.Tuple[int, str, typing.Optional[str]]:
+    """Split "[epoch:]version[-release]" string. Missing epoch is 0, missing release is None."""
+    epoch, _, version_release = evr.rpartition(":")
+    version, _, release = version_release.partition("-")
+    return int(epoch) if epoch else 0, version, release if release else None
+
+
+@functools.lru_cache(maxsize=RPM_KEYS_CACHE_SIZE)
+def split_rpm_nevra(nevra: str) -> typing.Optional[typing.Tuple[str, typing.Optional[str], str, str, typing.Optional[str]]]:
+    """Split "[E:]N-[E:]V-R[.A]" string into name, epoch, version, release and arch.
+    Arch is None for the form without it. None is returned for anything else."""
+    nevra = nevra.strip()
+    match = _RPM_NEVRA_REGEX.match(nevra)
+    if match is None:
+        match = _RPM_NEVR_REGEX.match(nevra)
+        if match is None:
+            return None
+
+    epoch = match.group("epoch") or match.group("name_epoch")
+    return match.group("name"), epoch, match.group("version"), match.group("release"), match.groupdict().get("arch")
+
+
+def rpm_evr_key(evr: str) -> typing.Tuple[typing.Any, ...]:
+    """Sort key of "[epoch:]version[-release]" string.
+
+    Unlike compare_rpm_versions, which skips release when one of versions has no release,
+    the key needs a total order, so a version without release sorts before the same version
+    with any release.
+    """
+    epoch, version, release = split_rpm_evr(evr)
+    return epoch, rpm_version_key(version), rpm_version_key(release or "")
+
+
+def rpm_nevra_key(nevra: str) -> typing.Tuple[typing.Any, ...]:
+    """Sort key of "[E:]N-[E:]V-R[.A]" string: by name, then by version, then by arch."""
+    parts = split_rpm_nevra(nevra)
+    if parts is None:
+        raise ValueError(f"Cannot parse rpm package NEVRA '{nevra}'")
+
+    name, epoch, version, release, arch = parts
+    # Package without arch goes before the same package with any arch
+    return name, int(epoch) if epoch else 0, rpm_version_key(version), rpm_version_key(release), arch or ""
+
+
+def sort_rpm_versions(versions: typing.Iterable[str], reverse: bool = False) -> typing.List[str]:
+    return sorted(versions, key=rpm_evr_key, reverse=reverse)
+
+
+def sort_rpm_nevras(nevras: typing.Iterable[str], reverse: bool = False) -> typing.List[str]:
+    """Sort NEVRAs without any call to rpm, so thousands of packages are sorted in a moment."""
+    return sorted(nevras, key=rpm_nevra_key, reverse=reverse)
+
+
+def compare_rpm_versions(left: str, right: str) -> int:
+    """Compare rpm versions in "[epoch:]version[-release]" form. Returns -1, 0 or 1."""
+    left_epoch, left_version, left_release = split_rpm_evr(left)
+    right_epoch, right_version, right_release = split_rpm_evr(right)
+    if left_epoch != right_epoch:
+        return 1 if left_epoch > right_epoch else -1
+
+    result = rpmvercmp(left_version, right_version)
+    # Just like rpm, release is compared only if both versions have it
+    if result == 0 and left_release is not None and right_release is not None:
+        result = rpmvercmp(left_release, right_release)
+    return result
+
+
+def _deb_order(char: str) -> int:
+    if char == "~":
+        return -1
+    if not char or char in string.digits:
+        return 0
+    if char in string.ascii_letters:
+        return ord(char)
+    return ord(char) + 256
+
+
+def _deb_vercmp(left: str, right: str) -> int:
+    """Comparison of upstream version or revision strings by the dpkg algorithm."""
+    i, j = 0, 0
+    while i < len(left) or j < len(right):
+        while (i < len(left) and left[i] not in string.digits) or (j < len(right) and right[j] not in string.digits):
+            left_order, right_order = _deb_order(left[i:i + 1]), _deb_order(right[j:j + 1])
+            if left_order != right_order:
+                return 1 if left_order > right_order else -1
+            i, j = i + 1, j + 1
+
+        while i < len(left) and left[i] == "0":
+            i += 1
+        while j < len(right) and right[j] == "0":
+            j += 1
+
+        first_difference = 0
+        while i < len(left) and left[i] in string.digits and j < len(right) and right[j] in string.digits:
+            if not first_difference and left[i] != right[j]:
+                first_difference = 1 if left[i] > right[j] else -1
+            i, j = i + 1, j + 1
+
+        if i < len(left) and left[i] in string.digits:
+            return 1
+        if j < len(right) and right[j] in string.digits:
+            return -1
+        if first_difference:
+            return first_difference
+
+    return 0
+
+
+def compare_deb_versions(left: str, right: str) -> int:
+    """Compare debian versions in "[epoch:]upstream[-revision]" form. Returns -1, 0 or 1."""
+    # Upstream version may contain colons when there is an epoch, so only the first one separates the epoch
+    left_epoch, _, left_rest = left.partition(":") if ":" in left else ("0", "", left)
+    right_epoch, _, right_rest = right.partition(":") if ":" in right else ("0", "", right)
+    if int(left_epoch) != int(right_epoch):
+        return 1 if int(left_epoch) > int(right_epoch) else -1
+
+    # Revision is everything after the last hyphen, so upstream version may contain hyphens
+    left_upstream, _, left_revision = left_rest.rpartition("-") if "-" in left_rest else (left_rest, "", "")
+    right_upstream, _, right_revision = right_rest.rpartition("-") if "-" in right_rest else (right_rest, "", "")
+
+    result = _deb_vercmp(left_upstream, right_upstream)
+    if result == 0:
+        result = _deb_vercmp(left_revision, right_revision)
+    return result
@@ -0,0 +1,65 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import json
+import os
+import subprocess
+import unittest
+
+import src.accounting as accounting
+
+
+class ResourcesUsageTests(unittest.TestCase):
+    SUMMARY_FILE = "resources_usage.json"
+
+    def tearDown(self):
+        if os.path.exists(self.SUMMARY_FILE):
+            os.remove(self.SUMMARY_FILE)
+
+    def test_not_accounted_outside_of_context(self):
+        usage = accounting.ResourcesUsage()
+        accounting.run(["/bin/true"])
+        self.assertEqual(usage.get_summary()["total"]["commands"], 0)
+
+    def test_run_is_accounted(self):
+        usage = accounting.ResourcesUsage()
+        with accounting.accounted_to(usage, "stage", "action"):
+            result = accounting.run(["/bin/sh", "-c", "echo out; exit 3"], stdout=subprocess.PIPE, universal_newlines=True)
+
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stdout, "out\n")
+        self.assertEqual(len(usage.records), 1)
+        record = usage.records[0]
+        self.assertEqual((record.stage, record.action), ("stage", "action"))
+        self.assertGreater(record.max_rss_kb, 0)
+        self.assertGreaterEqual(record.wall_time, 0)
+
+    def test_check_output_and_call(self):
+        usage = accounting.ResourcesUsage()
+        with accounting.accounted_to(usage, "stage", "action"):
+            self.assertEqual(accounting.check_output(["/bin/echo", "value"], universal_newlines=True), "value\n")
+            self.assertEqual(accounting.call(["/bin/false"]), 1)
+            with self.assertRaises(subprocess.CalledProcessError):
+                accounting.check_output(["/bin/false"])
+            accounting.run(["/bin/cat"], input=b"data", stdout=subprocess.DEVNULL)
+
+        self.assertEqual(len(usage.records), 4)
+
+    def test_summary_aggregation(self):
+        usage = accounting.ResourcesUsage()
+        with accounting.accounted_to(usage, "first stage", "first"):
+            accounting.call(["/bin/true"])
+            with accounting.accounted_to(usage, "first stage", "second"):
+                accounting.call(["/bin/true"])
+            accounting.call(["/bin/true"])
+        with accounting.accounted_to(usage, "second stage", "third"):
+            accounting.call(["/bin/true"])
+
+        usage.save(self.SUMMARY_FILE)
+        with open(self.SUMMARY_FILE) as summary_file:
+            summary = json.load(summary_file)
+
+        self.assertEqual(summary["total"]["commands"], 4)
+        self.assertEqual(summary["stages"]["first stage"]["commands"], 3)
+        self.assertEqual(summary["stages"]["second stage"]["commands"], 1)
+        self.assertEqual({name: value["commands"] for name, value in summary["actions"].items()},
+                         {"first": 2, "second": 1, "third": 1})
+        self.assertIn("cpu_utilization", summary["total"])
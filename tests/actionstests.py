@@ -3,7 +3,17 @@ import unittest
 from unittest import mock
 
 import os
+import signal
+import subprocess
+import threading
+import time
+
+import src.accounting as accounting
 import src.action as action
+import src.checks_cache as checks_cache
+import src.durations as durations
+import src.packages as packages
+import src.util as util
 
 
 class SimpleAction(action.ActiveAction):
@@ -102,6 +112,247 @@ class TestPrepareActionsFlow(unittest.TestCase):
         skip_action._prepare_action.assert_not_called()
 
 
+class ConcurrentAction(action.ActiveAction):
+    concurrent = True
+
+    def __init__(self, name, calls, depends_on=None, resources=None, work=None):
+        self.name = name
+        self.description = name
+        self.calls = calls
+        self.depends_on = depends_on if depends_on is not None else []
+        self.resources = resources if resources is not None else []
+        self.work = work
+
+    def _prepare_action(self):
+        if self.work is not None:
+            self.work()
+        self.calls.append(self.name)
+
+    def _post_action(self):
+        pass
+
+    def _revert_action(self):
+        pass
+
+
+class TestParallelPrepareActionsFlow(unittest.TestCase):
+
+    def setUp(self):
+        with open("actions.json", "w") as actions_data_file:
+            actions_data_file.write("{ \"actions\": [] }")
+
+    def tearDown(self):
+        os.remove("actions.json")
+
+    def test_independent_actions_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        calls = []
+        actions = [ConcurrentAction("first", calls, work=barrier.wait),
+                   ConcurrentAction("second", calls, work=barrier.wait)]
+
+        with PrepareActionsFlowForTests({1: actions}, max_workers=2) as flow:
+            self.assertTrue(flow.pass_actions())
+
+        self.assertEqual(sorted(calls), ["first", "second"])
+
+    def test_dependencies_are_respected(self):
+        calls = []
+        actions = [ConcurrentAction("first", calls, work=lambda: time.sleep(0.1)),
+                   ConcurrentAction("second", calls, depends_on=["first"]),
+                   ConcurrentAction("third", calls, resources=["yum"], work=lambda: time.sleep(0.1)),
+                   ConcurrentAction("fourth", calls, resources=["yum"])]
+
+        with PrepareActionsFlowForTests({1: actions}, max_workers=4) as flow:
+            self.assertTrue(flow.pass_actions())
+
+        self.assertLess(calls.index("first"), calls.index("second"))
+        self.assertLess(calls.index("third"), calls.index("fourth"))
+
+    def test_non_concurrent_action_is_barrier(self):
+        calls = []
+        barrier_action = SimpleAction()
+        barrier_action._prepare_action = lambda: calls.append("barrier")
+        actions = [ConcurrentAction("first", calls, work=lambda: time.sleep(0.1)),
+                   barrier_action,
+                   ConcurrentAction("second", calls)]
+
+        with PrepareActionsFlowForTests({1: actions}, max_workers=4) as flow:
+            self.assertTrue(flow.pass_actions())
+
+        self.assertEqual(calls, ["first", "barrier", "second"])
+
+    def test_fail_fast(self):
+        calls = []
+
+        def fail():
+            raise Exception("failure")
+
+        actions = [ConcurrentAction("failed", calls, work=fail),
+                   ConcurrentAction("dependent", calls, depends_on=["failed"])]
+
+        with PrepareActionsFlowForTests({1: actions, 2: [ConcurrentAction("next stage", calls)]}, max_workers=2) as flow:
+            self.assertFalse(flow.pass_actions())
+            self.assertTrue(flow.is_failed())
+
+        self.assertEqual(calls, [])
+        self.assertEqual(dict(flow.actions_states.items()), {"failed": action.ActionState.failed})
+
+    def test_failed_command_output_is_exposed(self):
+        def fail():
+            raise subprocess.CalledProcessError(1, ["yum"], output="first\nsecond")
+
+        with PrepareActionsFlowForTests({1: [ConcurrentAction("failed", [], work=fail)]}) as flow:
+            self.assertFalse(flow.pass_actions())
+            self.assertEqual(flow.get_error_output(), ["first", "second"])
+
+    def test_resources_usage_per_stage_and_action(self):
+        actions = [ConcurrentAction("first", [], work=lambda: util.logged_check_call(["/bin/true"])),
+                   ConcurrentAction("second", [], work=lambda: accounting.run(["/bin/true"]))]
+
+        with PrepareActionsFlowForTests({"stage": actions}, max_workers=2) as flow:
+            self.assertTrue(flow.pass_actions())
+
+        usage = flow.get_resources_usage()
+        self.assertEqual(usage["total"]["commands"], 2)
+        self.assertEqual(usage["stages"]["stage"]["commands"], 2)
+        self.assertEqual(usage["actions"]["first"]["commands"], 1)
+        self.assertEqual(usage["actions"]["second"]["commands"], 1)
+
+    def test_packages_transaction_per_stage(self):
+        actions = [ConcurrentAction("first", [], work=lambda: packages.defer_install_packages(["a"])),
+                   ConcurrentAction("second", [], work=lambda: packages.defer_install_packages(["b"]))]
+
+        with mock.patch("src.packages.apply_packages_transaction") as apply:
+            with PrepareActionsFlowForTests({1: actions}, max_workers=2, packages_transactions=True) as flow:
+                self.assertTrue(flow.pass_actions())
+
+        apply.assert_called_once()
+        self.assertEqual(sorted(apply.call_args[0][0]), ["a", "b"])
+
+    def test_packages_transaction_failure_fails_requester(self):
+        actions = [ConcurrentAction("first", [], work=lambda: packages.defer_install_packages(["a"]))]
+
+        with mock.patch("src.packages.apply_packages_transaction", side_effect=Exception("broken")):
+            with PrepareActionsFlowForTests({1: actions, 2: [ConcurrentAction("next", [])]}, packages_transactions=True) as flow:
+                self.assertFalse(flow.pass_actions())
+                self.assertEqual(flow.actions_states.get_state("first"), action.ActionState.failed)
+                self.assertIsNone(flow.actions_states.get_state("next"))
+
+    def test_packages_of_failed_action_are_not_installed(self):
+        def fail():
+            packages.defer_install_packages(["x"])
+            raise Exception("broken")
+
+        actions = [ConcurrentAction("first", [], work=lambda: packages.defer_install_packages(["a"])),
+                   ConcurrentAction("failed", [], work=fail)]
+
+        with mock.patch("src.packages.apply_packages_transaction") as apply:
+            with PrepareActionsFlowForTests({1: actions}, packages_transactions=True) as flow:
+                self.assertFalse(flow.pass_actions())
+
+        apply.assert_called_once()
+        self.assertEqual(apply.call_args[0][0], ["a"])
+
+    def test_packages_transaction_is_cleared_on_exception(self):
+        actions = [ConcurrentAction("first", [], depends_on=["second"]), ConcurrentAction("second", [])]
+
+        with PrepareActionsFlowForTests({1: actions}, max_workers=2, packages_transactions=True) as flow:
+            with self.assertRaises(ValueError):
+                flow.pass_actions()
+
+        self.assertIsNone(packages._active_transaction)
+
+    def test_forward_dependency_is_rejected(self):
+        calls = []
+        actions = [ConcurrentAction("first", calls, depends_on=["second"]),
+                   ConcurrentAction("second", calls)]
+
+        with self.assertRaises(ValueError):
+            action.StageScheduler(actions, 2)
+
+
+class TestResumePrepareActionsFlow(unittest.TestCase):
+
+    def setUp(self):
+        with open("actions.json", "w") as actions_data_file:
+            actions_data_file.write("{\"name\":\"first\",\"state\":\"success\"}\n"
+                                    "{\"name\":\"second\",\"state\":\"failed\"}\n"
+                                    "{\"name\":\"third\",\"state\":\"success\"}\n")
+
+    def tearDown(self):
+        os.remove("actions.json")
+
+    def _make_actions(self, calls):
+        return [ConcurrentAction(name, calls) for name in ("first", "second", "third")]
+
+    def test_resume_from_first_incomplete_action(self):
+        calls = []
+        with PrepareActionsFlowForTests({1: self._make_actions(calls)}, resume=True) as flow:
+            self.assertTrue(flow.pass_actions())
+            self.assertEqual(flow.get_resumed_actions(), ["first"])
+
+        self.assertEqual(calls, ["second", "third"])
+
+    def test_resume_stops_on_not_applied_action(self):
+        calls = []
+        actions = self._make_actions(calls)
+        actions[0]._is_still_applied = lambda: False
+        with PrepareActionsFlowForTests({1: actions}, resume=True) as flow:
+            self.assertTrue(flow.pass_actions())
+            self.assertEqual(flow.get_resumed_actions(), [])
+
+        self.assertEqual(calls, ["first", "second", "third"])
+
+    def test_no_resume_by_default(self):
+        calls = []
+        with PrepareActionsFlowForTests({1: self._make_actions(calls)}) as flow:
+            self.assertTrue(flow.pass_actions())
+
+        self.assertEqual(calls, ["first", "second", "third"])
+
+    def test_resumed_actions_are_not_estimated(self):
+        with PrepareActionsFlowForTests({1: self._make_actions([])}, resume=True) as flow:
+            self.assertEqual(flow.get_total_time(), 2)
+
+
+class TestActionsDurationsInFlow(unittest.TestCase):
+    DURATIONS_FILE = "durations.json"
+
+    def setUp(self):
+        with open("actions.json", "w") as actions_data_file:
+            actions_data_file.write("{ \"actions\": [] }")
+
+    def tearDown(self):
+        for path in ("actions.json", self.DURATIONS_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_durations_are_recorded(self):
+        actions_durations = durations.ActionsDurations(self.DURATIONS_FILE)
+        with PrepareActionsFlowForTests({1: [SimpleAction(), SkipAction()]}, actions_durations=actions_durations) as flow:
+            flow.pass_actions()
+
+        stored = durations.ActionsDurations(self.DURATIONS_FILE).load()
+        self.assertEqual(list(stored.samples["prepare"].keys()), ["Simple action"])
+
+    def test_durations_are_accumulated_between_runs(self):
+        for _ in range(2):
+            actions_durations = durations.ActionsDurations(self.DURATIONS_FILE)
+            with PrepareActionsFlowForTests({1: [SimpleAction()]}, actions_durations=actions_durations) as flow:
+                flow.pass_actions()
+
+        stored = durations.ActionsDurations(self.DURATIONS_FILE)
+        self.assertEqual(len(stored.samples["prepare"]["Simple action"]), 2)
+
+    def test_estimate_uses_history(self):
+        actions_durations = durations.ActionsDurations(self.DURATIONS_FILE)
+        for seconds in (100, 110, 120):
+            actions_durations.record("prepare", "Simple action", seconds)
+
+        with PrepareActionsFlowForTests({1: [SimpleAction(), SkipAction()]}, actions_durations=actions_durations) as flow:
+            self.assertEqual(flow.get_total_time(), 111)
+
+
 class SavedAction(action.ActiveAction):
     def __init__(self):
         self.name = "saved"
@@ -229,6 +480,46 @@ class TestFinishActionsFlow(unittest.TestCase):
         saved_action._post_action.assert_not_called()
 
 
+class TestFlowPlan(unittest.TestCase):
+
+    def setUp(self):
+        with open("actions.json", "w") as actions_data_file:
+            actions_data_file.write("{ \"actions\": [] }")
+
+    def tearDown(self):
+        if os.path.exists("actions.json"):
+            os.remove("actions.json")
+
+    def test_requirement_is_evaluated_once(self):
+        simple_action = SimpleAction()
+        simple_action._is_required = mock.Mock(return_value=True)
+        simple_action._post_action = mock.Mock()
+        skip_action = SkipAction()
+        skip_action._post_action = mock.Mock()
+
+        with FinishActionsFlowForTests({1: [simple_action], 2: [skip_action]}) as flow:
+            plan = flow.make_plan(max_workers=2)
+            self.assertEqual(flow.get_total_time(), 1)
+            self.assertTrue(flow.pass_actions())
+
+        self.assertEqual([planned.required for planned in plan.stages[1]], [True])
+        self.assertEqual([planned.required for planned in plan.stages[2]], [False])
+        simple_action._is_required.assert_called_once()
+        simple_action._post_action.assert_called_once()
+        skip_action._post_action.assert_not_called()
+
+    def test_dry_run(self):
+        simple_action = SimpleAction()
+        simple_action._prepare_action = mock.Mock()
+
+        with PrepareActionsFlowForTests({1: [simple_action, SkipAction()]}) as flow:
+            self.assertTrue(flow.pass_actions(dry_run=True))
+            description = flow.plan.describe()
+
+        simple_action._prepare_action.assert_not_called()
+        self.assertEqual(description, ["Stage 1:", "\t[run ] Simple action (1 sec)", "\t[skip] Skip action (0 sec)", "Estimated time: 1 sec"])
+
+
 class RevertActionsFlowForTests(action.RevertActionsFlow):
     PATH_TO_ACTIONS_DATA = "./actions.json"
 
@@ -399,3 +690,235 @@ class TestCheckFlow(unittest.TestCase):
             flow.validate_actions()
             res = flow.make_checks()
             self.assertEqual(len(res), 5)
+
+
+class SlowCheckAction(action.CheckAction):
+    def __init__(self, name, result, work):
+        self.name = name
+        self.description = name
+        self.result = result
+        self.work = work
+
+    def _do_check(self):
+        self.work()
+        return self.result
+
+
+class TestConcurrentCheckFlow(unittest.TestCase):
+    def test_checks_run_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+        checks = [SlowCheckAction("first", False, barrier.wait),
+                  SlowCheckAction("second", True, barrier.wait),
+                  SlowCheckAction("third", False, barrier.wait)]
+
+        with action.CheckFlow(checks, max_workers=3) as flow:
+            res = flow.make_checks()
+
+        self.assertEqual(len(res), 2)
+        self.assertIn("first", res[0])
+        self.assertIn("third", res[1])
+
+    def test_result_order_is_deterministic(self):
+        checks = [SlowCheckAction("slow", False, lambda: time.sleep(0.2)),
+                  SlowCheckAction("fast", False, lambda: None)]
+
+        with action.CheckFlow(checks, max_workers=2) as flow:
+            res = flow.make_checks()
+
+        self.assertIn("slow", res[0])
+        self.assertIn("fast", res[1])
+
+    def test_check_timeout(self):
+        event = threading.Event()
+        checks = [SlowCheckAction("hanged", True, lambda: event.wait(5)),
+                  SlowCheckAction("fine", True, lambda: None)]
+
+        with action.CheckFlow(checks, max_workers=1, check_timeout=0.2) as flow:
+            res = flow.make_checks()
+        event.set()
+
+        self.assertEqual(len(res), 1)
+        self.assertIn("hanged", res[0])
+        self.assertIn("was not checked", res[0])
+
+    def test_none_result_is_not_met(self):
+        checks = [SlowCheckAction("none", None, lambda: None)]
+
+        for max_workers in (1, 2):
+            with action.CheckFlow(checks, max_workers=max_workers) as flow:
+                res = flow.make_checks()
+
+            self.assertEqual(len(res), 1)
+            self.assertIn("not met", res[0])
+
+    def test_timed_out_check_does_not_change_timings(self):
+        finished = threading.Event()
+
+        def work():
+            time.sleep(0.5)
+            finished.set()
+
+        with action.CheckFlow([SlowCheckAction("hanged", True, work)], check_timeout=0.1) as flow:
+            flow.make_checks()
+            self.assertTrue(finished.wait(5))
+            time.sleep(0.1)
+            timings = flow.get_checks_timings()
+
+        self.assertLess(timings[0][1], 0.4)
+
+    def test_timings_are_recorded(self):
+        checks = [SlowCheckAction("slow", True, lambda: time.sleep(0.1)), TrueCheckAction()]
+
+        with action.CheckFlow(checks) as flow:
+            flow.make_checks()
+            timings = flow.get_checks_timings()
+
+        self.assertEqual([name for name, _ in timings], ["slow", "true"])
+        self.assertGreaterEqual(timings[0][1], 0.1)
+
+    def test_exception_is_raised(self):
+        def fail():
+            raise RuntimeError("broken check")
+
+        with action.CheckFlow([SlowCheckAction("broken", True, fail)], max_workers=2) as flow:
+            with self.assertRaises(RuntimeError):
+                flow.make_checks()
+
+
+class FileCheckAction(action.CheckAction):
+    def __init__(self, path):
+        self.name = "file check"
+        self.description = "Checks file content"
+        self.path = path
+        self.calls = 0
+
+    def _get_inputs(self):
+        return checks_cache.CheckInputs(files=[self.path])
+
+    def _do_check(self):
+        self.calls += 1
+        with open(self.path) as f:
+            return f.read() == "good"
+
+
+class TestCachedCheckFlow(unittest.TestCase):
+    CACHE_FILE = "checks_cache.json"
+    CHECKED_FILE = "checked.txt"
+
+    def setUp(self):
+        with open(self.CHECKED_FILE, "w") as f:
+            f.write("bad")
+
+    def tearDown(self):
+        for path in (self.CACHE_FILE, self.CHECKED_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _make_checks(self, check, version="1.0"):
+        with action.CheckFlow([check], results_cache=checks_cache.ChecksCache(self.CACHE_FILE, version).load()) as flow:
+            return flow.make_checks()
+
+    def test_unchanged_inputs_are_taken_from_cache(self):
+        check = FileCheckAction(self.CHECKED_FILE)
+        self.assertEqual(len(self._make_checks(check)), 1)
+        self.assertEqual(len(self._make_checks(check)), 1)
+        self.assertEqual(check.calls, 1)
+
+    def test_changed_inputs_rerun_check(self):
+        check = FileCheckAction(self.CHECKED_FILE)
+        self.assertEqual(len(self._make_checks(check)), 1)
+
+        with open(self.CHECKED_FILE, "w") as f:
+            f.write("good")
+        os.utime(self.CHECKED_FILE, ns=(0, 0))
+
+        self.assertEqual(len(self._make_checks(check)), 0)
+        self.assertEqual(check.calls, 2)
+
+    def test_utility_upgrade_reruns_check(self):
+        check = FileCheckAction(self.CHECKED_FILE)
+        self._make_checks(check, "1.0")
+        self._make_checks(check, "1.1")
+        self.assertEqual(check.calls, 2)
+
+    def test_check_version_change_reruns_check(self):
+        check = FileCheckAction(self.CHECKED_FILE)
+        self._make_checks(check)
+        check.cache_version = "2"
+        self._make_checks(check)
+        self.assertEqual(check.calls, 2)
+
+    def test_checks_without_inputs_are_not_cached(self):
+        check = TrueCheckAction()
+        check._do_check = mock.Mock(return_value=True)
+        self._make_checks(check)
+        self._make_checks(check)
+        self.assertEqual(check._do_check.call_count, 2)
+
+
+class CollectingWriter():
+    def __init__(self):
+        self.messages = []
+
+    def write(self, message):
+        self.messages.append(message)
+
+
+class TestFlowProgressbar(unittest.TestCase):
+
+    def setUp(self):
+        with open("actions.json", "w") as actions_data_file:
+            actions_data_file.write("{ \"actions\": [] }")
+
+    def tearDown(self):
+        os.remove("actions.json")
+
+    def test_event_driven_redraws_on_changes(self):
+        calls = []
+        actions = [ConcurrentAction("first", calls, work=lambda: time.sleep(0.3)),
+                   ConcurrentAction("second", calls, work=lambda: time.sleep(0.3))]
+        writer = CollectingWriter()
+
+        with PrepareActionsFlowForTests({"stage": actions}) as flow:
+            progressbar = action.FlowProgressbar(flow, [writer], event_driven=True)
+            display_thread = threading.Thread(target=progressbar.display)
+            display_thread.start()
+            flow.pass_actions()
+            display_thread.join(5)
+
+        self.assertFalse(display_thread.is_alive())
+        self.assertTrue(any("action first" in message for message in writer.messages))
+        self.assertTrue(any("action second" in message for message in writer.messages))
+        for previous, current in zip(writer.messages, writer.messages[1:]):
+            self.assertNotEqual(previous, current)
+
+    def test_sigwinch_handler_is_restored(self):
+        previous_handler = signal.getsignal(signal.SIGWINCH)
+        actions = [ConcurrentAction("first", [], work=lambda: time.sleep(0.2))]
+
+        with PrepareActionsFlowForTests({"stage": actions}) as flow:
+            with action.FlowProgressbar(flow, [CollectingWriter()], event_driven=True) as progressbar:
+                # Installed by the main thread, so the size is cached even when displayed by a helper one
+                self.assertNotEqual(signal.getsignal(signal.SIGWINCH), previous_handler)
+                display_thread = threading.Thread(target=progressbar.display)
+                display_thread.start()
+                flow.pass_actions()
+                display_thread.join(5)
+                self.assertIsNotNone(progressbar._terminal_size)
+
+        self.assertEqual(signal.getsignal(signal.SIGWINCH), previous_handler)
+
+    def test_flow_without_notifications_is_polled(self):
+        flow = mock.Mock(spec=["get_total_time", "is_finished"])
+        flow.get_total_time.return_value = 10
+        with action.FlowProgressbar(flow, [CollectingWriter()], event_driven=True) as progressbar:
+            self.assertFalse(progressbar.event_driven)
+
+    def test_wait_state_change_returns_on_notify(self):
+        flow = PrepareActionsFlowForTests({})
+        version = flow.wait_state_change(None, 0)
+
+        threading.Timer(0.1, flow._notify_state_changed).start()
+        start_time = time.monotonic()
+        self.assertNotEqual(flow.wait_state_change(version, 5), version)
+        self.assertLess(time.monotonic() - start_time, 5)
@@ -0,0 +1,88 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import os
+import subprocess
+import time
+import unittest
+from unittest import mock
+
+import src.accounting as accounting
+import src.cassette as cassette
+import src.util as util
+
+
+class CassetteTests(unittest.TestCase):
+    CASSETTE_FILE = "cassette.json"
+
+    def tearDown(self):
+        cassette.stop_cassette()
+        if os.path.exists(self.CASSETTE_FILE):
+            os.remove(self.CASSETTE_FILE)
+
+    def _record(self, action):
+        cassette.start_recording(self.CASSETTE_FILE)
+        try:
+            action()
+        finally:
+            cassette.stop_cassette()
+
+    def test_replay_run(self):
+        self._record(lambda: (accounting.check_output(["/bin/echo", "recorded"], universal_newlines=True),
+                              accounting.run(["/bin/cat"], input=b"data", stdout=subprocess.PIPE),
+                              accounting.call(["/bin/sh", "-c", "exit 4"])))
+
+        cassette.start_replaying(self.CASSETTE_FILE, time_scale=0)
+        with mock.patch("src.accounting.AccountedPopen") as popen:
+            self.assertEqual(accounting.check_output(["/bin/echo", "recorded"], universal_newlines=True), "recorded\n")
+            self.assertEqual(accounting.run(["/bin/cat"], input=b"data", stdout=subprocess.PIPE).stdout, b"data")
+            self.assertEqual(accounting.call(["/bin/sh", "-c", "exit 4"]), 4)
+            popen.assert_not_called()
+
+    def test_replay_check_failure(self):
+        self._record(lambda: accounting.call(["/bin/false"]))
+
+        cassette.start_replaying(self.CASSETTE_FILE, time_scale=0)
+        with self.assertRaises(subprocess.CalledProcessError):
+            accounting.check_output(["/bin/false"])
+
+    def test_not_recorded_command(self):
+        self._record(lambda: accounting.call(["/bin/true"]))
+
+        cassette.start_replaying(self.CASSETTE_FILE, time_scale=0)
+        accounting.call(["/bin/true"])
+        with self.assertRaises(cassette.CassetteError):
+            accounting.call(["/bin/true"])
+        with self.assertRaises(cassette.CassetteError):
+            accounting.call(["/bin/false"])
+
+    def test_replay_streamed_command(self):
+        cmd = ["/bin/sh", "-c", "echo first; echo second; exit 2"]
+
+        def run():
+            with self.assertRaises(subprocess.CalledProcessError):
+                util.logged_check_call(cmd)
+        self._record(run)
+
+        cassette.start_replaying(self.CASSETTE_FILE, time_scale=0)
+        with mock.patch("src.util.log.info") as info, self.assertRaises(subprocess.CalledProcessError) as context:
+            util.logged_check_call(cmd)
+
+        self.assertEqual(context.exception.returncode, 2)
+        self.assertEqual(context.exception.output, "first\nsecond")
+        self.assertIn("second", [call.args[0] for call in info.call_args_list])
+
+    def test_scaled_timing(self):
+        cmd = ["/bin/sh", "-c", "echo started; sleep 0.4"]
+        self._record(lambda: util.logged_check_call(cmd))
+
+        cassette.start_replaying(self.CASSETTE_FILE, time_scale=0.25)
+        start = time.monotonic()
+        util.logged_check_call(cmd)
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_replayed_command_timeout(self):
+        cmd = ["/bin/sh", "-c", "echo started; sleep 0.5"]
+        self._record(lambda: util.logged_check_call(cmd))
+
+        cassette.start_replaying(self.CASSETTE_FILE)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            util.logged_check_call(cmd, timeout=0.1)
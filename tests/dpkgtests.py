@@ -0,0 +1,87 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import os
+import unittest
+from unittest import mock
+
+import src.dpkg as dpkg
+
+
+class DpkgStatusIndexTests(unittest.TestCase):
+    STATUS_FILE = "dpkg_status"
+    STATUS_CONTENT = """Package: bash
+Essential: yes
+Status: install ok installed
+Priority: required
+Architecture: amd64
+Version: 5.0-6ubuntu1.2
+Description: GNU Bourne Again SHell
+ Bash is an sh-compatible command language interpreter.
+ .
+ Package: fake continuation line
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Version: 2.31-0ubuntu9.9
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.31-0ubuntu9.9
+
+Package: mysql-server
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 8.0.32-0ubuntu0.20.04.2
+Conffiles:
+ /etc/mysql/my.cnf 1234
+
+Package: tzdata
+Status: install ok unpacked
+Architecture: all
+Version: 2023c-0ubuntu0.20.04.2
+"""
+
+    def setUp(self):
+        with open(self.STATUS_FILE, "w") as status_file:
+            status_file.write(self.STATUS_CONTENT)
+        self.cache = dpkg._StatusIndexCache(self.STATUS_FILE)
+
+    def tearDown(self):
+        os.remove(self.STATUS_FILE)
+
+    def test_installed_packages(self):
+        index = self.cache.get()
+        self.assertEqual(len(index), 5)
+        self.assertTrue(index.is_installed("bash"))
+        self.assertTrue(index.is_installed("tzdata"))
+        self.assertFalse(index.is_installed("mysql-server"))
+        self.assertFalse(index.is_installed("Package"))
+        self.assertFalse(index.is_installed("zsh"))
+
+    def test_architecture_qualified_names(self):
+        index = self.cache.get()
+        self.assertTrue(index.is_installed("libc6:i386"))
+        self.assertFalse(index.is_installed("bash:i386"))
+        self.assertTrue(index.is_installed("tzdata:amd64"))
+        self.assertEqual(sorted(index.get_arches("libc6")), ["amd64", "i386"])
+        self.assertEqual(index.get_versions("bash"), ["5.0-6ubuntu1.2"])
+
+    def test_index_is_reused_until_file_changes(self):
+        first = self.cache.get()
+        self.assertIs(self.cache.get(), first)
+
+        with open(self.STATUS_FILE, "a") as status_file:
+            status_file.write("\nPackage: zsh\nStatus: install ok installed\nArchitecture: amd64\nVersion: 5.8-3ubuntu1\n")
+        stat = os.stat(self.STATUS_FILE)
+        os.utime(self.STATUS_FILE, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+        second = self.cache.get()
+        self.assertIsNot(second, first)
+        self.assertTrue(second.is_installed("zsh"))
+
+    def test_module_queries_use_index(self):
+        with mock.patch("src.dpkg._status_index", self.cache), mock.patch("src.dpkg.accounting.run") as run:
+            self.assertEqual(dpkg.filter_installed_packages(["bash", "mysql-server", "libc6"]), ["bash", "libc6"])
+            self.assertTrue(dpkg.is_package_installed("bash"))
+            run.assert_not_called()
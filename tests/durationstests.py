@@ -0,0 +1,58 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import os
+import unittest
+
+import src.durations as durations
+
+
+class ActionsDurationsTests(unittest.TestCase):
+    DURATIONS_FILE = "durations.json"
+
+    def tearDown(self):
+        if os.path.exists(self.DURATIONS_FILE):
+            os.remove(self.DURATIONS_FILE)
+
+    def test_no_samples(self):
+        self.assertIsNone(durations.ActionsDurations(self.DURATIONS_FILE).load().estimate("prepare", "action"))
+
+    def test_median_estimate(self):
+        actions_durations = durations.ActionsDurations(self.DURATIONS_FILE)
+        for seconds in (10, 1000, 20, 30, 15):
+            actions_durations.record("prepare", "action", seconds)
+
+        self.assertEqual(actions_durations.estimate("prepare", "action"), 20)
+        self.assertIsNone(actions_durations.estimate("post", "action"))
+
+    def test_percentile_estimate(self):
+        actions_durations = durations.ActionsDurations(self.DURATIONS_FILE, percentile=90)
+        for seconds in range(1, 11):
+            actions_durations.record("revert", "action", seconds)
+
+        self.assertEqual(actions_durations.estimate("revert", "action"), 9)
+
+    def test_small_durations_rounded_up(self):
+        actions_durations = durations.ActionsDurations(self.DURATIONS_FILE)
+        actions_durations.record("prepare", "action", 0.01)
+
+        self.assertEqual(actions_durations.estimate("prepare", "action"), 1)
+
+    def test_only_last_samples_are_kept(self):
+        actions_durations = durations.ActionsDurations(self.DURATIONS_FILE)
+        for seconds in range(actions_durations.MAX_SAMPLES * 2):
+            actions_durations.record("prepare", "action", seconds)
+
+        self.assertEqual(len(actions_durations.samples["prepare"]["action"]), actions_durations.MAX_SAMPLES)
+        self.assertEqual(actions_durations.samples["prepare"]["action"][0], actions_durations.MAX_SAMPLES)
+
+    def test_save_and_load(self):
+        actions_durations = durations.ActionsDurations(self.DURATIONS_FILE)
+        actions_durations.record("post", "action", 42)
+        actions_durations.save()
+
+        self.assertEqual(durations.ActionsDurations(self.DURATIONS_FILE).load().estimate("post", "action"), 42)
+
+    def test_load_broken_file(self):
+        with open(self.DURATIONS_FILE, "w") as f:
+            f.write("{ broken")
+
+        self.assertEqual(durations.ActionsDurations(self.DURATIONS_FILE).load().samples, {})
@@ -2,6 +2,7 @@
 import os
 import unittest
 import zipfile
+from unittest import mock
 
 import src.feedback as feedback
 
@@ -65,3 +66,11 @@ class TestFeedback(unittest.TestCase):
         with zipfile.ZipFile(self.TARGET_FEEDBACK, "r") as zip_file:
             self.assertTrue("testfile" in zip_file.namelist())
             self.assertTrue("versions.txt" in zip_file.namelist())
+
+    def test_create_feedback_with_failed_command_output(self):
+        with mock.patch("src.util.get_last_failed_command_output", return_value=["first", "second"]):
+            test_feedback = feedback.Feedback("tests", "1.0.0-rev1", collect_actions=[feedback.collect_failed_command_output])
+        test_feedback.save_archive(self.TARGET_FEEDBACK)
+
+        with zipfile.ZipFile(self.TARGET_FEEDBACK, "r") as zip_file:
+            self.assertEqual(zip_file.read(feedback.FAILED_COMMAND_OUTPUT_FILE_PATH).decode(), "first\nsecond\n")
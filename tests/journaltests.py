@@ -0,0 +1,143 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import json
+import os
+import unittest
+
+import src.journal as journal
+
+
+class ActionsJournalTests(unittest.TestCase):
+    JOURNAL_FILE = "actions.journal"
+
+    def tearDown(self):
+        for path in (self.JOURNAL_FILE, self.JOURNAL_FILE + ".next"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _read_records(self):
+        with open(self.JOURNAL_FILE) as f:
+            return [json.loads(line) for line in f]
+
+    def test_load_missing_file(self):
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {})
+
+    def test_records_are_appended_immediately(self):
+        actions_journal = journal.ActionsJournal(self.JOURNAL_FILE).load()
+        actions_journal.open()
+        actions_journal.record("first", "success")
+        actions_journal.record("second", "failed")
+        actions_journal.record("second", "success")
+
+        # Not closed, like the process was killed
+        self.assertEqual(self._read_records(), [{"name": "first", "state": "success"},
+                                                {"name": "second", "state": "failed"},
+                                                {"name": "second", "state": "success"}])
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {"first": "success", "second": "success"})
+        actions_journal.close()
+
+    def test_compact_on_close(self):
+        actions_journal = journal.ActionsJournal(self.JOURNAL_FILE).load()
+        actions_journal.open()
+        actions_journal.record("first", "failed")
+        actions_journal.record("first", "success")
+        actions_journal.close()
+
+        self.assertEqual(self._read_records(), [{"name": "first", "state": "success"}])
+        self.assertFalse(os.path.exists(self.JOURNAL_FILE + ".next"))
+
+    def test_load_legacy_single_line(self):
+        with open(self.JOURNAL_FILE, "w") as f:
+            f.write("{ \"actions\": [ { \"name\" : \"saved\", \"state\" : \"skip\"}] }")
+
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {"saved": "skip"})
+
+    def test_load_legacy_multiline(self):
+        with open(self.JOURNAL_FILE, "w") as f:
+            f.write(json.dumps({"actions": [{"name": "first", "state": "success"}, {"name": "second", "state": "skip"}]}, indent=4))
+
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {"first": "success", "second": "skip"})
+
+    def test_skip_torn_last_record(self):
+        with open(self.JOURNAL_FILE, "w") as f:
+            f.write("{\"name\":\"first\",\"state\":\"success\"}\n{\"name\":\"sec")
+
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {"first": "success"})
+
+    def test_skip_torn_first_record(self):
+        with open(self.JOURNAL_FILE, "w") as f:
+            f.write("{\"name\":\"a\",\"sta")
+
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {})
+
+    def test_skip_torn_first_record_before_next_ones(self):
+        with open(self.JOURNAL_FILE, "w") as f:
+            f.write("{\"name\":\"a\",\"sta\n{\"name\":\"b\",\"state\":\"success\"}\n")
+
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {"b": "success"})
+
+    def _append_and_crash(self, name):
+        actions_journal = journal.ActionsJournal(self.JOURNAL_FILE).load()
+        actions_journal.open()
+        actions_journal.record(name, "success")
+        # Not closed, like the process was killed
+        actions_journal._journal.close()
+
+    def test_append_to_legacy_and_crash(self):
+        with open(self.JOURNAL_FILE, "w") as f:
+            f.write(json.dumps({"actions": [{"name": "old", "state": "success"}]}, indent=4))
+
+        self._append_and_crash("new")
+
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {"old": "success", "new": "success"})
+
+    def test_append_after_torn_record_and_crash(self):
+        with open(self.JOURNAL_FILE, "w") as f:
+            f.write("{\"name\":\"old\",\"state\":\"success\"}\n{\"name\":\"sec")
+
+        self._append_and_crash("new")
+
+        self.assertEqual(journal.ActionsJournal(self.JOURNAL_FILE).load().states, {"old": "success", "new": "success"})
+        self.assertEqual(self._read_records(), [{"name": "old", "state": "success"}, {"name": "new", "state": "success"}])
+
+    def test_remove(self):
+        actions_journal = journal.ActionsJournal(self.JOURNAL_FILE).load()
+        actions_journal.open()
+        actions_journal.record("first", "success")
+        actions_journal.remove()
+
+        self.assertFalse(os.path.exists(self.JOURNAL_FILE))
+
+
+class ActionsStateStoreTests(unittest.TestCase):
+    STORE_FILE = "actions.journal"
+
+    def setUp(self):
+        with open(self.STORE_FILE, "w") as f:
+            f.write("{\"name\":\"first\",\"state\":\"success\"}\n"
+                    "{\"name\":\"second\",\"state\":\"skip\"}\n"
+                    "{\"name\":\"third\",\"state\":\"success\"}\n")
+
+    def tearDown(self):
+        if os.path.exists(self.STORE_FILE):
+            os.remove(self.STORE_FILE)
+
+    def test_lookup(self):
+        store = journal.ActionsStateStore(self.STORE_FILE).load()
+        self.assertEqual(store.get_state("second"), "skip")
+        self.assertIsNone(store.get_state("unknown"))
+        self.assertIn("first", store)
+        self.assertEqual(len(store), 3)
+
+    def test_bulk_queries(self):
+        store = journal.ActionsStateStore(self.STORE_FILE).load()
+        self.assertEqual(store.get_states(["first", "unknown"]), {"first": "success", "unknown": None})
+        self.assertEqual(store.get_names_with_state("success"), ["first", "third"])
+        self.assertEqual(store.get_names_with_state("skip", "failed"), ["second"])
+
+    def test_changes_are_persisted(self):
+        store = journal.ActionsStateStore(self.STORE_FILE).load()
+        store.open()
+        store.set_state("second", "success")
+        store.close()
+
+        self.assertEqual(journal.ActionsStateStore(self.STORE_FILE).load().get_names_with_state("skip"), [])
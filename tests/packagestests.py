@@ -0,0 +1,185 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import os
+import unittest
+from unittest import mock
+
+import src.dist as dist
+import src.packages as packages
+import src.rpm as rpm
+
+
+class PackagesTransactionTests(unittest.TestCase):
+    def test_operations_are_merged(self):
+        transaction = packages.PackagesTransaction()
+        transaction.install(["a", "b"], requester="first")
+        transaction.remove(["c"], requester="first")
+        transaction.install(["b", "d"], requester="second")
+        transaction.upgrade(["e"], requester="second")
+
+        with mock.patch("src.packages.apply_packages_transaction") as apply:
+            transaction.commit()
+
+        apply.assert_called_once_with(["a", "b", "d"], ["c"], ["e"], None, False)
+        self.assertTrue(transaction.is_empty())
+
+    def test_upgrade_of_everything_wins(self):
+        transaction = packages.PackagesTransaction()
+        transaction.upgrade(["e"], requester="first")
+        transaction.upgrade(requester="second")
+
+        with mock.patch("src.packages.apply_packages_transaction") as apply:
+            transaction.commit()
+
+        apply.assert_called_once_with([], [], [], None, False)
+
+    def test_operations_with_different_options_are_separated(self):
+        transaction = packages.PackagesTransaction()
+        transaction.install(["a"], requester="first")
+        transaction.install(["b"], requester="second", repository="special")
+
+        with mock.patch("src.packages.apply_packages_transaction") as apply:
+            transaction.commit()
+
+        apply.assert_has_calls([mock.call(["a"], [], None, None, False), mock.call(["b"], [], None, "special", False)])
+
+    def test_failure_is_mapped_to_requesters(self):
+        transaction = packages.PackagesTransaction()
+        transaction.install(["good"], requester="first")
+        transaction.install(["broken"], requester="second")
+
+        def apply(install, remove, upgrade, repository, force_package_config):
+            if "broken" in install:
+                raise Exception("no such package")
+
+        with mock.patch("src.packages.apply_packages_transaction", side_effect=apply) as applied:
+            with self.assertRaises(packages.PackagesTransactionError) as context:
+                transaction.commit()
+
+        self.assertEqual(context.exception.requesters, ["second"])
+        self.assertEqual(applied.call_count, 3)
+
+    def test_applied_removals_are_not_repeated(self):
+        transaction = packages.PackagesTransaction()
+        transaction.remove(["old"], requester="remover")
+        transaction.install(["broken"], requester="installer")
+
+        def apply(install, remove, upgrade, repository, force_package_config):
+            # Just like rpm based systems do: packages are removed first, then the install fails
+            if "broken" in install:
+                raise Exception("no such package")
+
+        with mock.patch("src.packages.apply_packages_transaction", side_effect=apply) as applied, \
+                mock.patch("src.packages.filter_installed_packages", return_value=[]):
+            with self.assertRaises(packages.PackagesTransactionError) as context:
+                transaction.commit()
+
+        self.assertEqual(context.exception.requesters, ["installer"])
+        self.assertEqual(applied.call_count, 2)
+        applied.assert_called_with(["broken"], [], None, None, False)
+
+    def test_aborted_transaction_is_not_applied(self):
+        packages.begin_transaction()
+        packages.defer_install_packages(["a"])
+        packages.abort_transaction()
+
+        self.assertIsNone(packages._active_transaction)
+        with mock.patch("src.packages.install_packages") as install:
+            packages.defer_install_packages(["b"])
+        install.assert_called_once_with(["b"], None, False)
+
+    def test_deferred_operations_without_transaction_are_immediate(self):
+        with mock.patch("src.packages.install_packages") as install:
+            packages.defer_install_packages(["a"])
+
+        install.assert_called_once_with(["a"], None, False)
+
+    def test_deferred_operations_go_to_active_transaction(self):
+        transaction = packages.begin_transaction()
+        try:
+            with packages.transaction_requester("action"):
+                packages.defer_install_packages(["a"])
+                packages.defer_remove_packages(["b"])
+        finally:
+            with mock.patch("src.packages.apply_packages_transaction") as apply:
+                packages.commit_transaction()
+
+        apply.assert_called_once_with(["a"], ["b"], None, None, False)
+        self.assertIsNone(packages._active_transaction)
+        self.assertTrue(transaction.is_empty())
+
+    def test_operations_of_failed_requester_are_dropped(self):
+        packages.begin_transaction()
+        try:
+            with packages.transaction_requester("good"):
+                packages.defer_install_packages(["a"])
+            with self.assertRaises(RuntimeError):
+                with packages.transaction_requester("broken"):
+                    packages.defer_install_packages(["x"])
+                    raise RuntimeError("action failed")
+        finally:
+            with mock.patch("src.packages.apply_packages_transaction") as apply:
+                packages.commit_transaction()
+
+        apply.assert_called_once_with(["a"], [], None, None, False)
+
+
+class InstalledPackagesTests(unittest.TestCase):
+    SNAPSHOT_FILE = "packages_snapshot.json"
+
+    def tearDown(self):
+        if os.path.exists(self.SNAPSHOT_FILE):
+            os.remove(self.SNAPSHOT_FILE)
+
+    def test_diff(self):
+        before = packages.InstalledPackages("rpm", {
+            "bash.x86_64": ["4.2.46-34.el7"],
+            "python2.x86_64": ["2.7.5-90.el7"],
+            "openssl.x86_64": ["1:1.0.2k-26.el7"],
+            "kernel.x86_64": ["3.10.0-1160.el7", "3.10.0-1127.el7"],
+            "glibc.i686": ["2.17-326.el7_9"],
+        })
+        after = packages.InstalledPackages("rpm", {
+            "bash.x86_64": ["5.1.8-6.el9"],
+            "python3.x86_64": ["3.9.16-1.el9"],
+            "openssl.x86_64": ["1:1.0.2k-19.el7"],
+            "kernel.x86_64": ["3.10.0-1160.el7"],
+            "glibc.i686": ["2.17-326.el7_9"],
+        })
+
+        diff = before.diff(after)
+        self.assertEqual(diff.added, {"python3.x86_64": ["3.9.16-1.el9"]})
+        self.assertEqual(diff.removed, {"python2.x86_64": ["2.7.5-90.el7"]})
+        self.assertEqual(diff.upgraded, {"bash.x86_64": ("4.2.46-34.el7", "5.1.8-6.el9")})
+        self.assertEqual(diff.downgraded, {"openssl.x86_64": ("1:1.0.2k-26.el7", "1:1.0.2k-19.el7")})
+        self.assertFalse(diff.is_empty())
+        self.assertTrue(after.diff(after).is_empty())
+
+    def test_deb_versions_diff(self):
+        before = packages.InstalledPackages("deb", {"libc6:amd64": ["2.31-0ubuntu9.9"]})
+        after = packages.InstalledPackages("deb", {"libc6:amd64": ["2.31-0ubuntu9.10"]})
+        self.assertEqual(before.diff(after).upgraded, {"libc6:amd64": ("2.31-0ubuntu9.9", "2.31-0ubuntu9.10")})
+
+    def test_different_kinds(self):
+        with self.assertRaises(ValueError):
+            packages.InstalledPackages("rpm", {}).diff(packages.InstalledPackages("deb", {}))
+
+    def test_save_and_load(self):
+        snapshot = packages.InstalledPackages("rpm", {"bash.x86_64": ["4.2.46-34.el7"],
+                                                      "kernel.x86_64": ["3.10.0-1160.el7", "3.10.0-1127.el7"]})
+        snapshot.save(self.SNAPSHOT_FILE)
+
+        loaded = packages.InstalledPackages.load(self.SNAPSHOT_FILE)
+        self.assertEqual(loaded.kind, "rpm")
+        self.assertEqual(loaded.versions, snapshot.versions)
+
+    def test_take_from_rpm_index(self):
+        index = rpm.RpmPackagesIndex.parse("bash\t(none)\t4.2.46\t34.el7\tx86_64\n"
+                                           "openssl\t1\t1.0.2k\t26.el7\tx86_64\n"
+                                           "gpg-pubkey\t(none)\tf4a80eb5\t53a7ff4b\t(none)\n")
+        with mock.patch("src.dist.get_distro", return_value=dist.Distro.centos7), \
+                mock.patch("src.rpm.get_installed_packages_index", return_value=index):
+            snapshot = packages.InstalledPackages.take()
+
+        self.assertEqual(snapshot.kind, "rpm")
+        self.assertEqual(snapshot.versions, {"bash.x86_64": ["4.2.46-34.el7"], "openssl.x86_64": ["1:1.0.2k-26.el7"],
+                                             "gpg-pubkey": ["f4a80eb5-53a7ff4b"]})
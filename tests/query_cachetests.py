@@ -0,0 +1,84 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import unittest
+
+import src.query_cache as query_cache
+
+
+class QueryCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        @query_cache.cached_query("test.installed")
+        def is_installed(name):
+            self.calls.append(name)
+            return name == "present"
+
+        @query_cache.cached_query("test.version", query_cache.RUN_SCOPE)
+        def get_version():
+            self.calls.append("version")
+            return "1.0"
+
+        @query_cache.invalidates_queries("test.installed")
+        def install(name):
+            raise RuntimeError("installation failed")
+
+        self.is_installed = is_installed
+        self.get_version = get_version
+        self.install = install
+        query_cache.enable_query_cache()
+
+    def tearDown(self):
+        query_cache.disable_query_cache()
+
+    def test_disabled_cache_always_queries(self):
+        query_cache.disable_query_cache()
+        self.assertTrue(self.is_installed("present"))
+        self.assertTrue(self.is_installed("present"))
+        self.assertEqual(self.calls, ["present", "present"])
+
+    def test_repeated_query_is_cached(self):
+        self.assertTrue(self.is_installed("present"))
+        self.assertFalse(self.is_installed("absent"))
+        self.assertTrue(self.is_installed("present"))
+        self.assertFalse(self.is_installed("absent"))
+        self.assertEqual(self.calls, ["present", "absent"])
+
+    def test_invalidate_by_arguments(self):
+        self.is_installed("present")
+        self.is_installed("absent")
+        query_cache.invalidate_query("test.installed", ("absent",))
+        self.is_installed("present")
+        self.is_installed("absent")
+        self.assertEqual(self.calls, ["present", "absent", "absent"])
+
+    def test_invalidate_namespace(self):
+        self.is_installed("present")
+        self.get_version()
+        query_cache.invalidate_query("test.installed")
+        self.is_installed("present")
+        self.get_version()
+        self.assertEqual(self.calls, ["present", "version", "present"])
+
+    def test_failed_mutation_invalidates(self):
+        self.is_installed("present")
+        with self.assertRaises(RuntimeError):
+            self.install("present")
+        self.is_installed("present")
+        self.assertEqual(self.calls, ["present", "present"])
+
+    def test_clear_stage_queries_keeps_run_scope(self):
+        self.is_installed("present")
+        self.get_version()
+        query_cache.clear_stage_queries()
+        self.is_installed("present")
+        self.get_version()
+        self.assertEqual(self.calls, ["present", "version", "present"])
+
+    def test_changes_of_returned_value_do_not_affect_cache(self):
+        @query_cache.cached_query("test.services")
+        def get_required_services(name):
+            return ["first", "second"]
+
+        get_required_services("service").append("third")
+        get_required_services("service").clear()
+        self.assertEqual(get_required_services("service"), ["first", "second"])
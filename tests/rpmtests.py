@@ -2,6 +2,7 @@
 import unittest
 import os
 import shutil
+from unittest import mock
 
 import src.rpm as rpm
 
@@ -376,3 +377,338 @@ class HandleRpmnewFilesTests(unittest.TestCase):
             self.assertEqual(open(f"{self.test_dir}/{file}").read(), content)
 
         shutil.rmtree(self.test_dir)
+
+
+class RpmPackagesIndexTests(unittest.TestCase):
+    QUERY_OUTPUT = "\n".join([
+        "bash\t(none)\t4.2.46\t35.el7_9\tx86_64",
+        "glibc\t(none)\t2.17\t326.el7_9\tx86_64",
+        "glibc\t(none)\t2.17\t326.el7_9\ti686",
+        "perl-Time-Local\t(none)\t1.2300\t2.el7\tnoarch",
+        "mariadb-server\t1\t5.5.68\t1.el7\tx86_64",
+        "gpg-pubkey\t(none)\tf4a80eb5\t53a7ff4b\t(none)",
+    ]) + "\n"
+
+    def setUp(self):
+        rpm.invalidate_installed_packages_index()
+
+    def tearDown(self):
+        rpm.invalidate_installed_packages_index()
+
+    def test_lookup_by_name(self):
+        index = rpm.RpmPackagesIndex.parse(self.QUERY_OUTPUT)
+        self.assertEqual(len(index), 6)
+        self.assertTrue(index.is_installed("bash"))
+        self.assertTrue(index.is_installed("perl-Time-Local"))
+        self.assertFalse(index.is_installed("perl-Time"))
+        self.assertFalse(index.is_installed("zsh"))
+
+    def test_lookup_by_query_names(self):
+        index = rpm.RpmPackagesIndex.parse(self.QUERY_OUTPUT)
+        for query_name in ("bash-4.2.46", "bash-4.2.46-35.el7_9", "bash.x86_64", "bash-4.2.46-35.el7_9.x86_64",
+                           "glibc.i686", "mariadb-server-1:5.5.68-1.el7", "mariadb-server-1:5.5.68-1.el7.x86_64",
+                           "gpg-pubkey-f4a80eb5-53a7ff4b"):
+            self.assertTrue(index.is_installed(query_name), query_name)
+
+        self.assertFalse(index.is_installed("bash-5.0"))
+        self.assertFalse(index.is_installed("bash.i686"))
+
+    def test_versions_and_arches(self):
+        index = rpm.RpmPackagesIndex.parse(self.QUERY_OUTPUT)
+        self.assertEqual(index.get_versions("glibc"), ["2.17-326.el7_9", "2.17-326.el7_9"])
+        self.assertEqual(sorted(index.get_arches("glibc")), ["i686", "x86_64"])
+        self.assertEqual(index.get_versions("mariadb-server"), ["1:5.5.68-1.el7"])
+        self.assertEqual(index.get_arches("gpg-pubkey"), [])
+        self.assertEqual(index.find("mariadb-server")[0].nevra, "mariadb-server-1:5.5.68-1.el7.x86_64")
+
+    def test_latest_package(self):
+        index = rpm.RpmPackagesIndex.parse("\n".join([
+            "kernel\t(none)\t3.10.0\t1160.95.1.el7\tx86_64",
+            "kernel\t(none)\t3.10.0\t957.5.1.el7\tx86_64",
+            "kernel\t(none)\t3.10.0\t1160.102.1.el7\tx86_64",
+            "kernel\t(none)\t3.10.0\t1160.el7\tx86_64",
+        ]))
+        self.assertEqual(index.get_latest("kernel").nevra, "kernel-3.10.0-1160.102.1.el7.x86_64")
+        self.assertIsNone(index.get_latest("bash"))
+
+        with mock.patch("src.rpm.accounting.check_output", return_value=self.QUERY_OUTPUT):
+            self.assertEqual(rpm.get_latest_installed_package("mariadb-server").evr, "1:5.5.68-1.el7")
+
+    def test_single_query_for_many_packages(self):
+        with mock.patch("src.rpm.accounting.check_output", return_value=self.QUERY_OUTPUT) as check_output:
+            self.assertEqual(rpm.filter_installed_packages(["bash", "zsh", "glibc", "vim"]), ["bash", "glibc"])
+            self.assertTrue(rpm.is_package_installed("mariadb-server"))
+
+        check_output.assert_called_once()
+
+    def test_index_is_dropped_after_change(self):
+        with mock.patch("src.rpm.accounting.check_output", return_value=self.QUERY_OUTPUT) as check_output, \
+                mock.patch("src.rpm.util.logged_check_call"):
+            self.assertTrue(rpm.is_package_installed("bash"))
+            rpm.remove_packages(["bash"])
+            rpm.is_package_installed("bash")
+
+        self.assertEqual(check_output.call_count, 2)
+
+
+class RepoFileTests(unittest.TestCase):
+    REPO_FILE_CONTENT = """# Managed by hand
+
+[repo1]
+name=repo1
+baseurl=http://repo1
+enabled=1
+#gpgcheck=1
+
+[repo2]
+name = repo2
+metalink = http://repo2/metalink
+gpgcheck=0
+"""
+    REPOS_DIR = "repos_test_dir"
+
+    def tearDown(self):
+        if os.path.exists(self.REPOS_DIR):
+            shutil.rmtree(self.REPOS_DIR)
+
+    def test_parse_sections(self):
+        repofile = rpm.RepoFile.parse(self.REPO_FILE_CONTENT.splitlines(keepends=True))
+        self.assertEqual([section.id for section in repofile.sections], [None, "repo1", "repo2"])
+        self.assertEqual([repo.id for repo in repofile], ["repo1", "repo2"])
+
+        repo2 = repofile.get_repository("repo2")
+        self.assertEqual(repo2.name, "repo2")
+        self.assertEqual(repo2.metalink, "http://repo2/metalink")
+        self.assertIsNone(repo2.baseurl)
+        self.assertEqual(list(repo2.fields), ["name", "metalink", "gpgcheck"])
+        self.assertIsNone(repofile.get_repository("repo1").get("gpgcheck"))
+
+    def test_round_trip(self):
+        repofile = rpm.RepoFile.parse(self.REPO_FILE_CONTENT.splitlines(keepends=True))
+        self.assertEqual(repofile.to_text(), self.REPO_FILE_CONTENT)
+
+    def test_no_debug_formatting_when_disabled(self):
+        with mock.patch("src.log.is_debug_enabled", return_value=False), mock.patch("src.log.debug") as debug:
+            rpm.RepoFile.parse(self.REPO_FILE_CONTENT.splitlines(keepends=True))
+        debug.assert_not_called()
+
+    def test_loader_reparses_changed_files_only(self):
+        os.mkdir(self.REPOS_DIR)
+        for name in ("first.repo", "second.repo"):
+            with open(os.path.join(self.REPOS_DIR, name), "w") as repofile:
+                repofile.write(self.REPO_FILE_CONTENT)
+
+        loader = rpm.RepoFilesLoader()
+        first, second = loader.load(self.REPOS_DIR)
+
+        with open(os.path.join(self.REPOS_DIR, "second.repo"), "a") as repofile:
+            repofile.write("\n[repo3]\nname=repo3\nbaseurl=http://repo3\n")
+        stat = os.stat(os.path.join(self.REPOS_DIR, "second.repo"))
+        os.utime(os.path.join(self.REPOS_DIR, "second.repo"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        os.remove(os.path.join(self.REPOS_DIR, "first.repo"))
+
+        reloaded = loader.load(self.REPOS_DIR)
+        self.assertEqual(len(reloaded), 1)
+        self.assertIsNot(reloaded[0], second)
+        self.assertEqual([repo.id for repo in reloaded[0]], ["repo1", "repo2", "repo3"])
+        self.assertIs(loader.load(self.REPOS_DIR)[0], reloaded[0])
+
+
+class RepoFileEditorTests(unittest.TestCase):
+    REPO_FILE_CONTENT = """[repo1]
+name=repo1
+baseurl=http://repo1
+enabled=1
+
+[repo2]
+name=repo2
+baseurl=http://repo2
+"""
+    REPO_FILE_NAME = "repo_file.txt"
+
+    def setUp(self):
+        with open(self.REPO_FILE_NAME, "w") as f:
+            f.write(self.REPO_FILE_CONTENT)
+
+    def tearDown(self):
+        for path in (self.REPO_FILE_NAME, self.REPO_FILE_NAME + ".next"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _read(self):
+        with open(self.REPO_FILE_NAME) as file:
+            return file.read()
+
+    def test_new_file_has_default_permissions(self):
+        os.remove(self.REPO_FILE_NAME)
+        with rpm.RepoFileEditor(self.REPO_FILE_NAME) as editor:
+            editor.add_repository("repo3", "repo3", "http://repo3")
+
+        self.assertEqual(os.stat(self.REPO_FILE_NAME).st_mode & 0o777, 0o644)
+
+    def test_modify_and_add(self):
+        with rpm.RepoFileEditor(self.REPO_FILE_NAME) as editor:
+            editor.set_field("repo1", "enabled", "0")
+            editor.set_field("repo1", "gpgcheck", "1")
+            editor.add_repository("repo3", "repo3", metalink="http://repo3", additional=["enabled=1\n"])
+
+        self.assertEqual(self._read(), """[repo1]
+name=repo1
+baseurl=http://repo1
+enabled=0
+gpgcheck=1
+
+[repo2]
+name=repo2
+baseurl=http://repo2
+
+[repo3]
+name=repo3
+metalink=http://repo3
+enabled=1
+""")
+
+    def test_rollback_on_exception(self):
+        with self.assertRaises(RuntimeError):
+            with rpm.RepoFileEditor(self.REPO_FILE_NAME) as editor:
+                editor.remove_repository("repo1")
+                raise RuntimeError("failure")
+
+        self.assertEqual(self._read(), self.REPO_FILE_CONTENT)
+        self.assertEqual([name for name in os.listdir(".") if name.startswith(self.REPO_FILE_NAME + ".")], [])
+
+    def test_stale_next_file_is_ignored(self):
+        with open(self.REPO_FILE_NAME + ".next", "w") as f:
+            f.write("[stale]\nname=stale\n")
+
+        rpm.remove_repositories(self.REPO_FILE_NAME, [lambda id, _1, _2, _3, _4: id == "repo2"])
+        self.assertEqual(self._read(), "[repo1]\nname=repo1\nbaseurl=http://repo1\nenabled=1\n\n")
+
+    def test_unchanged_file_is_not_written(self):
+        mtime = os.stat(self.REPO_FILE_NAME).st_mtime_ns
+        with mock.patch("src.rpm.tempfile.mkstemp") as mkstemp, rpm.RepoFileEditor(self.REPO_FILE_NAME) as editor:
+            editor.remove_repository("repo4")
+
+        mkstemp.assert_not_called()
+        self.assertEqual(os.stat(self.REPO_FILE_NAME).st_mtime_ns, mtime)
+
+    def test_unknown_repository_modification(self):
+        with self.assertRaises(KeyError), rpm.RepoFileEditor(self.REPO_FILE_NAME) as editor:
+            editor.set_field("repo4", "enabled", "0")
+
+
+class RepositoryMatcherTests(unittest.TestCase):
+    REPOS_DIR = "repos_test_dir"
+
+    def tearDown(self):
+        if os.path.exists(self.REPOS_DIR):
+            shutil.rmtree(self.REPOS_DIR)
+
+    def test_match_by_id(self):
+        matcher = rpm.RepositoryMatcher(ids=["epel"], id_globs=["plesk-*", "*-testing"])
+        self.assertTrue(matcher.match("epel", []))
+        self.assertTrue(matcher.match("plesk-php74", []))
+        self.assertTrue(matcher.match("epel-testing", []))
+        self.assertFalse(matcher.match("epel-source", []))
+        self.assertFalse(matcher.match("my-plesk-php", []))
+
+    def test_match_by_url_host(self):
+        matcher = rpm.RepositoryMatcher(url_hosts=["mirror.example.com", ".plesk.com"])
+        self.assertTrue(matcher.match("any", ["http://mirror.example.com/centos/7"]))
+        self.assertTrue(matcher.match("any", ["https://user@MIRROR.example.com:8080/path"]))
+        self.assertTrue(matcher.match("any", ["http://autoinstall.plesk.com/PHP74_17"]))
+        self.assertFalse(matcher.match("any", ["http://example.com/centos/7"]))
+        self.assertFalse(matcher.match("any", ["http://notplesk.com/repo"]))
+        self.assertFalse(matcher.match("any", [None]))
+
+    def test_match_by_url_prefix(self):
+        matcher = rpm.RepositoryMatcher(url_prefixes=["repo.example.com/centos/7/", "repo.example.com/epel"])
+        self.assertTrue(matcher.match("any", ["https://repo.example.com/centos/7/os/x86_64"]))
+        self.assertTrue(matcher.match("any", ["http://repo.example.com/epel7/x86_64"]))
+        self.assertFalse(matcher.match("any", ["http://repo.example.com/centos/8/os"]))
+        self.assertTrue(matcher.match("any", ["http://other/a, http://repo.example.com/centos/7/os"]))
+
+    def test_as_remove_repositories_condition(self):
+        matcher = rpm.RepositoryMatcher(url_hosts=["repo2"])
+        self.assertTrue(matcher("repo2", "repo2", None, "http://repo2/metalink", None))
+        self.assertFalse(matcher("repo1", "repo1", "http://repo1", None, None))
+
+    def test_bulk_removal(self):
+        os.mkdir(self.REPOS_DIR)
+        contents = {
+            "first.repo": "[epel]\nname=epel\nbaseurl=http://epel\n\n[base]\nname=base\nbaseurl=http://mirror/base\n",
+            "second.repo": "[plesk-php74]\nname=php\nbaseurl=http://autoinstall.plesk.com/php74\n",
+            "third.repo": "[updates]\nname=updates\nmirrorlist=http://mirror/updates\n",
+        }
+        for name, content in contents.items():
+            with open(os.path.join(self.REPOS_DIR, name), "w") as repofile:
+                repofile.write(content)
+
+        matcher = rpm.RepositoryMatcher(ids=["epel"], url_hosts=[".plesk.com"])
+        self.assertEqual([section.id for _, section in rpm.find_repositories(matcher, self.REPOS_DIR)], ["epel", "plesk-php74"])
+
+        removed = rpm.remove_matching_repositories(matcher, self.REPOS_DIR)
+        self.assertEqual(removed, {os.path.join(self.REPOS_DIR, "first.repo"): ["epel"],
+                                   os.path.join(self.REPOS_DIR, "second.repo"): ["plesk-php74"]})
+        self.assertEqual(sorted(os.listdir(self.REPOS_DIR)), ["first.repo", "third.repo"])
+        with open(os.path.join(self.REPOS_DIR, "first.repo")) as repofile:
+            self.assertEqual(repofile.read(), "[base]\nname=base\nbaseurl=http://mirror/base\n")
+
+
+class RemovePackagesTests(unittest.TestCase):
+    DUPES_OUTPUT = """Loaded plugins: fastestmirror
+kernel-headers-3.10.0-1160.el7.x86_64
+kernel-headers-3.10.0-1127.el7.x86_64
+1:openssl-libs-1.0.2k-26.el7_9.x86_64
+1:openssl-libs-1.0.2k-19.el7.x86_64
+php-fpm-7.4.33-1.el7.x86_64
+php-fpm-7.4.30-1.el7.x86_64
+"""
+
+    def test_parse_nevra(self):
+        package = rpm.parse_nevra("1:openssl-libs-1.0.2k-26.el7_9.x86_64")
+        self.assertEqual((package.name, package.epoch, package.version, package.release, package.arch),
+                         ("openssl-libs", "1", "1.0.2k", "26.el7_9", "x86_64"))
+        self.assertEqual(rpm.parse_nevra("bash-0:4.2.46-35.el7_9.x86_64").epoch, "0")
+        self.assertEqual(rpm.parse_nevra("kernel-3.10.0-1160.el7.x86_64").name, "kernel")
+        self.assertIsNone(rpm.parse_nevra("Loaded plugins: fastestmirror"))
+        self.assertIsNone(rpm.parse_nevra("bash"))
+        package = rpm.parse_nevra("gpg-pubkey-f4a80eb5-53a7ff4b")
+        self.assertEqual((package.name, package.version, package.release, package.arch), ("gpg-pubkey", "f4a80eb5", "53a7ff4b", None))
+
+    def test_duplicates_are_removed_in_one_transaction(self):
+        pkgs = ["kernel-headers", "openssl-libs", "php", "bash"]
+        with mock.patch("os.path.exists", return_value=True), \
+                mock.patch("src.rpm.accounting.check_output", return_value=self.DUPES_OUTPUT), \
+                mock.patch("src.rpm.util.logged_check_call") as logged_check_call:
+            report = rpm.remove_packages(pkgs)
+
+        self.assertEqual(pkgs, ["kernel-headers", "openssl-libs", "php", "bash"])
+        logged_check_call.assert_called_once_with(["/usr/bin/rpm", "-e", "--nodeps",
+                                                   "kernel-headers-3.10.0-1160.el7.x86_64", "kernel-headers-3.10.0-1127.el7.x86_64",
+                                                   "openssl-libs-1.0.2k-26.el7_9.x86_64", "openssl-libs-1.0.2k-19.el7.x86_64",
+                                                   "php", "bash"])
+        self.assertEqual(report.to_dict()["duplicates"], {
+            "kernel-headers": ["kernel-headers-3.10.0-1160.el7.x86_64", "kernel-headers-3.10.0-1127.el7.x86_64"],
+            "openssl-libs": ["openssl-libs-1:1.0.2k-26.el7_9.x86_64", "openssl-libs-1:1.0.2k-19.el7.x86_64"],
+        })
+
+    def test_duplicates_without_arch(self):
+        output = "gpg-pubkey-f4a80eb5-53a7ff4b\ngpg-pubkey-f4a80eb5-53a7ff4c\n"
+        with mock.patch("os.path.exists", return_value=True), \
+                mock.patch("src.rpm.accounting.check_output", return_value=output), \
+                mock.patch("src.rpm.util.logged_check_call") as logged_check_call:
+            rpm.remove_packages(["gpg-pubkey"])
+
+        logged_check_call.assert_called_once_with(["/usr/bin/rpm", "-e", "--nodeps",
+                                                   "gpg-pubkey-f4a80eb5-53a7ff4b", "gpg-pubkey-f4a80eb5-53a7ff4c"])
+
+    def test_without_package_cleanup(self):
+        with mock.patch("os.path.exists", return_value=False), \
+                mock.patch("src.rpm.accounting.check_output") as check_output, \
+                mock.patch("src.rpm.util.logged_check_call") as logged_check_call:
+            report = rpm.remove_packages(["bash"])
+
+        check_output.assert_not_called()
+        logged_check_call.assert_called_once_with(["/usr/bin/rpm", "-e", "--nodeps", "bash"])
+        self.assertEqual(report.removed, ["bash"])
@@ -0,0 +1,69 @@
+# Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import json
+import os
+import unittest
+
+import src.tracing as tracing
+import src.util as util
+
+
+class TracerTests(unittest.TestCase):
+    TRACE_FILE = "trace.json"
+
+    def setUp(self):
+        self.tracer = tracing.Tracer()
+
+    def tearDown(self):
+        if os.path.exists(self.TRACE_FILE):
+            os.remove(self.TRACE_FILE)
+
+    def test_disabled_tracer_collects_nothing(self):
+        with self.tracer.span("stage", "stage") as span:
+            span.args["key"] = "value"
+
+        self.assertEqual(self.tracer.events, [])
+        self.assertEqual(self.tracer.to_trace_events(), [])
+
+    def test_nested_spans(self):
+        self.tracer.enable()
+        with self.tracer.span("stage", "stage"):
+            with self.tracer.span("action", "action", flow="test"):
+                pass
+
+        events = {event["name"]: event for event in self.tracer.to_trace_events() if event["ph"] == "X"}
+        self.assertEqual(set(events.keys()), {"stage", "action"})
+        self.assertLessEqual(events["stage"]["ts"], events["action"]["ts"])
+        self.assertGreaterEqual(events["stage"]["ts"] + events["stage"]["dur"], events["action"]["ts"] + events["action"]["dur"])
+        self.assertEqual(events["action"]["args"], {"flow": "test"})
+        self.assertEqual(events["stage"]["tid"], events["action"]["tid"])
+
+    def test_error_is_recorded(self):
+        self.tracer.enable()
+        with self.assertRaises(ValueError):
+            with self.tracer.span("action", "action"):
+                raise ValueError("broken")
+
+        self.assertEqual(self.tracer.events[0][5], {"error": "broken"})
+
+    def test_save(self):
+        self.tracer.enable()
+        with self.tracer.span("stage", "stage"):
+            pass
+        self.tracer.save(self.TRACE_FILE)
+
+        with open(self.TRACE_FILE) as f:
+            trace = json.load(f)
+
+        self.assertEqual([event["ph"] for event in trace["traceEvents"]], ["M", "X"])
+
+    def test_subprocess_span(self):
+        tracing.enable_tracing()
+        try:
+            util.logged_check_call(["/bin/true"])
+        finally:
+            tracing.disable_tracing()
+
+        events = [event for event in tracing.tracer.to_trace_events() if event["ph"] == "X"]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["cat"], "subprocess")
+        self.assertEqual(events[0]["args"]["returncode"], "0")
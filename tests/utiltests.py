@@ -1,5 +1,9 @@
 # Copyright 1999-2024. WebPros International GmbH. All rights reserved.
+import subprocess
+import threading
+import time
 import unittest
+from unittest import mock
 
 import src.util as util
 
@@ -58,3 +62,114 @@ class TestDictOfListsMerge(unittest.TestCase):
             ),
             {"a": [1, 2, 3, 7, 8, 9], "b": [4, 5, 6], "c": [10, 11, 12]}
         )
+
+
+class TestLoggedCheckCall(unittest.TestCase):
+    def test_output_is_logged(self):
+        with mock.patch("src.util.log.info") as info:
+            util.logged_check_call(["/bin/sh", "-c", "echo first; echo; echo second"])
+
+        logged = [call.args[0] for call in info.call_args_list]
+        self.assertIn("first", logged)
+        self.assertIn("second", logged)
+        self.assertNotIn("", logged)
+
+    def test_output_after_exit_is_not_lost(self):
+        with mock.patch("src.util.log.info") as info:
+            util.logged_check_call(["/bin/sh", "-c", "for i in 1 2 3 4 5; do echo line$i; done"])
+
+        logged = [call.args[0] for call in info.call_args_list]
+        for number in range(1, 6):
+            self.assertIn(f"line{number}", logged)
+
+    def test_failure_raises(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            util.logged_check_call(["/bin/sh", "-c", "exit 3"])
+
+        self.assertEqual(context.exception.returncode, 3)
+
+    def test_caller_arguments_are_passed(self):
+        with mock.patch("src.util.log.info") as info:
+            util.logged_check_call(["/bin/sh", "-c", "echo $TEST_VALUE"], env={"TEST_VALUE": "passed"}, universal_newlines=True)
+
+        self.assertIn("passed", [call.args[0] for call in info.call_args_list])
+
+    def test_run_concurrently(self):
+        with mock.patch("src.util.log.info") as info:
+            util.logged_check_call_concurrently([["/bin/sh", "-c", "sleep 0.2; echo first"],
+                                                 ["/bin/sh", "-c", "echo second"]])
+
+        logged = [call.args[0] for call in info.call_args_list]
+        self.assertIn("[0] first", logged)
+        self.assertIn("[1] second", logged)
+        self.assertLess(logged.index("[1] second"), logged.index("[0] first"))
+
+    def test_concurrent_failure_raises(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            util.logged_check_call_concurrently([["/bin/true"], ["/bin/sh", "-c", "exit 2"]])
+
+        self.assertEqual(context.exception.returncode, 2)
+
+    def test_failure_output_tail_is_attached(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            util.logged_check_call(["/bin/sh", "-c", f"seq 1 {util.COMMAND_OUTPUT_TAIL_SIZE + 10}; exit 1"])
+
+        lines = context.exception.output.splitlines()
+        self.assertEqual(len(lines), util.COMMAND_OUTPUT_TAIL_SIZE)
+        self.assertEqual(lines[-1], str(util.COMMAND_OUTPUT_TAIL_SIZE + 10))
+        self.assertEqual(util.get_last_failed_command_output(), lines)
+
+
+class TestLoggedCheckCallLimits(unittest.TestCase):
+    def tearDown(self):
+        util.set_command_timeouts()
+
+    def test_timeout_terminates_command(self):
+        with self.assertRaises(subprocess.TimeoutExpired) as context:
+            util.logged_check_call(["/bin/sh", "-c", "echo started; exec sleep 10"], timeout=0.5)
+
+        self.assertEqual(context.exception.timeout, 0.5)
+        self.assertEqual(context.exception.output, "started")
+        self.assertEqual(util.get_running_commands(), [])
+
+    def test_inactivity_timeout_terminates_silent_command(self):
+        with self.assertRaises(subprocess.TimeoutExpired) as context:
+            util.logged_check_call(["/bin/sh", "-c", "echo started; exec sleep 10"], inactivity_timeout=0.3)
+
+        self.assertEqual(context.exception.timeout, 0.3)
+
+    def test_inactivity_timeout_is_prolonged_by_output(self):
+        util.logged_check_call(["/bin/sh", "-c", "for i in 1 2 3 4 5 6; do echo $i; sleep 0.1; done"], inactivity_timeout=0.4)
+
+    def test_default_limits(self):
+        util.set_command_timeouts(timeout=0.3)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            util.logged_check_call(["/bin/sh", "-c", "exec sleep 10"])
+
+    def test_kill_after_ignored_sigterm(self):
+        with mock.patch("src.util.COMMAND_TERMINATION_GRACE_PERIOD", 0.3):
+            with self.assertRaises(subprocess.TimeoutExpired):
+                util.logged_check_call(["/bin/sh", "-c", "trap '' TERM; exec sleep 10"], timeout=0.3)
+
+    def test_concurrent_commands_limits(self):
+        with self.assertRaises(subprocess.TimeoutExpired):
+            util.logged_check_call_concurrently([["/bin/true"], ["/bin/sh", "-c", "exec sleep 10"]], timeout=0.3)
+
+    def test_heartbeat_of_running_command(self):
+        runner = threading.Thread(target=util.logged_check_call, args=(["/bin/sh", "-c", "echo beat; sleep 0.5"],))
+        runner.start()
+        try:
+            heartbeats = []
+            for _ in range(40):
+                heartbeats = util.get_running_commands()
+                if heartbeats and heartbeats[0].last_line is not None:
+                    break
+                time.sleep(0.01)
+
+            self.assertEqual(len(heartbeats), 1)
+            self.assertEqual(heartbeats[0].last_line, "beat")
+            self.assertLess(heartbeats[0].get_silence_time(), heartbeats[0].get_running_time() + 0.001)
+        finally:
+            runner.join()
+
+        self.assertEqual(util.get_running_commands(), [])
@@ -113,6 +113,18 @@ class KernelVersionTests(unittest.TestCase):
         kernel2 = version.KernelVersion("3.10.0-1160.el7.x86_64")
         self.assertGreater(kernel1, kernel2)
 
+    def test_compare_less_major_greater_minor(self):
+        kernel1 = version.KernelVersion("3.10.0-1160.95.1.el7.x86_64")
+        kernel2 = version.KernelVersion("4.4.0-1160.95.1.el7.x86_64")
+        self.assertLess(kernel1, kernel2)
+        self.assertFalse(kernel2 < kernel1)
+
+    def test_compare_less_main_part_greater_build(self):
+        kernel1 = version.KernelVersion("4.18.0-553.el8.x86_64")
+        kernel2 = version.KernelVersion("5.14.0-70.el9.x86_64")
+        self.assertLess(kernel1, kernel2)
+        self.assertFalse(kernel2 < kernel1)
+
     def test_find_last_kernel(self):
         kernels_strings = [
             "3.10.0-1160.76.1.el7.x86_64",
@@ -209,3 +221,105 @@ class PHPVersionTests(unittest.TestCase):
         php1 = version.PHPVersion("PHP 6.1")
         php2 = version.PHPVersion("PHP 5.2")
         self.assertGreater(php1, php2)
+
+
+class RpmVersionCompareTests(unittest.TestCase):
+
+    def _check(self, left, right, expected):
+        self.assertEqual(version.compare_rpm_versions(left, right), expected, f"{left} vs {right}")
+        self.assertEqual(version.compare_rpm_versions(right, left), -expected, f"{right} vs {left}")
+
+    def test_equal(self):
+        self._check("1.0", "1.0", 0)
+        self._check("fc4", "fc.4", 0)
+        self._check("1.0-1", "1.0", 0)
+
+    def test_numeric_segments(self):
+        self._check("1.0", "1.1", -1)
+        self._check("1.010", "1.9", 1)
+        self._check("1.0.1", "1.0", 1)
+
+    def test_alpha_and_numeric_segments(self):
+        self._check("1.0a", "1.0", 1)
+        self._check("1a", "1.1", -1)
+
+    def test_tilde_and_caret(self):
+        self._check("1.0~rc1", "1.0", -1)
+        self._check("1.0~rc1", "1.0~rc2", -1)
+        self._check("1.0^git1", "1.0", 1)
+        self._check("1.0^git1", "1.0.1", -1)
+
+    def test_epoch_and_release(self):
+        self._check("1:1.0", "2.0", 1)
+        self._check("2.17-326.el7_9", "2.17-325.el7_9", 1)
+
+
+class RpmVersionKeyTests(unittest.TestCase):
+
+    def test_key_order_matches_compare(self):
+        versions = ["1.0", "1.0~rc1", "1.0~rc2", "1.0^git1", "1.0.1", "1.0a", "1a", "1.1", "1.010", "fc4", "fc.4", "", "~", "^", "1..0"]
+        for left in versions:
+            for right in versions:
+                left_key, right_key = version.rpm_version_key(left), version.rpm_version_key(right)
+                self.assertEqual((left_key > right_key) - (left_key < right_key), version.rpmvercmp(left, right), f"{left} vs {right}")
+
+    def test_leading_zeros_and_separators(self):
+        self.assertEqual(version.rpm_version_key("1.001"), version.rpm_version_key("1_1"))
+
+    def test_sort_versions(self):
+        self.assertEqual(version.sort_rpm_versions(["1:1.0-1", "2.0-1", "2.0-10", "2.0-9", "2.0~beta-1", "2.0"]),
+                         ["2.0~beta-1", "2.0", "2.0-1", "2.0-9", "2.0-10", "1:1.0-1"])
+
+    def test_sort_nevras(self):
+        nevras = [
+            "kernel-3.10.0-1160.95.1.el7.x86_64",
+            "bash-4.2.46-35.el7_9.x86_64",
+            "kernel-3.10.0-1160.el7.x86_64",
+            "kernel-3.10.0-957.5.1.el7.x86_64",
+            "kernel-1:2.6.32-754.el6.x86_64",
+            "kernel-3.10.0-1160.95.1.el7.i686",
+            "gpg-pubkey-f4a80eb5-53a7ff4b",
+        ]
+        self.assertEqual(version.sort_rpm_nevras(nevras), [
+            "bash-4.2.46-35.el7_9.x86_64",
+            "gpg-pubkey-f4a80eb5-53a7ff4b",
+            "kernel-3.10.0-957.5.1.el7.x86_64",
+            "kernel-3.10.0-1160.el7.x86_64",
+            "kernel-3.10.0-1160.95.1.el7.i686",
+            "kernel-3.10.0-1160.95.1.el7.x86_64",
+            "kernel-1:2.6.32-754.el6.x86_64",
+        ])
+
+    def test_sort_wrong_nevra(self):
+        with self.assertRaises(ValueError):
+            version.sort_rpm_nevras(["bash-4.2.46-35.el7_9.x86_64", "bash"])
+
+
+class DebVersionCompareTests(unittest.TestCase):
+
+    def _check(self, left, right, expected):
+        self.assertEqual(version.compare_deb_versions(left, right), expected, f"{left} vs {right}")
+        self.assertEqual(version.compare_deb_versions(right, left), -expected, f"{right} vs {left}")
+
+    def test_equal(self):
+        self._check("1.0", "1.0", 0)
+        self._check("0:1.0", "1.0", 0)
+
+    def test_tilde(self):
+        self._check("1.0~rc1", "1.0", -1)
+
+    def test_revision(self):
+        self._check("1.0-1", "1.0-2", -1)
+        self._check("1.0-1ubuntu1", "1.0-1", 1)
+        self._check("2.31-0ubuntu9.9", "2.31-0ubuntu9.10", -1)
+        self._check("1.2-3-4", "1.2-3-5", -1)
+
+    def test_letters_and_symbols(self):
+        self._check("1.0a", "1.0", 1)
+        self._check("1.0+b1", "1.0", 1)
+        self._check("1.0.", "1.0", 1)
+
+    def test_epoch(self):
+        self._check("1:1.0", "2.0", 1)
+        self._check("1:2.0:3-1", "1:2.0:4-1", -1)
+        self._check("2:2.0:3-1", "1:2.0:4-1", 1)